@@ -2,14 +2,13 @@
 # Use of this source code is governed by the Apache 2.0 license that can be
 # found in the LICENSE file.
 """Base class support for android browsers"""
-import gzip
 import hashlib
 import logging
 import os
-import shutil
 import subprocess
 import time
-import ujson as json
+from .compression import compress_file
+from .support import json_codec as json
 
 class AndroidBrowser(object):
     """Android Browser base"""
@@ -155,11 +154,8 @@ class AndroidBrowser(object):
             tcpdump = os.path.join(task['dir'], task['prefix']) + '.cap'
             if os.path.isfile(tcpdump):
                 pcap_out = tcpdump + '.gz'
-                with open(tcpdump, 'rb') as f_in:
-                    with gzip.open(pcap_out, 'wb', 7) as f_out:
-                        shutil.copyfileobj(f_in, f_out)
+                compress_file(tcpdump, pcap_out, 'pcap')
                 if os.path.isfile(pcap_out):
-                    os.remove(tcpdump)
                     self.tcpdump_file = pcap_out
                     path_base = os.path.join(task['dir'], task['prefix'])
                     slices_file = path_base + '_pcap_slices.json.gz'
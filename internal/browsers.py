@@ -8,7 +8,7 @@ import os
 class Browsers(object):
     """Controller for handling several browsers"""
     def __init__(self, options, browsers, adb):
-        import ujson as json
+        from .support import json_codec as json
         self.options = options
         self.browsers = browsers
         self.adb = adb
@@ -2,11 +2,10 @@
 # Use of this source code is governed by the Apache 2.0 license that can be
 # found in the LICENSE file.
 """Chrome browser on Android"""
-import gzip
 import logging
 import os
-import shutil
 import time
+from .compression import compress_file
 from .devtools_browser import DevtoolsBrowser
 from .android_browser import AndroidBrowser
 
@@ -172,12 +171,8 @@ class ChromeAndroid(AndroidBrowser, DevtoolsBrowser):
             self.adb.adb(['pull', '/data/local/tmp/netlog.txt', netlog_file])
             self.adb.shell(['rm', '/data/local/tmp/netlog.txt'])
             if os.path.isfile(netlog_file):
-                netlog_gzip = netlog_file + '.gz'
-                with open(netlog_file, 'rb') as f_in:
-                    with gzip.open(netlog_gzip, 'wb', 7) as f_out:
-                        shutil.copyfileobj(f_in, f_out)
-                if os.path.isfile(netlog_gzip):
-                    os.remove(netlog_file)
+                task['compression_jobs'].append(compress_file(netlog_file,
+                                                              artifact='netlog'))
 
     def on_start_recording(self, task):
         """Notification that we are about to start an operation that needs to be recorded"""
@@ -2,10 +2,9 @@
 # Use of this source code is governed by the Apache 2.0 license that can be
 # found in the LICENSE file.
 """Logic for controlling a desktop Chrome browser"""
-import gzip
 import os
-import shutil
 import time
+from .compression import compress_file
 from .desktop_browser import DesktopBrowser
 from .devtools_browser import DevtoolsBrowser
 
@@ -117,12 +116,7 @@ class ChromeDesktop(DesktopBrowser, DevtoolsBrowser):
         DesktopBrowser.stop(self, job, task)
         netlog_file = os.path.join(task['dir'], task['prefix']) + '_netlog.txt'
         if os.path.isfile(netlog_file):
-            netlog_gzip = netlog_file + '.gz'
-            with open(netlog_file, 'rb') as f_in:
-                with gzip.open(netlog_gzip, 'wb', 7) as f_out:
-                    shutil.copyfileobj(f_in, f_out)
-            if os.path.isfile(netlog_gzip):
-                os.remove(netlog_file)
+            task['compression_jobs'].append(compress_file(netlog_file, artifact='netlog'))
 
     def on_start_recording(self, task):
         """Notification that we are about to start an operation that needs to be recorded"""
@@ -139,6 +133,12 @@ class ChromeDesktop(DesktopBrowser, DevtoolsBrowser):
         DesktopBrowser.on_start_processing(self, task)
         DevtoolsBrowser.on_start_processing(self, task)
 
+    def defer_processing(self, task):
+        """Snapshot the processing of the current step for the background worker"""
+        processor = DevtoolsBrowser.defer_processing(self, task)
+        DesktopBrowser.hand_off_processing(self, processor)
+        return processor
+
     def wait_for_processing(self, task):
         """Wait for any background processing threads to finish"""
         DesktopBrowser.wait_for_processing(self, task)
@@ -0,0 +1,233 @@
+# Copyright 2017 Google Inc. All rights reserved.
+# Use of this source code is governed by the Apache 2.0 license that can be
+# found in the LICENSE file.
+"""Shared compression service for the test result artifacts"""
+import gzip
+import logging
+import multiprocessing
+import os
+import Queue
+import threading
+import zlib
+import monotonic
+
+# Per-artifact compression policy:
+#   level - gzip compression level (0 stores the data uncompressed)
+#   parallel - compress independent blocks across the worker pool.  Each block
+#              is written as a separate gzip member which gzip readers
+#              (python, zlib, the gzip utility) transparently concatenate.
+#   background - compress files asynchronously, pass the job that compress_file()
+#                returns to wait_for_compression() before using them
+#   large - artifact switches to store-only with --gzipstore
+POLICY = {
+    'default': {'level': 7, 'parallel': False, 'background': False, 'large': False},
+    'devtools': {'level': 7, 'parallel': True, 'background': False, 'large': True},
+    'trace': {'level': 7, 'parallel': True, 'background': False, 'large': True},
+    'netlog': {'level': 7, 'parallel': True, 'background': True, 'large': True},
+    'pcap': {'level': 7, 'parallel': True, 'background': False, 'large': True},
+    'debug_log': {'level': 7, 'parallel': False, 'background': False, 'large': False},
+    'page_data': {'level': 7, 'parallel': False, 'background': False, 'large': False},
+}
+BLOCK_SIZE = 1024 * 1024
+
+class CompressionJob(object):
+    """A pending compression task"""
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def run(self):
+        """Run the task (on a worker thread)"""
+        try:
+            self.result = self.func(*self.args)
+        except Exception as err:
+            self.error = err
+        self.done.set()
+
+    def wait(self):
+        """Wait for the task to complete and return the result"""
+        while not self.done.is_set():
+            self.done.wait(1)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+class Compressor(object):
+    """Thread pool that compresses the artifacts (zlib releases the GIL while compressing)"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.jobs = Queue.Queue()
+        self.threads = []
+        self.policy = {}
+        for artifact in POLICY:
+            self.policy[artifact] = dict(POLICY[artifact])
+        try:
+            self.worker_count = max(2, multiprocessing.cpu_count())
+        except Exception:
+            self.worker_count = 2
+
+    def configure(self, options):
+        """Apply the command-line options to the artifact policies"""
+        if options is not None and getattr(options, 'gzipstore', False):
+            for artifact in self.policy:
+                if self.policy[artifact]['large']:
+                    self.policy[artifact]['level'] = 0
+
+    def get_policy(self, artifact):
+        """Get the compression policy for the given artifact type"""
+        return self.policy[artifact] if artifact in self.policy else self.policy['default']
+
+    def submit(self, func, *args):
+        """Queue a task for the worker pool"""
+        with self.lock:
+            if not self.threads:
+                for _ in xrange(self.worker_count):
+                    thread = threading.Thread(target=self.worker)
+                    thread.daemon = True
+                    thread.start()
+                    self.threads.append(thread)
+        job = CompressionJob(func, args)
+        self.jobs.put(job)
+        return job
+
+    def worker(self):
+        """Worker thread"""
+        while True:
+            job = self.jobs.get()
+            job.run()
+
+    def open(self, path, artifact='default'):
+        """Open a gzip file for writing"""
+        policy = self.get_policy(artifact)
+        if policy['parallel']:
+            return ParallelGzipFile(path, policy['level'], self)
+        return gzip.open(path, 'wb', policy['level'])
+
+    def compress_file(self, src, dest=None, artifact='default', remove=True):
+        """Compress the given file (asynchronously if the artifact policy calls for it).
+        Returns the job, job.wait() returns True if the file was compressed."""
+        if dest is None:
+            dest = src + '.gz'
+        job = CompressionJob(self.compress_file_job, (src, dest, artifact, remove))
+        if self.get_policy(artifact)['background']:
+            thread = threading.Thread(target=job.run)
+            thread.daemon = True
+            thread.start()
+        else:
+            job.run()
+        return job
+
+    def compress_file_job(self, src, dest, artifact, remove):
+        """Compress a file in blocks"""
+        ok = False
+        try:
+            start = monotonic.monotonic()
+            with open(src, 'rb') as f_in:
+                with self.open(dest, artifact) as f_out:
+                    while True:
+                        data = f_in.read(BLOCK_SIZE)
+                        if not data:
+                            break
+                        f_out.write(data)
+            ok = os.path.isfile(dest)
+            logging.debug("Compressed %s (%d bytes) in %0.3fs", os.path.basename(src),
+                          os.path.getsize(src), monotonic.monotonic() - start)
+            if ok and remove:
+                os.remove(src)
+        except Exception as err:
+            logging.critical("Error compressing %s: %s", src, err.__str__())
+        return ok
+
+    def write_file(self, path, data, artifact='default'):
+        """Write the given data to a gzip file"""
+        with self.open(path, artifact) as f_out:
+            f_out.write(data)
+
+class ParallelGzipFile(object):
+    """Write-only gzip file that compresses the blocks in the worker pool"""
+    def __init__(self, path, level, compressor):
+        self.file = open(path, 'wb')
+        self.level = level
+        self.compressor = compressor
+        self.buffer = []
+        self.buffered = 0
+        self.pending = []
+        self.blocks = 0
+        self.max_pending = compressor.worker_count * 2
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def write(self, data):
+        """Buffer the data and compress it in blocks"""
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= BLOCK_SIZE:
+            self.submit_block()
+            self.write_completed(False)
+
+    def submit_block(self):
+        """Hand the buffered data off to the pool"""
+        if self.buffered or not self.blocks:
+            data = ''.join(self.buffer)
+            self.buffer = []
+            self.buffered = 0
+            self.blocks += 1
+            self.pending.append(self.compressor.submit(compress_block, data, self.level))
+
+    def write_completed(self, wait):
+        """Write out the compressed blocks in order, waiting if too many are in flight"""
+        while self.pending and (wait or self.pending[0].done.is_set() or
+                                len(self.pending) > self.max_pending):
+            self.file.write(self.pending.pop(0).wait())
+
+    def flush(self):
+        """Nothing to do, data is only written in complete blocks"""
+        pass
+
+    def close(self):
+        """Compress anything remaining and close the file"""
+        if self.file is not None:
+            try:
+                self.submit_block()
+                self.write_completed(True)
+            finally:
+                self.file.close()
+                self.file = None
+
+def compress_block(data, level):
+    """Compress a block of data into a stand-alone gzip member"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+COMPRESSOR = Compressor()
+
+def configure(options):
+    """Apply the command-line options"""
+    COMPRESSOR.configure(options)
+
+def open_gzip(path, artifact='default'):
+    """Open a gzip file for writing using the artifact's policy"""
+    return COMPRESSOR.open(path, artifact)
+
+def compress_file(src, dest=None, artifact='default', remove=True):
+    """Compress the given file to dest (src.gz by default), returns the job handle"""
+    return COMPRESSOR.compress_file(src, dest, artifact, remove)
+
+def write_gzip(path, data, artifact='default'):
+    """Write the data to a gzip file"""
+    COMPRESSOR.write_file(path, data, artifact)
+
+def wait_for_compression(jobs):
+    """Wait for the given compression jobs (and only those) to complete"""
+    for job in jobs or []:
+        try:
+            job.wait()
+        except Exception:
+            pass
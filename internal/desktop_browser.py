@@ -2,7 +2,6 @@
 # Use of this source code is governed by the Apache 2.0 license that can be
 # found in the LICENSE file.
 """Base class support for desktop browsers"""
-import gzip
 import logging
 import os
 import platform
@@ -12,7 +11,10 @@ import subprocess
 import threading
 import time
 import monotonic
-import ujson as json
+from .compression import compress_file, open_gzip
+from .os_util import set_recording
+from .slots import get_slot_cpus
+from .support import json_codec as json
 
 class DesktopBrowser(object):
     """Desktop Browser base"""
@@ -36,6 +38,14 @@ class DesktopBrowser(object):
         self.task = None
         self.cpu_start = None
         self.throttling_cpu = False
+        # Each test slot throttles in its own cgroup, on one of its own CPUs
+        self.cgroup = 'wptagent'
+        self.throttle_cpu = 0
+        if options.slot is not None:
+            self.cgroup = 'wptagent{0:d}'.format(options.slot)
+            cpus = get_slot_cpus(options.slot, options.slots)
+            if cpus:
+                self.throttle_cpu = cpus[0]
         self.support_path = os.path.join(os.path.abspath(os.path.dirname(__file__)), "support")
 
     def prepare(self, _job, task):
@@ -119,6 +129,8 @@ class DesktopBrowser(object):
             self.proc.kill()
             self.proc = None
         self.disable_cpu_throttling()
+        # Never leave the background processing waiting on a run that didn't stop recording
+        set_recording(False)
         # Clean up the downloads folder in case anything was downloaded
         if platform.system() == 'Linux':
             downloads = os.path.expanduser('~/Downloads')
@@ -171,6 +183,7 @@ class DesktopBrowser(object):
         if task['log_data']:
             self.cpu_start = psutil.cpu_times()
             self.recording = True
+            set_recording(True)
             ver = platform.uname()
             task['page_data']['osVersion'] = '{0} {1}'.format(ver[0], ver[2])
             task['page_data']['os_version'] = '{0} {1}'.format(ver[0], ver[2])
@@ -226,13 +239,14 @@ class DesktopBrowser(object):
             task['page_data']['fullyLoadedCPUpct'] = cpu_pct
             self.cpu_start = None
         self.recording = False
+        set_recording(False)
         if self.thread is not None:
             self.thread.join()
             self.thread = None
         # record the CPU/Bandwidth/memory info
         if self.usage_queue is not None and not self.usage_queue.empty() and task is not None:
             file_path = os.path.join(task['dir'], task['prefix']) + '_progress.csv.gz'
-            gzfile = gzip.open(file_path, 'wb', 7)
+            gzfile = open_gzip(file_path)
             if gzfile:
                 gzfile.write("Offset Time (ms),Bandwidth In (bps),CPU Utilization (%),Memory\n")
                 while not self.usage_queue.empty():
@@ -282,33 +296,25 @@ class DesktopBrowser(object):
 
     def on_start_processing(self, _task):
         """Start any processing of the captured data"""
-        if self.pcap_file is not None:
-            logging.debug('Compressing pcap')
-            if os.path.isfile(self.pcap_file):
-                pcap_out = self.pcap_file + '.gz'
-                with open(self.pcap_file, 'rb') as f_in:
-                    with gzip.open(pcap_out, 'wb', 7) as f_out:
-                        shutil.copyfileobj(f_in, f_out)
-                if os.path.isfile(pcap_out):
-                    self.pcap_thread = threading.Thread(target=self.process_pcap)
-                    self.pcap_thread.daemon = True
-                    self.pcap_thread.start()
-                    try:
-                        os.remove(self.pcap_file)
-                    except Exception:
-                        pass
+        if self.pcap_file is not None and os.path.isfile(self.pcap_file):
+            # The pcap is compressed and parsed in the background
+            self.pcap_thread = threading.Thread(target=self.process_pcap)
+            self.pcap_thread.daemon = True
+            self.pcap_thread.start()
+
+    def hand_off_processing(self, processor):
+        """Hand the pcap and video processing of the current step over to the deferred
+        processing of the run (the browser forgets about them)"""
+        processor.pcap_file = self.pcap_file
+        processor.video_processing = self.video_processing
+        self.pcap_file = None
+        self.video_processing = None
 
     def wait_for_processing(self, task):
         """Wait for any background processing threads to finish"""
         if self.video_processing is not None:
-            logging.debug('Waiting for video processing to finish')
-            self.video_processing.communicate()
+            finish_video_processing(self.job, task, self.video_processing)
             self.video_processing = None
-            if not self.job['keepvideo']:
-                try:
-                    os.remove(task['video_file'])
-                except Exception:
-                    pass
         if self.pcap_thread is not None:
             logging.debug('Waiting for pcap processing to finish')
             self.pcap_thread.join()
@@ -317,27 +323,7 @@ class DesktopBrowser(object):
 
     def process_pcap(self):
         """Process the pcap in a background thread"""
-        pcap_file = self.pcap_file + '.gz'
-        if os.path.isfile(pcap_file):
-            path_base = os.path.join(self.task['dir'], self.task['prefix'])
-            slices_file = path_base + '_pcap_slices.json.gz'
-            pcap_parser = os.path.join(os.path.abspath(os.path.dirname(__file__)),
-                                       'support', "pcap-parser.py")
-            cmd = ['python', pcap_parser, '--json', '-i', pcap_file, '-d', slices_file]
-            logging.debug(cmd)
-            try:
-                stdout = subprocess.check_output(cmd)
-                if stdout is not None:
-                    result = json.loads(stdout)
-                    if result:
-                        if 'in' in result:
-                            self.task['page_data']['pcapBytesIn'] = result['in']
-                        if 'out' in result:
-                            self.task['page_data']['pcapBytesOut'] = result['out']
-                        if 'in_dup' in result:
-                            self.task['page_data']['pcapBytesInDup'] = result['in_dup']
-            except Exception:
-                pass
+        process_pcap(self.pcap_file, self.task)
 
     def get_net_bytes(self):
         """Get the bytes received, ignoring the loopback interface"""
@@ -381,19 +367,20 @@ class DesktopBrowser(object):
             try:
                 import getpass
                 uid = '{0}:{0}'.format(getpass.getuser())
-                cmd = ['sudo', 'cgcreate', '-a', uid, '-t', uid, '-g', 'cpu,cpuset:wptagent']
+                cmd = ['sudo', 'cgcreate', '-a', uid, '-t', uid, '-g', 'cpu,cpuset:' + self.cgroup]
                 logging.debug(' '.join(cmd))
                 subprocess.check_call(cmd)
-                cmd = ['sudo', 'cgset', '-r', 'cpuset.cpus="0"', 'wptagent']
+                cmd = ['sudo', 'cgset', '-r', 'cpuset.cpus="{0:d}"'.format(self.throttle_cpu),
+                       self.cgroup]
                 logging.debug(' '.join(cmd))
                 subprocess.check_call(cmd)
-                cmd = ['sudo', 'cgset', '-r', 'cpu.cfs_period_us=1000', 'wptagent']
+                cmd = ['sudo', 'cgset', '-r', 'cpu.cfs_period_us=1000', self.cgroup]
                 logging.debug(' '.join(cmd))
                 subprocess.check_call(cmd)
-                cmd = ['sudo', 'cgset', '-r', 'cpu.cfs_quota_us=1000', 'wptagent']
+                cmd = ['sudo', 'cgset', '-r', 'cpu.cfs_quota_us=1000', self.cgroup]
                 logging.debug(' '.join(cmd))
                 subprocess.check_call(cmd)
-                command_line = 'cgexec -g cpu:wptagent ' + command_line
+                command_line = 'cgexec -g cpu:{0} {1}'.format(self.cgroup, command_line)
             except Exception as err:
                 logging.critical("Exception enabling throttling: %s", err.__str__())
             self.throttling_cpu = True
@@ -403,7 +390,7 @@ class DesktopBrowser(object):
         """Remove the CPU throttling if necessary"""
         if self.throttling_cpu:
             try:
-                cmd = ['sudo', 'cgdelete', '-r', 'cpu,cpuset:wptagent']
+                cmd = ['sudo', 'cgdelete', '-r', 'cpu,cpuset:' + self.cgroup]
                 logging.debug(' '.join(cmd))
                 subprocess.check_call(cmd)
             except Exception:
@@ -415,7 +402,8 @@ class DesktopBrowser(object):
             try:
                 # Leave the quota at 1000 and vary the period to get to the correct multiplier
                 period = int(round(1000.0 * self.job['throttle_cpu']))
-                cmd = ['sudo', 'cgset', '-r', 'cpu.cfs_period_us={0:d}'.format(period), 'wptagent']
+                cmd = ['sudo', 'cgset', '-r', 'cpu.cfs_period_us={0:d}'.format(period),
+                       self.cgroup]
                 logging.debug(' '.join(cmd))
                 subprocess.check_call(cmd)
             except Exception:
@@ -425,8 +413,46 @@ class DesktopBrowser(object):
         """Start the CPU throttling if necessary"""
         if self.throttling_cpu:
             try:
-                cmd = ['sudo', 'cgset', '-r', 'cpu.cfs_period_us=1000', 'wptagent']
+                cmd = ['sudo', 'cgset', '-r', 'cpu.cfs_period_us=1000', self.cgroup]
                 logging.debug(' '.join(cmd))
                 subprocess.check_call(cmd)
             except Exception:
                 pass
+
+
+def finish_video_processing(job, task, video_processing):
+    """Wait for the video processing of a step and clean up the raw capture"""
+    logging.debug('Waiting for video processing to finish')
+    video_processing.communicate()
+    if not job['keepvideo']:
+        try:
+            os.remove(task['video_file'])
+        except Exception:
+            pass
+
+
+def process_pcap(pcap_file, task):
+    """Compress and parse the pcap of a step"""
+    logging.debug('Compressing pcap')
+    pcap_out = pcap_file + '.gz'
+    compress_file(pcap_file, pcap_out, 'pcap')
+    if os.path.isfile(pcap_out):
+        path_base = os.path.join(task['dir'], task['prefix'])
+        slices_file = path_base + '_pcap_slices.json.gz'
+        pcap_parser = os.path.join(os.path.abspath(os.path.dirname(__file__)),
+                                   'support', "pcap-parser.py")
+        cmd = ['python', pcap_parser, '--json', '-i', pcap_out, '-d', slices_file]
+        logging.debug(cmd)
+        try:
+            stdout = subprocess.check_output(cmd)
+            if stdout is not None:
+                result = json.loads(stdout)
+                if result:
+                    if 'in' in result:
+                        task['page_data']['pcapBytesIn'] = result['in']
+                    if 'out' in result:
+                        task['page_data']['pcapBytesOut'] = result['out']
+                    if 'in_dup' in result:
+                        task['page_data']['pcapBytesInDup'] = result['in_dup']
+        except Exception:
+            pass
@@ -3,17 +3,131 @@
 # found in the LICENSE file.
 """Main entry point for interfacing with Chrome's remote debugging protocol"""
 import base64
-import gzip
+import collections
+import hashlib
+import io
 import logging
+import multiprocessing
 import os
 import Queue
 import re
+import struct
 import subprocess
+import threading
 import time
 import zipfile
 import monotonic
-import ujson as json
-from ws4py.client.threadedclient import WebSocketClient
+from ws4py.client import WebSocketBaseClient
+from ws4py.manager import WebSocketManager
+from .compression import open_gzip
+from .support import json_codec as json
+
+# Response bodies larger than this are never fetched
+MAX_BODY_SIZE = 10000000
+BODY_TIMEOUT = 10
+# The devtools events are buffered and written out in blocks this size
+LOG_BLOCK_SIZE = 64 * 1024
+# Reading from a session's socket is paused when its message queue backs up past the
+# high-water mark (letting TCP push back on the browser) and resumed once the queue
+# drains below the low-water mark
+MESSAGE_QUEUE_HIGH = 10000
+MESSAGE_QUEUE_LOW = 1000
+
+class NetworkRequest(object):
+    """Request details, updated incrementally as the Network events arrive.
+    The flattened record used by the optimization checks and body fetching is
+    cached until the next update."""
+    __slots__ = ['request_id', 'target_id', 'from_net', 'is_video', 'url', 'request_headers',
+                 'response', 'data_size', 'has_data', 'finished_size', 'body', 'record']
+
+    def __init__(self, request_id):
+        self.request_id = request_id
+        self.target_id = None
+        self.from_net = False
+        self.is_video = False
+        self.url = None
+        self.request_headers = None
+        self.response = None
+        self.data_size = 0
+        self.has_data = False
+        self.finished_size = None
+        self.body = None
+        self.record = None
+
+    def request_sent(self, params):
+        """Network.requestWillBeSent"""
+        self.record = None
+        self.from_net = True
+        if 'url' in params and params['url'].endswith('.mp4'):
+            self.is_video = True
+        if 'request' in params:
+            self.url = params['request']['url'] if 'url' in params['request'] else None
+            self.request_headers = params['request']['headers'] \
+                if 'headers' in params['request'] else None
+
+    def response_received(self, params):
+        """Network.responseReceived"""
+        self.record = None
+        if 'response' in params:
+            response = params['response']
+            self.response = response
+            if 'fromDiskCache' in response and response['fromDiskCache']:
+                self.from_net = False
+            if 'fromServiceWorker' in response and response['fromServiceWorker']:
+                self.from_net = False
+            if 'mimeType' in response and response['mimeType'].startswith('video/'):
+                self.is_video = True
+
+    def data_received(self, params):
+        """Network.dataReceived"""
+        self.record = None
+        self.has_data = True
+        if 'encodedDataLength' in params:
+            self.data_size += params['encodedDataLength']
+        elif 'dataLength' in params:
+            self.data_size += params['dataLength']
+
+    def loading_finished(self, params):
+        """Network.loadingFinished"""
+        self.record = None
+        if 'encodedDataLength' in params:
+            self.finished_size = params['encodedDataLength']
+
+    def set_body(self, path):
+        """The response body was stored to disk"""
+        self.record = None
+        self.body = path
+
+    def get_record(self):
+        """Flattened request details (headers, body file, transfer size)"""
+        if self.record is None:
+            record = {'id': self.request_id}
+            if self.body is not None:
+                record['body'] = self.body
+            # Get the headers from responseReceived
+            if self.response is not None:
+                if 'url' in self.response:
+                    record['url'] = self.response['url']
+                if 'status' in self.response:
+                    record['status'] = self.response['status']
+                if 'headers' in self.response:
+                    record['response_headers'] = self.response['headers']
+                if 'requestHeaders' in self.response:
+                    record['request_headers'] = self.response['requestHeaders']
+                if 'connectionId' in self.response:
+                    record['connection'] = self.response['connectionId']
+            # Fill in any missing details from the requestWillBeSent event
+            if 'url' not in record and self.url is not None:
+                record['url'] = self.url
+            if 'request_headers' not in record and self.request_headers is not None:
+                record['request_headers'] = self.request_headers
+            # Get the response length from the data events
+            if self.finished_size is not None:
+                record['transfer_size'] = self.finished_size
+            elif self.has_data:
+                record['transfer_size'] = self.data_size
+            self.record = record
+        return self.record
 
 class DevTools(object):
     """Interface into Chrome's remote dev tools protocol"""
@@ -24,18 +138,18 @@ class DevTools(object):
         self.job = job
         self.task = task
         self.command_id = 0
-        self.command_responses = {}
-        self.pending_commands = []
         self.workers = []
         self.page_loaded = None
         self.main_frame = None
         self.is_navigating = False
         self.last_activity = monotonic.monotonic()
-        self.dev_tools_file = None
+        self.dev_tools_log = None
         self.trace_file = None
         self.trace_enabled = False
         self.requests = {}
-        self.response_bodies = {}
+        self.response_bodies = set()
+        self.body_queue = []
+        self.body_fetches = {}
         self.body_fail_count = 0
         self.body_index = 0
         self.bodies_zip_file = None
@@ -58,7 +172,9 @@ class DevTools(object):
     def prepare(self):
         """Set up the various paths and states"""
         self.requests = {}
-        self.response_bodies = {}
+        self.response_bodies = set()
+        self.body_queue = []
+        self.body_fetches = {}
         self.nav_error = None
         self.nav_error_code = None
         self.main_request = None
@@ -133,7 +249,7 @@ class DevTools(object):
                                     requests.get(self.url + '/close/' + tabs[index]['id'])
                         if websocket_url is not None:
                             try:
-                                self.websocket = DevToolsClient(websocket_url)
+                                self.websocket = DevToolsClient(websocket_url, trusted_peer=True)
                                 self.websocket.connect()
                                 ret = True
                             except Exception as err:
@@ -143,7 +259,8 @@ class DevTools(object):
                                 # try connecting to 127.0.0.1 instead of localhost
                                 try:
                                     websocket_url = websocket_url.replace('localhost', '127.0.0.1')
-                                    self.websocket = DevToolsClient(websocket_url)
+                                    self.websocket = DevToolsClient(websocket_url,
+                                                                    trusted_peer=True)
                                     self.websocket.connect()
                                     ret = True
                                 except Exception as err:
@@ -187,6 +304,8 @@ class DevTools(object):
         """Start capturing dev tools, timeline and trace data"""
         self.prepare()
         self.recording = True
+        if self.websocket:
+            self.websocket.set_recording(True)
         if self.use_devtools_video and self.job['video'] and self.task['log_data']:
             self.grab_screenshot(self.video_prefix + '000000.jpg', png=False)
         elif self.mobile_viewport is None and not self.options.android:
@@ -198,26 +317,26 @@ class DevTools(object):
             except Exception:
                 pass
         self.flush_pending_messages()
-        self.send_command('Page.enable', {})
-        self.send_command('Inspector.enable', {})
-        self.send_command('ServiceWorker.enable', {})
-        self.send_command('Network.enable', {})
+        # Pipeline all of the setup commands and wait for them together
+        commands = [('Page.enable', {}),
+                    ('Inspector.enable', {}),
+                    ('ServiceWorker.enable', {}),
+                    ('Network.enable', {})]
         if len(self.workers):
             for target in self.workers:
-                self.send_command('Network.enable', {}, target_id=target['targetId'])
+                commands.append(('Network.enable', {}, target['targetId']))
         if 'user_agent_string' in self.job:
-            self.send_command('Network.setUserAgentOverride',
-                              {'userAgent': self.job['user_agent_string']}, wait=True)
+            commands.append(('Network.setUserAgentOverride',
+                             {'userAgent': self.job['user_agent_string']}))
         if 'headers' in self.job:
-            self.send_command('Network.setExtraHTTPHeaders',
-                              {'headers': self.job['headers']}, wait=True)
+            commands.append(('Network.setExtraHTTPHeaders', {'headers': self.job['headers']}))
         if len(self.task['block']):
             for block in self.task['block']:
-                self.send_command('Network.addBlockedURL', {'url': block})
-            self.send_command('Network.setBlockedURLs', {'urls': self.task['block']})
+                commands.append(('Network.addBlockedURL', {'url': block}))
+            commands.append(('Network.setBlockedURLs', {'urls': self.task['block']}))
         if self.task['log_data']:
-            self.send_command('Security.enable', {})
-            self.send_command('Console.enable', {})
+            commands.append(('Security.enable', {}))
+            commands.append(('Console.enable', {}))
             if 'trace' in self.job and self.job['trace']:
                 if 'traceCategories' in self.job:
                     trace = self.job['traceCategories']
@@ -234,9 +353,9 @@ class DevTools(object):
                 self.recording_video = True
             trace += ",rail,blink.user_timing,netlog"
             self.trace_enabled = True
-            self.send_command('Tracing.start',
-                              {'categories': trace, 'options': 'record-as-much-as-possible'},
-                              wait=True)
+            commands.append(('Tracing.start',
+                             {'categories': trace, 'options': 'record-as-much-as-possible'}))
+        self.send_many(commands)
         now = monotonic.monotonic()
         if not self.task['stop_at_onload']:
             self.last_activity = now
@@ -246,6 +365,8 @@ class DevTools(object):
     def stop_recording(self):
         """Stop capturing dev tools, timeline and trace data"""
         self.recording = False
+        if self.websocket:
+            self.websocket.set_recording(False)
         self.send_command('Inspector.disable', {})
         self.send_command('Page.disable', {})
         self.collect_trace()
@@ -254,6 +375,7 @@ class DevTools(object):
             self.send_command('Security.disable', {})
             self.send_command('Console.disable', {})
             self.get_response_bodies()
+        self.fetch_bodies(True)
         if self.bodies_zip_file is not None:
             self.bodies_zip_file.close()
             self.bodies_zip_file = None
@@ -262,10 +384,20 @@ class DevTools(object):
             for target in self.workers:
                 self.send_command('Network.disable', {}, target_id=target['targetId'])
         self.send_command('ServiceWorker.disable', {})
-        if self.dev_tools_file is not None:
-            self.dev_tools_file.write("\n]")
-            self.dev_tools_file.close()
-            self.dev_tools_file = None
+        if self.dev_tools_log is not None:
+            self.dev_tools_log.close()
+            self.dev_tools_log = None
+        self.record_queue_stats()
+
+    def record_queue_stats(self):
+        """Add the websocket message queue stats (since the last test) to the page data"""
+        if self.websocket:
+            stats = self.websocket.messages.get_stats()
+            self.websocket.messages.reset_stats()
+            self.task['page_data']['devtoolsMessages'] = stats['messages']
+            self.task['page_data']['devtoolsQueueHighWater'] = stats['high_water']
+            self.task['page_data']['devtoolsMessagesDropped'] = stats['dropped']
+            self.task['page_data']['devtoolsQueuePauses'] = stats['pauses']
 
     def collect_trace(self):
         """Stop tracing and collect the results"""
@@ -301,8 +433,9 @@ class DevTools(object):
             self.recording_video = False
 
     def get_response_body(self, request_id):
-        """Retrieve and store the given response body (if necessary)"""
-        if request_id not in self.response_bodies and self.body_fail_count < 3:
+        """Queue the given response body to be fetched (if necessary)"""
+        if request_id not in self.response_bodies and request_id not in self.body_fetches and \
+                self.body_fail_count < 3:
             request = self.get_request(request_id)
             if request is not None and 'status' in request and request['status'] == 200 and \
                     'response_headers' in request:
@@ -314,11 +447,7 @@ class DevTools(object):
                     content_length = request['transfer_size']
                 else:
                     content_length = 0
-                logging.debug('Getting body for %s (%d) - %s', request_id,
-                               content_length, request['url'])
                 path = os.path.join(self.task['dir'], 'bodies')
-                if not os.path.isdir(path):
-                    os.makedirs(path)
                 body_file_path = os.path.join(path, request_id)
                 if not os.path.exists(body_file_path):
                     # Only grab bodies needed for optimization checks
@@ -333,50 +462,107 @@ class DevTools(object):
                                 content_type.find('javascript') >= 0 or \
                                 content_type.find('json') >= 0:
                             is_text = True
-                        # Ignore video files over 10MB
-                        if content_type[:6] == 'video/' and content_length > 10000000:
+                        # None of the checks look at audio or video
+                        if content_type[:6] == 'video/' or content_type[:6] == 'audio/':
                             need_body = False
+                    if content_length > MAX_BODY_SIZE:
+                        need_body = False
                     optimization_checks_disabled = bool('noopt' in self.job and self.job['noopt'])
-                    if optimization_checks_disabled and self.bodies_zip_file is None:
+                    if optimization_checks_disabled and \
+                            (self.bodies_zip_file is None or not is_text):
                         need_body = False
                     if need_body:
+                        logging.debug('Queueing body fetch for %s (%d) - %s', request_id,
+                                      content_length, request['url'])
                         target_id = None
-                        if request_id in self.requests and 'targetId' in self.requests[request_id]:
-                            target_id = self.requests[request_id]['targetId']
-                        response = self.send_command("Network.getResponseBody",
-                                                     {'requestId': request_id}, wait=True,
-                                                     target_id=target_id)
-                        if response is None:
-                            self.body_fail_count += 1
-                            logging.warning('No response to body request for request %s',
-                                            request_id)
-                        elif 'result' not in response or \
-                                'body' not in response['result']:
-                            self.body_fail_count = 0
-                            logging.warning('Missing response body for request %s',
-                                            request_id)
-                        elif len(response['result']['body']):
-                            self.body_fail_count = 0
-                            # Write the raw body to a file (all bodies)
-                            if 'base64Encoded' in response['result'] and \
-                                    response['result']['base64Encoded']:
-                                body = base64.b64decode(response['result']['body'])
-                            else:
-                                body = response['result']['body'].encode('utf-8')
-                                is_text = True
-                            # Add text bodies to the zip archive
-                            if self.bodies_zip_file is not None and is_text:
-                                self.body_index += 1
-                                name = '{0:03d}-{1}-body.txt'.format(self.body_index, request_id)
-                                self.bodies_zip_file.writestr(name, body)
-                                logging.debug('%s: Stored body in zip', request_id)
-                            logging.debug('%s: Body length: %d', request_id, len(body))
-                            self.response_bodies[request_id] = body
-                            with open(body_file_path, 'wb') as body_file:
-                                body_file.write(body)
-                        else:
-                            self.body_fail_count = 0
-                            self.response_bodies[request_id] = response['result']['body']
+                        if request_id in self.requests:
+                            target_id = self.requests[request_id].target_id
+                        self.body_fetches[request_id] = {'path': body_file_path,
+                                                         'is_text': is_text,
+                                                         'target_id': target_id,
+                                                         'future': None,
+                                                         'start': None}
+                        self.body_queue.append(request_id)
+        self.fetch_bodies()
+
+    def fetch_bodies(self, wait=False):
+        """Keep up to --bodyfetches body requests in flight and store the completed ones.
+        Only waits for the outstanding requests if wait is True."""
+        while self.body_fetches:
+            now = monotonic.monotonic()
+            # Store any completed bodies
+            for request_id in self.body_fetches.keys():
+                fetch = self.body_fetches[request_id]
+                future = fetch['future']
+                if future is not None and \
+                        (future.done.is_set() or now - fetch['start'] > BODY_TIMEOUT):
+                    del self.body_fetches[request_id]
+                    if not future.done.is_set() and self.websocket:
+                        self.websocket.resolve_command(future.command_id, None)
+                    self.store_response_body(request_id, fetch, future.response)
+            if self.body_fail_count >= 3:
+                for request_id in self.body_queue:
+                    del self.body_fetches[request_id]
+                self.body_queue = []
+            # Start more requests
+            in_flight = len(self.body_fetches) - len(self.body_queue)
+            while self.body_queue and in_flight < self.options.bodyfetches:
+                request_id = self.body_queue.pop(0)
+                fetch = self.body_fetches[request_id]
+                fetch['start'] = now
+                fetch['future'] = self.send_command_async("Network.getResponseBody",
+                                                          {'requestId': request_id},
+                                                          target_id=fetch['target_id'])
+                if fetch['future'] is None:
+                    del self.body_fetches[request_id]
+                else:
+                    in_flight += 1
+            if not wait or not self.body_fetches:
+                break
+            # Wait for the oldest request to complete
+            oldest = None
+            for request_id in self.body_fetches:
+                fetch = self.body_fetches[request_id]
+                if fetch['future'] is not None and \
+                        (oldest is None or fetch['start'] < oldest['start']):
+                    oldest = fetch
+            if oldest is not None:
+                oldest['future'].wait(max(0.01, oldest['start'] + BODY_TIMEOUT - now))
+
+    def store_response_body(self, request_id, fetch, response):
+        """Write a fetched body straight to disk (and the bodies zip for text)"""
+        if response is None:
+            self.body_fail_count += 1
+            logging.warning('No response to body request for request %s', request_id)
+        elif 'result' not in response or 'body' not in response['result']:
+            self.body_fail_count = 0
+            logging.warning('Missing response body for request %s', request_id)
+        else:
+            self.body_fail_count = 0
+            self.response_bodies.add(request_id)
+            if len(response['result']['body']):
+                # Write the raw body to a file (all bodies)
+                is_text = fetch['is_text']
+                if 'base64Encoded' in response['result'] and \
+                        response['result']['base64Encoded']:
+                    body = base64.b64decode(response['result']['body'])
+                else:
+                    body = response['result']['body'].encode('utf-8')
+                    is_text = True
+                # Add text bodies to the zip archive
+                if self.bodies_zip_file is not None and is_text:
+                    self.body_index += 1
+                    name = '{0:03d}-{1}-body.txt'.format(self.body_index, request_id)
+                    self.bodies_zip_file.writestr(name, body)
+                    logging.debug('%s: Stored body in zip', request_id)
+                logging.debug('%s: Body length: %d', request_id, len(body))
+                path = os.path.dirname(fetch['path'])
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+                with open(fetch['path'], 'wb') as body_file:
+                    body_file.write(body)
+                if request_id in self.requests:
+                    self.requests[request_id].set_body(fetch['path'])
 
     def get_response_bodies(self):
         """Retrieve all of the response bodies for the requests that we know about"""
@@ -384,54 +570,13 @@ class DevTools(object):
         if self.task['error'] is None and requests:
             for request_id in requests:
                 self.get_response_body(request_id)
+        self.fetch_bodies(True)
 
     def get_request(self, request_id):
         """Get the given request details if it is a real request"""
         request = None
-        if request_id in self.requests and 'fromNet' in self.requests[request_id] \
-                and self.requests[request_id]['fromNet']:
-            events = self.requests[request_id]
-            request = {'id': request_id}
-            # See if we have a body
-            body_path = os.path.join(self.task['dir'], 'bodies')
-            body_file_path = os.path.join(body_path, request_id)
-            if os.path.isfile(body_file_path):
-                request['body'] = body_file_path
-            if request_id in self.response_bodies:
-                request['response_body'] = self.response_bodies[request_id]
-            # Get the headers from responseReceived
-            if 'response' in events:
-                response = events['response'][-1]
-                if 'response' in response:
-                    if 'url' in response['response']:
-                        request['url'] = response['response']['url']
-                    if 'status' in response['response']:
-                        request['status'] = response['response']['status']
-                    if 'headers' in response['response']:
-                        request['response_headers'] = response['response']['headers']
-                    if 'requestHeaders' in response['response']:
-                        request['request_headers'] = response['response']['requestHeaders']
-                    if 'connectionId' in response['response']:
-                        request['connection'] = response['response']['connectionId']
-            # Fill in any missing details from the requestWillBeSent event
-            if 'request' in events:
-                req = events['request'][-1]
-                if 'request' in req:
-                    if 'url' not in request and 'url' in req['request']:
-                        request['url'] = req['request']['url']
-                    if 'request_headers' not in request and 'headers' in req['request']:
-                        request['request_headers'] = req['request']['headers']
-            # Get the response length from the data events
-            if 'finished' in events and 'encodedDataLength' in events['finished']:
-                request['transfer_size'] = events['finished']['encodedDataLength']
-            elif 'data' in events:
-                transfer_size = 0
-                for data in events['data']:
-                    if 'encodedDataLength' in data:
-                        transfer_size += data['encodedDataLength']
-                    elif 'dataLength' in data:
-                        transfer_size += data['dataLength']
-                request['transfer_size'] = transfer_size
+        if request_id in self.requests and self.requests[request_id].from_net:
+            request = self.requests[request_id].get_record()
         return request
 
     def get_requests(self):
@@ -449,76 +594,80 @@ class DevTools(object):
     def flush_pending_messages(self):
         """Clear out any pending websocket messages"""
         if self.websocket:
+            if not self.recording:
+                self.websocket.messages.discard()
+                return
+            while True:
+                messages = self.websocket.get_messages(0)
+                if not messages:
+                    break
+                self.process_messages(messages)
+
+    def process_messages(self, messages):
+        """Process a batch of raw messages from the websocket"""
+        for raw in messages:
             try:
-                while True:
-                    raw = self.websocket.get_message(0)
-                    if raw is not None and len(raw):
-                        if self.recording:
-                            logging.debug(raw[:200])
-                            msg = json.loads(raw)
-                            self.process_message(msg)
-                    if not raw:
-                        break
+                if raw is not None and len(raw):
+                    logging.debug(raw[:200])
+                    msg = json.loads(raw)
+                    self.process_message(msg)
             except Exception:
                 pass
 
     def send_command(self, method, params, wait=False, timeout=10, target_id=None):
         """Send a raw dev tools message and optionally wait for the response"""
         ret = None
-        if target_id is not None:
-            self.command_id += 1
-            command_id = int(self.command_id)
-            msg = {'id': command_id, 'method': method, 'params': params}
-            if wait:
-                self.pending_commands.append(command_id)
-            end_time = monotonic.monotonic() + timeout
-            self.send_command('Target.sendMessageToTarget',
-                              {'targetId': target_id, 'message': json.dumps(msg)},
-                              wait=True, timeout=timeout)
-            if wait:
-                if command_id in self.command_responses:
-                    ret = self.command_responses[command_id]
-                    del self.command_responses[command_id]
-                else:
-                    while ret is None and monotonic.monotonic() < end_time:
-                        try:
-                            raw = self.websocket.get_message(1)
-                            if raw is not None and len(raw):
-                                logging.debug(raw[:200])
-                                msg = json.loads(raw)
-                                self.process_message(msg)
-                                if command_id in self.command_responses:
-                                    ret = self.command_responses[command_id]
-                                    del self.command_responses[command_id]
-                        except Exception:
-                            pass
-        elif self.websocket:
+        future = self.send_command_async(method, params, target_id=target_id, track=wait)
+        if future is not None:
+            ret = future.wait(timeout)
+            if ret is None and self.websocket:
+                self.websocket.resolve_command(future.command_id, None)
+        return ret
+
+    def send_command_async(self, method, params, target_id=None, track=True):
+        """Send a dev tools command without waiting.
+        Returns a future for the response (if tracked)"""
+        future = None
+        if self.websocket:
             self.command_id += 1
             command_id = int(self.command_id)
-            if wait:
-                self.pending_commands.append(command_id)
             msg = {'id': command_id, 'method': method, 'params': params}
+            if track:
+                future = self.websocket.register_command(command_id)
             try:
+                if target_id is not None:
+                    # The response is dispatched from Target.receivedMessageFromTarget,
+                    # there is no need to wait for sendMessageToTarget to be acknowledged
+                    self.command_id += 1
+                    msg = {'id': int(self.command_id), 'method': 'Target.sendMessageToTarget',
+                           'params': {'targetId': target_id, 'message': json.dumps(msg)}}
                 out = json.dumps(msg)
                 logging.debug("Sending: %s", out)
                 self.websocket.send(out)
-                if wait:
-                    end_time = monotonic.monotonic() + timeout
-                    while ret is None and monotonic.monotonic() < end_time:
-                        try:
-                            raw = self.websocket.get_message(1)
-                            if raw is not None and len(raw):
-                                logging.debug(raw[:200])
-                                msg = json.loads(raw)
-                                self.process_message(msg)
-                                if command_id in self.command_responses:
-                                    ret = self.command_responses[command_id]
-                                    del self.command_responses[command_id]
-                        except Exception:
-                            pass
             except Exception as err:
                 logging.critical("Websocket send error: %s", err.__str__())
-        return ret
+                if future is not None:
+                    self.websocket.resolve_command(command_id, None)
+        return future
+
+    def send_many(self, commands, timeout=10):
+        """Pipeline a batch of commands and wait for all of the responses.
+        commands is a list of (method, params) or (method, params, target_id) tuples,
+        returns the list of responses (None for any that failed or timed out)."""
+        futures = []
+        for command in commands:
+            target_id = command[2] if len(command) > 2 else None
+            futures.append(self.send_command_async(command[0], command[1], target_id=target_id))
+        end_time = monotonic.monotonic() + timeout
+        responses = []
+        for future in futures:
+            response = None
+            if future is not None:
+                response = future.wait(max(0, end_time - monotonic.monotonic()))
+                if response is None and self.websocket:
+                    self.websocket.resolve_command(future.command_id, None)
+            responses.append(response)
+        return responses
 
     def wait_for_page_load(self):
         """Wait for the page load and activity to finish"""
@@ -527,14 +676,11 @@ class DevTools(object):
             end_time = start_time + self.task['time_limit']
             done = False
             while not done:
+                self.process_messages(self.websocket.get_messages(1))
                 try:
-                    raw = self.websocket.get_message(1)
-                    if raw is not None and len(raw):
-                        logging.debug(raw[:200])
-                        msg = json.loads(raw)
-                        self.process_message(msg)
+                    # Store any bodies that have arrived (doesn't count as activity)
+                    self.fetch_bodies()
                 except Exception:
-                    # ignore timeouts when we're in a polling read loop
                     pass
                 now = monotonic.monotonic()
                 elapsed_test = now - start_time
@@ -563,30 +709,68 @@ class DevTools(object):
         if not self.main_thread_blocked:
             response = self.send_command("Page.captureScreenshot", {}, wait=True, timeout=10)
             if response is not None and 'result' in response and 'data' in response['result']:
-                resize_string = '' if not resize else '-resize {0:d}x{0:d} '.format(resize)
-                if png:
-                    with open(path, 'wb') as image_file:
-                        image_file.write(base64.b64decode(response['result']['data']))
-                    # Fix png issues
-                    cmd = 'mogrify -format png -define png:color-type=2 '\
-                            '-depth 8 {0}"{1}"'.format(resize_string, path)
-                    logging.debug(cmd)
-                    subprocess.call(cmd, shell=True)
-                    self.crop_screen_shot(path)
-                else:
-                    tmp_file = path + '.png'
-                    with open(tmp_file, 'wb') as image_file:
-                        image_file.write(base64.b64decode(response['result']['data']))
-                    self.crop_screen_shot(tmp_file)
-                    command = 'convert "{0}" {1}-quality {2:d} "{3}"'.format(
-                        tmp_file, resize_string, self.job['iq'], path)
-                    logging.debug(command)
-                    subprocess.call(command, shell=True)
-                    if os.path.isfile(tmp_file):
-                        try:
-                            os.remove(tmp_file)
-                        except Exception:
-                            pass
+                data = base64.b64decode(response['result']['data'])
+                if not self.save_screenshot(data, path, png, resize):
+                    self.convert_screenshot(data, path, png, resize)
+
+    def save_screenshot(self, data, path, png, resize):
+        """Decode, crop, resize and encode the screen shot in one pass in-process (Pillow).
+        Returns False if it needs to fall back to ImageMagick."""
+        ok = False
+        try:
+            from PIL import Image
+            image = Image.open(io.BytesIO(data))
+            # Same as png:color-type=2 -depth 8 (8-bit RGB)
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            if self.needs_crop():
+                self.find_mobile_viewport(image)
+                if self.mobile_viewport is not None:
+                    width, height = image.size
+                    image = image.crop((0, 0, min(width, self.mobile_viewport[0]),
+                                        min(height, self.mobile_viewport[1])))
+            if resize:
+                # Scale to fit in a resize x resize box, like ImageMagick's -resize
+                width, height = image.size
+                scale = min(float(resize) / float(width), float(resize) / float(height))
+                size = (max(1, int(round(width * scale))), max(1, int(round(height * scale))))
+                if size != image.size:
+                    image = image.resize(size, Image.ANTIALIAS)
+            if png:
+                image.save(path, 'PNG')
+            else:
+                image.save(path, 'JPEG', quality=self.job['iq'])
+            ok = True
+        except Exception as err:
+            logging.debug('Error processing the screen shot in-process: %s', err.__str__())
+        return ok
+
+    def convert_screenshot(self, data, path, png, resize):
+        """Save the screen shot using the ImageMagick command-line tools"""
+        resize_string = '' if not resize else '-resize {0:d}x{0:d} '.format(resize)
+        if png:
+            with open(path, 'wb') as image_file:
+                image_file.write(data)
+            # Fix png issues
+            cmd = 'mogrify -format png -define png:color-type=2 '\
+                    '-depth 8 {0}"{1}"'.format(resize_string, path)
+            logging.debug(cmd)
+            subprocess.call(cmd, shell=True)
+            self.crop_screen_shot(path)
+        else:
+            tmp_file = path + '.png'
+            with open(tmp_file, 'wb') as image_file:
+                image_file.write(data)
+            self.crop_screen_shot(tmp_file)
+            command = 'convert "{0}" {1}-quality {2:d} "{3}"'.format(
+                tmp_file, resize_string, self.job['iq'], path)
+            logging.debug(command)
+            subprocess.call(command, shell=True)
+            if os.path.isfile(tmp_file):
+                try:
+                    os.remove(tmp_file)
+                except Exception:
+                    pass
 
     def colors_are_similar(self, color1, color2, threshold=15):
         """See if 2 given pixels are of similar color"""
@@ -601,57 +785,65 @@ class DevTools(object):
             similar = False
         return similar
 
+    def needs_crop(self):
+        """Screen shots are cropped to the viewport for mobile emulation tests"""
+        return not self.options.android and 'mobile' in self.job and self.job['mobile']
+
+    def find_mobile_viewport(self, image):
+        """Detect the viewport in the given (PIL) screen shot if we haven't already"""
+        if self.mobile_viewport is None:
+            width, height = image.size
+            if 'width' in self.job and 'height' in self.job and \
+                    width >= self.job['width'] and height > self.job['height']:
+                viewport_width = self.job['width']
+                viewport_height = self.job['height']
+            else:
+                pixels = image.load()
+                background = pixels[10, 10]
+                viewport_width = None
+                viewport_height = None
+                x_pos = 10
+                y_pos = 10
+                while viewport_width is None and x_pos < width:
+                    pixel_color = pixels[x_pos, y_pos]
+                    if not self.colors_are_similar(background, pixel_color):
+                        viewport_width = x_pos
+                    else:
+                        x_pos += 1
+                if viewport_width is None:
+                    viewport_width = width
+                x_pos = 10
+                while viewport_height is None and y_pos < height:
+                    pixel_color = pixels[x_pos, y_pos]
+                    if not self.colors_are_similar(background, pixel_color):
+                        viewport_height = y_pos
+                    else:
+                        y_pos += 1
+                if viewport_height is None:
+                    viewport_height = height
+            self.mobile_viewport = (viewport_width, viewport_height)
+            logging.debug('Mobile viewport found: %dx%d in %dx%d screen shot',
+                          viewport_width, viewport_height, width, height)
+            if width > 0 and height > 0:
+                if width != viewport_width or height != viewport_height:
+                    self.task['crop_pct'] = {
+                        "width": int(float(viewport_width * 100) / float(width)),
+                        "height": int(float(viewport_height * 100) / float(height)),
+                    }
+                    logging.debug("Crop percentages: %f%% x %f%%",
+                                  self.task['crop_pct']['width'],
+                                  self.task['crop_pct']['height'])
+
     def crop_screen_shot(self, path):
         """Crop screenshots to the viewport (for mobile emulation tests)"""
-        if not self.options.android and 'mobile' in self.job and self.job['mobile']:
+        if self.needs_crop():
             try:
-                # detect the viewport if we haven't already
                 if self.mobile_viewport is None:
                     from PIL import Image
-                    image = Image.open(path)
-                    width, height = image.size
-                    if 'width' in self.job and 'height' in self.job and \
-                            width >= self.job['width'] and height > self.job['height']:
-                        viewport_width = self.job['width']
-                        viewport_height = self.job['height']
-                    else:
-                        pixels = image.load()
-                        background = pixels[10, 10]
-                        viewport_width = None
-                        viewport_height = None
-                        x_pos = 10
-                        y_pos = 10
-                        while viewport_width is None and x_pos < width:
-                            pixel_color = pixels[x_pos, y_pos]
-                            if not self.colors_are_similar(background, pixel_color):
-                                viewport_width = x_pos
-                            else:
-                                x_pos += 1
-                        if viewport_width is None:
-                            viewport_width = width
-                        x_pos = 10
-                        while viewport_height is None and y_pos < height:
-                            pixel_color = pixels[x_pos, y_pos]
-                            if not self.colors_are_similar(background, pixel_color):
-                                viewport_height = y_pos
-                            else:
-                                y_pos += 1
-                        if viewport_height is None:
-                            viewport_height = height
-                    self.mobile_viewport = '{0:d}x{1:d}+0+0'.format(viewport_width, viewport_height)
-                    logging.debug('Mobile viewport found: %s in %dx%d screen shot',
-                                  self.mobile_viewport, width, height)
-                    if width > 0 and height > 0:
-                        if width != viewport_width or height != viewport_height:
-                            self.task['crop_pct'] = {
-                                "width": int(float(viewport_width * 100) / float(width)),
-                                "height": int(float(viewport_height * 100) / float(height)),
-                            }
-                            logging.debug("Crop percentages: %f%% x %f%%",
-                                          self.task['crop_pct']['width'],
-                                          self.task['crop_pct']['height'])
+                    self.find_mobile_viewport(Image.open(path))
                 if self.mobile_viewport is not None:
-                    command = 'mogrify -crop {0} "{1}"'.format(self.mobile_viewport, path)
+                    command = 'mogrify -crop {0:d}x{1:d}+0+0 "{2}"'.format(
+                        self.mobile_viewport[0], self.mobile_viewport[1], path)
                     logging.debug(command)
                     subprocess.call(command, shell=True)
             except Exception:
@@ -689,11 +881,6 @@ class DevTools(object):
                     self.process_target_event(event, msg)
                 else:
                     self.log_dev_tools_event(msg)
-        if 'id' in msg:
-            response_id = int(re.search(r'\d+', str(msg['id'])).group())
-            if response_id in self.pending_commands:
-                self.pending_commands.remove(response_id)
-                self.command_responses[response_id] = msg
 
     def process_page_event(self, event, msg):
         """Process Page.* dev tools events"""
@@ -735,18 +922,13 @@ class DevTools(object):
         if 'requestId' in msg['params']:
             request_id = msg['params']['requestId']
             if request_id not in self.requests:
-                self.requests[request_id] = {'id': request_id}
+                self.requests[request_id] = NetworkRequest(request_id)
             request = self.requests[request_id]
             if target_id is not None:
-                request['targetId'] = target_id
-            ignore_activity = request['is_video'] if 'is_video' in request else False
+                request.target_id = target_id
+            ignore_activity = request.is_video
             if event == 'requestWillBeSent':
-                if 'request' not in request:
-                    request['request'] = []
-                request['request'].append(msg['params'])
-                if 'url' in msg['params'] and msg['params']['url'].endswith('.mp4'):
-                    request['is_video'] = True
-                request['fromNet'] = True
+                request.request_sent(msg['params'])
                 if self.main_frame is not None and \
                         self.main_request is None and \
                         'frameId' in msg['params'] and \
@@ -756,34 +938,18 @@ class DevTools(object):
                     if 'timestamp' in msg['params']:
                         self.start_timestamp = float(msg['params']['timestamp'])
             elif event == 'resourceChangedPriority':
-                if 'priority' not in request:
-                    request['priority'] = []
-                request['priority'].append(msg['params'])
+                # Only counts as activity, the priority changes are in the devtools log
+                pass
             elif event == 'requestServedFromCache':
-                request['fromNet'] = False
+                request.from_net = False
             elif event == 'responseReceived':
-                if 'response' not in request:
-                    request['response'] = []
-                request['response'].append(msg['params'])
-                if 'response' in msg['params']:
-                    if 'fromDiskCache' in msg['params']['response'] and \
-                            msg['params']['response']['fromDiskCache']:
-                        request['fromNet'] = False
-                    if 'fromServiceWorker' in msg['params']['response'] and \
-                            msg['params']['response']['fromServiceWorker']:
-                        request['fromNet'] = False
-                    if 'mimeType' in msg['params']['response'] and \
-                            msg['params']['response']['mimeType'].startswith('video/'):
-                        request['is_video'] = True
+                request.response_received(msg['params'])
             elif event == 'dataReceived':
-                if 'data' not in request:
-                    request['data'] = []
-                request['data'].append(msg['params'])
+                request.data_received(msg['params'])
             elif event == 'loadingFinished':
-                request['finished'] = msg['params']
+                request.loading_finished(msg['params'])
                 self.get_response_body(request_id)
             elif event == 'loadingFailed':
-                request['failed'] = msg['params']
                 if self.main_request is not None and \
                         request_id == self.main_request and \
                         'errorText' in msg['params'] and \
@@ -825,13 +991,9 @@ class DevTools(object):
     def log_dev_tools_event(self, msg):
         """Log the dev tools events to a file"""
         if self.task['log_data']:
-            if self.dev_tools_file is None:
-                path = self.path_base + '_devtools.json.gz'
-                self.dev_tools_file = gzip.open(path, 'wb', 7)
-                self.dev_tools_file.write("[{}")
-            if self.dev_tools_file is not None:
-                self.dev_tools_file.write(",\n")
-                self.dev_tools_file.write(json.dumps(msg))
+            if self.dev_tools_log is None:
+                self.dev_tools_log = DevToolsLog(self.path_base)
+            self.dev_tools_log.write(msg)
 
     def get_header_value(self, headers, name):
         """Get the value for the requested header"""
@@ -873,14 +1035,230 @@ class DevTools(object):
             pass
         return byte_count
 
-class DevToolsClient(WebSocketClient):
+class DevToolsLog(object):
+    """Buffered log of the raw devtools events.
+    Events are written to <prefix>_devtools.log as length-prefixed JSON lines (4-byte
+    big-endian length, the JSON, a newline) and <prefix>_devtools_index.json records the
+    byte offset and timestamp of each event, grouped by request ID, so the parser can
+    read them back in timestamp order without loading the whole log.
+    The legacy <prefix>_devtools.json.gz array is generated from the log on close."""
+    def __init__(self, path_base):
+        self.path_base = path_base
+        self.log_file = open(path_base + '_devtools.log', 'wb')
+        self.buffer = []
+        self.buffered = 0
+        self.size = 0
+        self.count = 0
+        self.requests = {}
+        self.events = []
+
+    def write(self, msg):
+        """Append an event to the log"""
+        data = json.dumps(msg)
+        timestamp = 0
+        request_id = None
+        if 'params' in msg:
+            if 'timestamp' in msg['params']:
+                timestamp = msg['params']['timestamp']
+            if 'requestId' in msg['params']:
+                request_id = msg['params']['requestId']
+        if request_id is None:
+            self.events.append([self.size, timestamp])
+        elif request_id in self.requests:
+            self.requests[request_id].append([self.size, timestamp])
+        else:
+            self.requests[request_id] = [[self.size, timestamp]]
+        record = struct.pack('>I', len(data)) + data + '\n'
+        self.buffer.append(record)
+        self.buffered += len(record)
+        self.size += len(record)
+        self.count += 1
+        if self.buffered >= LOG_BLOCK_SIZE:
+            self.flush()
+
+    def flush(self):
+        """Write out the buffered events"""
+        if self.buffer:
+            self.log_file.write(''.join(self.buffer))
+            self.buffer = []
+            self.buffered = 0
+
+    def close(self):
+        """Finish the log, write the index and the legacy json array"""
+        if self.log_file is not None:
+            self.flush()
+            self.log_file.close()
+            self.log_file = None
+            try:
+                with open(self.path_base + '_devtools_index.json', 'wb') as f_out:
+                    json.dump({'log': os.path.basename(self.path_base + '_devtools.log'),
+                               'size': self.size,
+                               'count': self.count,
+                               'requests': self.requests,
+                               'events': self.events}, f_out)
+                self.write_legacy()
+            except Exception as err:
+                logging.critical('Error writing the devtools log: %s', err.__str__())
+
+    def write_legacy(self):
+        """Convert the log into the json array that the server expects"""
+        with open(self.path_base + '_devtools.log', 'rb') as f_in:
+            with open_gzip(self.path_base + '_devtools.json.gz', 'devtools') as f_out:
+                f_out.write('[{}')
+                while True:
+                    header = f_in.read(4)
+                    if len(header) < 4:
+                        break
+                    length = struct.unpack('>I', header)[0]
+                    f_out.write(',\n')
+                    f_out.write(f_in.read(length))
+                    f_in.read(1)
+                f_out.write('\n]')
+
+class MessageBuffer(object):
+    """Queue of raw DevTools messages between the socket thread and the main thread.
+    While recording nothing is dropped (the socket is paused at the high-water mark
+    instead), otherwise it is a ring buffer that keeps the newest messages and counts
+    the ones it drops."""
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.messages = collections.deque()
+        self.condition = threading.Condition()
+        self.keep_all = False
+        self.stats = None
+        self.reset_stats()
+
+    def __len__(self):
+        return len(self.messages)
+
+    def reset_stats(self):
+        """Start a new stats period"""
+        with self.condition:
+            self.stats = {'messages': 0, 'high_water': len(self.messages), 'dropped': 0,
+                          'pauses': 0}
+
+    def get_stats(self):
+        """Stats for the current period"""
+        with self.condition:
+            return dict(self.stats)
+
+    def put(self, message):
+        """Add a message, returns the new queue depth"""
+        with self.condition:
+            if not self.keep_all and len(self.messages) >= self.capacity:
+                self.messages.popleft()
+                self.stats['dropped'] += 1
+            self.messages.append(message)
+            depth = len(self.messages)
+            self.stats['messages'] += 1
+            if depth > self.stats['high_water']:
+                self.stats['high_water'] = depth
+            self.condition.notify()
+        return depth
+
+    def get_batch(self, timeout=None, max_count=None):
+        """Remove and return up to max_count messages (all of them by default),
+        waiting up to timeout seconds for the first one"""
+        batch = []
+        with self.condition:
+            if not self.messages and timeout is not None and timeout > 0:
+                end_time = monotonic.monotonic() + timeout
+                while not self.messages:
+                    remaining = end_time - monotonic.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+            count = len(self.messages)
+            if max_count is not None:
+                count = min(count, max_count)
+            for _ in xrange(count):
+                batch.append(self.messages.popleft())
+        return batch
+
+    def count_pause(self):
+        """The socket was paused because the queue backed up"""
+        with self.condition:
+            self.stats['pauses'] += 1
+
+    def discard(self):
+        """Drop everything that is queued (counted as dropped)"""
+        with self.condition:
+            self.stats['dropped'] += len(self.messages)
+            self.messages.clear()
+
+class DevToolsFuture(object):
+    """Response to a pending dev tools command"""
+    def __init__(self, command_id):
+        self.command_id = command_id
+        self.response = None
+        self.done = threading.Event()
+
+    def set_response(self, response):
+        """Resolve the command (called on the websocket thread)"""
+        self.response = response
+        self.done.set()
+
+    def wait(self, timeout):
+        """Wait for the response (None on timeout)"""
+        if not self.done.is_set() and timeout > 0:
+            self.done.wait(timeout)
+        return self.response
+
+class DevToolsManager(WebSocketManager):
+    """Single poller thread (epoll where available) that reads all of the DevTools
+    sessions and hands the messages to each session's received_message"""
+    def __init__(self):
+        WebSocketManager.__init__(self)
+        self.name = 'DevToolsManager'
+        self.daemon = True
+        self.paused = {}
+
+    def pause(self, websocket):
+        """Stop reading from the session's socket"""
+        with self.lock:
+            fd = websocket.sock.fileno()
+            if fd not in self.paused and self.websockets.get(fd) is websocket:
+                self.poller.unregister(fd)
+                self.paused[fd] = websocket
+
+    def resume(self, websocket):
+        """Start reading from a paused session's socket again"""
+        with self.lock:
+            fd = websocket.sock.fileno()
+            if self.paused.get(fd) is websocket:
+                del self.paused[fd]
+                if self.websockets.get(fd) is websocket:
+                    self.poller.register(fd)
+
+    def get_stats(self):
+        """Message queue stats for each of the sessions"""
+        with self.lock:
+            sessions = list(self.websockets.values())
+        return [session.get_queue_stats() for session in sessions]
+
+DEVTOOLS_MANAGER = None
+DEVTOOLS_MANAGER_LOCK = threading.Lock()
+
+def get_devtools_manager():
+    """Shared poller for all of the DevTools sessions (started on first use)"""
+    global DEVTOOLS_MANAGER
+    with DEVTOOLS_MANAGER_LOCK:
+        if DEVTOOLS_MANAGER is None:
+            DEVTOOLS_MANAGER = DevToolsManager()
+            DEVTOOLS_MANAGER.start()
+    return DEVTOOLS_MANAGER
+
+class DevToolsClient(WebSocketBaseClient):
     """DevTools Websocket client"""
     def __init__(self, url, protocols=None, extensions=None, heartbeat_freq=None,
-                 ssl_options=None, headers=None):
-        WebSocketClient.__init__(self, url, protocols, extensions, heartbeat_freq,
-                                 ssl_options, headers)
+                 ssl_options=None, headers=None, trusted_peer=False):
+        WebSocketBaseClient.__init__(self, url, protocols, extensions, heartbeat_freq,
+                                     ssl_options, headers=headers)
+        # A trusted peer (the local browser) always sends valid UTF-8 so the
+        # multi-MB text frames don't need to be validated
+        self.stream.validate_utf8 = not trusted_peer
         self.connected = False
-        self.messages = Queue.Queue()
+        self.messages = MessageBuffer(MESSAGE_QUEUE_HIGH)
         self.trace_file = None
         self.video_prefix = None
         self.trace_ts_start = None
@@ -889,10 +1267,31 @@ class DevToolsClient(WebSocketClient):
         self.task = None
         self.last_image = None
         self.pending_image = None
+        self.image_queue = None
+        self.image_thread = None
         self.video_viewport = None
         self.path_base = None
-        self.trace_parser = None
         self.trace_event_counts = {}
+        self.trace_queue = None
+        self.trace_thread = None
+        self.trace_parser = None
+        self.trace_timing = {}
+        self.pending_commands = {}
+        self.manager = None
+        self.queue_lock = threading.Lock()
+        self.paused = False
+        self.pause_start = None
+        self.queue_stats = {'max_depth': 0, 'pauses': 0, 'paused_time': 0.0}
+
+    def handshake_ok(self):
+        """Websocket interface - hand the connection to the shared poller (calls opened)"""
+        self.manager = get_devtools_manager()
+        self.manager.add(self)
+
+    def close(self, code=1000, reason=''):
+        """Start the closing handshake (the reply needs to be read even if paused)"""
+        self.resume_reading()
+        WebSocketBaseClient.close(self, code, reason)
 
     def opened(self):
         """Websocket interface - connection opened"""
@@ -903,41 +1302,119 @@ class DevToolsClient(WebSocketClient):
         """Websocket interface - connection closed"""
         logging.debug("DevTools websocket disconnected")
         self.connected = False
+        logging.debug("DevTools message queue: max depth %d, paused %d times (%0.3fs)",
+                      self.queue_stats['max_depth'], self.queue_stats['pauses'],
+                      self.queue_stats['paused_time'])
+        for command_id in self.pending_commands.keys():
+            self.resolve_command(command_id, None)
 
     def received_message(self, raw):
         """Websocket interface - message received"""
         try:
             if raw.is_text:
-                message = raw.data.decode(raw.encoding) if raw.encoding is not None else raw.data
-                compare = message[:50]
-                is_trace_data = False
-                if self.path_base is not None and compare.find('"Tracing.dataCollected') > -1:
-                    is_trace_data = True
-                    msg = json.loads(message)
-                    self.messages.put('{"method":"got_message"}')
-                    if msg is not None:
-                        self.process_trace_event(msg)
-                elif self.trace_file is not None and compare.find('"Tracing.tracingComplete') > -1:
-                    self.trace_file.write("\n]}")
-                    self.trace_file.close()
-                    self.trace_file = None
-                if not is_trace_data:
-                    self.messages.put(message)
+                # Only the start of the message is peeked at to route it, the payload
+                # itself stays as the raw utf-8 bytes (ujson parses those directly)
+                compare = raw.data[:50]
+                if self.trace_queue is not None and \
+                        compare.find('"Tracing.dataCollected') > -1:
+                    # Hand the raw chunk off to the trace pipeline, nothing else
+                    # happens on the socket thread.
+                    start = monotonic.monotonic()
+                    self.trace_queue.put(raw.data)
+                    self.queue_message('{"method":"got_message"}')
+                    self.trace_timing['socket'] += monotonic.monotonic() - start
+                    self.trace_timing['chunks'] += 1
+                    self.trace_timing['bytes'] += len(raw.data)
+                else:
+                    message = raw.data
+                    if not self.dispatch_response(message):
+                        self.queue_message(message)
         except Exception:
             pass
 
+    def queue_message(self, message):
+        """Queue an event for the main thread, pausing the socket if the queue backs up.
+        Reading is never paused while a command is waiting on its response."""
+        depth = self.messages.put(message)
+        if depth > self.queue_stats['max_depth']:
+            self.queue_stats['max_depth'] = depth
+        if self.messages.keep_all and depth >= MESSAGE_QUEUE_HIGH and not self.paused and \
+                not self.pending_commands:
+            with self.queue_lock:
+                if not self.paused and self.manager is not None:
+                    self.paused = True
+                    self.pause_start = monotonic.monotonic()
+                    self.queue_stats['pauses'] += 1
+                    self.messages.count_pause()
+                    self.manager.pause(self)
+
+    def resume_reading(self):
+        """Resume reading from the socket if it was paused"""
+        if self.paused:
+            with self.queue_lock:
+                if self.paused:
+                    self.paused = False
+                    self.queue_stats['paused_time'] += monotonic.monotonic() - self.pause_start
+                    self.manager.resume(self)
+
+    def get_queue_stats(self):
+        """Current and peak message queue depth"""
+        stats = dict(self.queue_stats)
+        stats['depth'] = len(self.messages)
+        stats['paused'] = self.paused
+        return stats
+
+    def register_command(self, command_id):
+        """Create the future for a command before it is sent"""
+        future = DevToolsFuture(command_id)
+        self.pending_commands[command_id] = future
+        # The response can't arrive while the socket is paused
+        self.resume_reading()
+        return future
+
+    def resolve_command(self, command_id, response):
+        """Hand the response to whoever is waiting for the command"""
+        future = self.pending_commands.pop(command_id, None)
+        if future is not None:
+            future.set_response(response)
+
+    def dispatch_response(self, message):
+        """Resolve command responses directly on the websocket thread.
+        Returns True if the message was a response (events are left for the main thread)."""
+        dispatched = False
+        if not message.startswith('{"method"'):
+            msg = json.loads(message)
+            if 'id' in msg:
+                self.resolve_command(msg['id'], msg)
+                dispatched = True
+        elif message[:60].find('"Target.receivedMessageFromTarget"') > -1:
+            # Responses to commands sent to service workers
+            msg = json.loads(message)
+            if 'params' in msg and 'message' in msg['params'] and \
+                    msg['params']['message'].startswith('{"id"'):
+                target_message = json.loads(msg['params']['message'])
+                if 'id' in target_message:
+                    self.resolve_command(target_message['id'], target_message)
+                    dispatched = True
+        return dispatched
+
     def get_message(self, timeout):
         """Wait for and return a message from the queue"""
-        message = None
-        try:
-            if timeout is None or timeout <= 0:
-                message = self.messages.get_nowait()
-            else:
-                message = self.messages.get(True, timeout)
-            self.messages.task_done()
-        except Exception:
-            pass
-        return message
+        messages = self.get_messages(timeout, 1)
+        return messages[0] if messages else None
+
+    def get_messages(self, timeout, max_count=None):
+        """Wait for and return a batch of messages from the queue"""
+        messages = self.messages.get_batch(timeout, max_count)
+        if self.paused and len(self.messages) <= MESSAGE_QUEUE_LOW:
+            self.resume_reading()
+        return messages
+
+    def set_recording(self, recording):
+        """Keep every message while recording, otherwise only the newest ones"""
+        self.messages.keep_all = recording
+        if not recording:
+            self.resume_reading()
 
     def start_processing_trace(self, path_base, video_prefix, options, job, task, start_timestamp):
         """Write any trace events to the given file"""
@@ -951,14 +1428,46 @@ class DevToolsClient(WebSocketClient):
         self.options = options
         self.job = job
         self.video_viewport = None
+        self.trace_timing = {'socket': 0.0, 'decode': 0.0, 'write': 0.0, 'parse': 0.0,
+                             'chunks': 0, 'bytes': 0, 'errors': 0, 'parse_errors': 0}
+        # The server opts in to the columnar (and optionally bucketed) netlog chunks
+        netlog_format = {'columns': bool('netlogChunks' in job and
+                                         job['netlogChunks'] == 'columns'),
+                         'bucket': None}
+        if 'netlogChunkBucket' in job and job['netlogChunkBucket']:
+            netlog_format['bucket'] = float(job['netlogChunkBucket']) * 1000.0
+        # The trace events are parsed in a separate process so the CPU-heavy
+        # Trace processing doesn't compete with the writer for the GIL.
+        self.trace_parser = get_trace_parser()
+        if self.trace_parser is not None:
+            self.trace_parser.start_run(path_base, netlog_format)
+        self.trace_queue = Queue.Queue()
+        self.trace_thread = threading.Thread(target=self.trace_writer_thread)
+        self.trace_thread.daemon = True
+        self.trace_thread.start()
+        if video_prefix is not None:
+            self.image_queue = Queue.Queue()
+            self.image_thread = threading.Thread(target=self.image_writer_thread)
+            self.image_thread.daemon = True
+            self.image_thread.start()
 
     def stop_processing_trace(self):
         """All done"""
+        trace_queue = self.trace_queue
+        self.trace_queue = None
+        if trace_queue is not None and self.trace_thread is not None:
+            trace_queue.put(None)
+            self.trace_thread.join()
+        self.trace_thread = None
         if self.pending_image is not None and self.last_image is not None and\
-                self.pending_image["image"] != self.last_image["image"]:
-            with open(self.pending_image["path"], 'wb') as image_file:
-                image_file.write(base64.b64decode(self.pending_image["image"]))
+                self.pending_image["hash"] != self.last_image["hash"]:
+            self.write_image(self.pending_image)
         self.pending_image = None
+        if self.image_queue is not None and self.image_thread is not None:
+            self.image_queue.put(None)
+            self.image_thread.join()
+        self.image_queue = None
+        self.image_thread = None
         self.trace_ts_start = None
         if self.trace_file is not None:
             self.trace_file.write("\n]}")
@@ -969,70 +1478,146 @@ class DevToolsClient(WebSocketClient):
         self.task = None
         self.video_viewport = None
         self.last_image = None
-        if self.trace_parser is not None and self.path_base is not None:
+        if self.trace_parser is not None:
             start = monotonic.monotonic()
-            logging.debug("Post-Processing the trace netlog events")
-            self.trace_parser.post_process_netlog_events()
-            logging.debug("Processing the trace timeline events")
-            self.trace_parser.ProcessTimelineEvents()
-            self.trace_parser.WriteUserTiming(self.path_base + '_user_timing.json.gz')
-            self.trace_parser.WriteCPUSlices(self.path_base + '_timeline_cpu.json.gz')
-            self.trace_parser.WriteScriptTimings(self.path_base + '_script_timing.json.gz')
-            self.trace_parser.WriteFeatureUsage(self.path_base + '_feature_usage.json.gz')
-            self.trace_parser.WriteInteractive(self.path_base + '_interactive.json.gz')
-            self.trace_parser.WriteNetlog(self.path_base + '_netlog_requests.json.gz')
-            self.trace_parser.WriteV8Stats(self.path_base + '_v8stats.json.gz')
+            stats = self.trace_parser.finish_run()
+            if stats is not None:
+                self.trace_timing.update(stats)
             elapsed = monotonic.monotonic() - start
             logging.debug("Done processing the trace events: %0.3fs", elapsed)
         self.trace_parser = None
         self.path_base = None
         logging.debug(self.trace_event_counts)
         self.trace_event_counts = {}
+        if self.trace_timing:
+            logging.debug("Trace pipeline: %d chunks, %d bytes - socket %0.3fs, "
+                          "decode %0.3fs, write %0.3fs, parse %0.3fs, post-process %0.3fs",
+                          self.trace_timing['chunks'], self.trace_timing['bytes'],
+                          self.trace_timing['socket'], self.trace_timing['decode'],
+                          self.trace_timing['write'], self.trace_timing['parse'],
+                          self.trace_timing.get('post_process', 0.0))
+            if self.trace_timing['errors'] or self.trace_timing['parse_errors']:
+                logging.warning("Trace pipeline errors: %d writing, %d parsing",
+                                self.trace_timing['errors'],
+                                self.trace_timing['parse_errors'])
+
+    def trace_writer_thread(self):
+        """Background thread that writes the trace chunks and feeds the parser"""
+        trace_queue = self.trace_queue
+        while True:
+            chunk = trace_queue.get()
+            if chunk is None:
+                break
+            try:
+                if self.trace_parser is not None:
+                    self.trace_parser.add_chunk(chunk)
+                start = monotonic.monotonic()
+                trace_events = split_trace_chunk(chunk)
+                if trace_events is None:
+                    # Unrecognized layout, decode the whole chunk
+                    msg = json.loads(chunk)
+                self.trace_timing['decode'] += monotonic.monotonic() - start
+                start = monotonic.monotonic()
+                if trace_events is not None:
+                    self.process_raw_trace_events(trace_events)
+                elif msg is not None:
+                    self.process_trace_event(msg)
+                self.trace_timing['write'] += monotonic.monotonic() - start
+            except Exception as err:
+                self.trace_timing['errors'] += 1
+                logging.error("Error writing a trace chunk: %s", err.__str__())
+
+    def write_image(self, image):
+        """Hand a video frame off to the image writer thread"""
+        if self.image_queue is not None:
+            self.image_queue.put((image["path"], image["image"]))
+
+    def image_writer_thread(self):
+        """Background thread that decodes and writes the video frames"""
+        image_queue = self.image_queue
+        while True:
+            image = image_queue.get()
+            if image is None:
+                break
+            try:
+                path, data = image
+                with open(path, 'wb') as image_file:
+                    image_file.write(base64.b64decode(data))
+            except Exception:
+                pass
+
+    def open_trace_file(self):
+        """Create the trace file if it isn't already open"""
+        if self.trace_file is None:
+            self.trace_file = open_gzip(self.path_base + '_trace.json.gz', 'trace')
+            self.trace_file.write('{"traceEvents":[{}')
+
+    def process_raw_trace_events(self, trace_events):
+        """Copy the raw trace events through to the trace file, only decoding
+        the events that need to be inspected (screenshots and the trace start)"""
+        if len(trace_events):
+            self.open_trace_file()
+            out = []
+            for event in trace_events:
+                if self.video_prefix is not None:
+                    category = get_trace_event_category(event)
+                    if category is None or category.find('devtools.screenshot') > -1 or \
+                            (self.trace_ts_start is None and
+                             (category.find('blink.user_timing') > -1 or
+                              category.find('rail') > -1)):
+                        if self.inspect_trace_event(json.loads(event)):
+                            continue
+                    else:
+                        if category not in self.trace_event_counts:
+                            self.trace_event_counts[category] = 0
+                        self.trace_event_counts[category] += 1
+                out.append(event)
+            if out:
+                self.trace_file.write(",\n")
+                self.trace_file.write(",\n".join(out))
+            logging.debug("Processed %d trace events", len(trace_events))
 
     def process_trace_event(self, msg):
         """Process Tracing.* dev tools events"""
         if 'params' in msg and 'value' in msg['params'] and len(msg['params']['value']):
-            if self.trace_file is None:
-                self.trace_file = gzip.open(self.path_base + '_trace.json.gz',
-                                            'wb', compresslevel=7)
-                self.trace_file.write('{"traceEvents":[{}')
-                from internal.support.trace_parser import Trace
-                self.trace_parser = Trace()
+            self.open_trace_file()
             # write out the trace events one-per-line but pull out any
             # devtools screenshots as separate files.
             if self.trace_file is not None:
                 trace_events = msg['params']['value']
                 for _, trace_event in enumerate(trace_events):
-                    is_screenshot = False
-                    if self.video_prefix is not None and 'cat' in trace_event and \
-                            'name' in trace_event and 'ts' in trace_event:
-                        if trace_event['cat'] not in self.trace_event_counts:
-                            self.trace_event_counts[trace_event['cat']] = 0
-                        self.trace_event_counts[trace_event['cat']] += 1
-                        if self.trace_ts_start is None and \
-                                (trace_event['name'] == 'navigationStart' or \
-                                 trace_event['name'] == 'fetchStart') and \
-                                trace_event['cat'].find('blink.user_timing') > -1:
-                            logging.debug("Trace start detected: %d", trace_event['ts'])
-                            self.trace_ts_start = trace_event['ts']
-                        if self.trace_ts_start is None and \
-                                (trace_event['name'] == 'navigationStart' or \
-                                 trace_event['name'] == 'fetchStart') and \
-                                trace_event['cat'].find('rail') > -1:
-                            logging.debug("Trace start detected: %d", trace_event['ts'])
-                            self.trace_ts_start = trace_event['ts']
-                        if trace_event['name'] == 'Screenshot' and \
-                                trace_event['cat'].find('devtools.screenshot') > -1:
-                            is_screenshot = True
-                            self.process_screenshot(trace_event)
-                    if not is_screenshot:
-                        # Write it to the trace file and pass it to the trace parser
+                    if not self.inspect_trace_event(trace_event):
+                        # Write it to the trace file
                         self.trace_file.write(",\n")
                         self.trace_file.write(json.dumps(trace_event))
-                        if self.trace_parser is not None:
-                            self.trace_parser.ProcessTraceEvent(trace_event)
                 logging.debug("Processed %d trace events", len(msg['params']['value']))
 
+    def inspect_trace_event(self, trace_event):
+        """Look for the trace start and screenshots, returns True for screenshots"""
+        is_screenshot = False
+        if self.video_prefix is not None and 'cat' in trace_event and \
+                'name' in trace_event and 'ts' in trace_event:
+            if trace_event['cat'] not in self.trace_event_counts:
+                self.trace_event_counts[trace_event['cat']] = 0
+            self.trace_event_counts[trace_event['cat']] += 1
+            if self.trace_ts_start is None and \
+                    (trace_event['name'] == 'navigationStart' or \
+                     trace_event['name'] == 'fetchStart') and \
+                    trace_event['cat'].find('blink.user_timing') > -1:
+                logging.debug("Trace start detected: %d", trace_event['ts'])
+                self.trace_ts_start = trace_event['ts']
+            if self.trace_ts_start is None and \
+                    (trace_event['name'] == 'navigationStart' or \
+                     trace_event['name'] == 'fetchStart') and \
+                    trace_event['cat'].find('rail') > -1:
+                logging.debug("Trace start detected: %d", trace_event['ts'])
+                self.trace_ts_start = trace_event['ts']
+            if trace_event['name'] == 'Screenshot' and \
+                    trace_event['cat'].find('devtools.screenshot') > -1:
+                is_screenshot = True
+                self.process_screenshot(trace_event)
+        return is_screenshot
+
     def process_screenshot(self, trace_event):
         """Process an individual screenshot event"""
         if self.trace_ts_start is not None and 'args' in trace_event and \
@@ -1040,6 +1625,10 @@ class DevToolsClient(WebSocketClient):
             ms_elapsed = int(round(float(trace_event['ts'] - self.trace_ts_start) / 1000.0))
             if ms_elapsed >= 0:
                 img = trace_event['args']['snapshot']
+                # Frames are compared by fingerprint. The payload stays base64-encoded
+                # (it is decoded by the image writer thread) and is only held for the
+                # pending frame, and only if it differs from the last frame written.
+                img_hash = hashlib.sha1(img).digest()
                 path = '{0}{1:06d}.jpg'.format(self.video_prefix, ms_elapsed)
                 logging.debug("Video frame (%f): %s", trace_event['ts'], path)
                 # Sample frames at at 100ms intervals for the first 20 seconds,
@@ -1057,16 +1646,20 @@ class DevToolsClient(WebSocketClient):
                         if self.pending_image is not None:
                             logging.debug("Discarding pending image: %s",
                                           self.pending_image["path"])
-                        self.pending_image = {"image": str(img),
+                        if img_hash == self.last_image["hash"]:
+                            # It can never be written, don't hold on to the data
+                            img = None
+                        self.pending_image = {"image": img,
+                                              "hash": img_hash,
                                               "time": int(ms_elapsed),
                                               "path": str(path)}
                 if keep_image:
                     is_duplicate = False
                     if self.pending_image is not None:
-                        if self.pending_image["image"] == img:
+                        if self.pending_image["hash"] == img_hash:
                             is_duplicate = True
                     elif self.last_image is not None and \
-                            self.last_image["image"] == img:
+                            self.last_image["hash"] == img_hash:
                         is_duplicate = True
                     if is_duplicate:
                         logging.debug('Dropping duplicate image: %s', path)
@@ -1074,15 +1667,244 @@ class DevToolsClient(WebSocketClient):
                         # write both the pending image and the current one if
                         # the interval is double the normal sampling rate
                         if self.last_image is not None and self.pending_image is not None and \
-                                self.pending_image["image"] != self.last_image["image"]:
+                                self.pending_image["hash"] != self.last_image["hash"]:
                             elapsed_interval = ms_elapsed - self.last_image["time"]
                             if elapsed_interval > 2 * min_interval:
-                                pending = self.pending_image["path"]
-                                with open(pending, 'wb') as image_file:
-                                    image_file.write(base64.b64decode(self.pending_image["image"]))
+                                self.write_image(self.pending_image)
                         self.pending_image = None
-                        with open(path, 'wb') as image_file:
-                            self.last_image = {"image": str(img),
-                                               "time": int(ms_elapsed),
-                                               "path": str(path)}
-                            image_file.write(base64.b64decode(img))
+                        self.last_image = {"hash": img_hash,
+                                           "time": int(ms_elapsed),
+                                           "path": str(path)}
+                        self.write_image({"image": img, "path": str(path)})
+
+
+# Categories that Trace.ProcessTraceEvent looks at, everything else can be
+# skipped without decoding it.
+TRACE_PARSER_CATEGORIES = ['blink.user_timing', 'rail', 'loading', 'devtools.timeline',
+                           'blink.feature_usage', 'v8', 'netlog']
+
+# Used to check the layout of the trace chunks without decoding them: the JSON
+# strings (which can hold braces but never a newline) are dropped, then the
+# objects on each line are collapsed to a '@' innermost first and every line
+# has to end up as a single '@' with an optional trailing comma.
+JSON_STRING_RE = re.compile(r'"[^"\\\n]*(?:\\.[^"\\\n]*)*"')
+JSON_INNER_OBJECT_RE = re.compile(r'\{[^{}\n]*\}')
+JSON_BLANKS_RE = re.compile(r'[ \t\r]+')
+ONE_OBJECT_PER_LINE_RE = re.compile(r'(?:@,?)?(?:\n(?:@,?)?)*\Z')
+
+def is_one_object_per_line(text):
+    """Check that every (non-blank) line of the text is exactly one JSON object
+    with balanced braces, optionally followed by a comma"""
+    text = JSON_STRING_RE.sub('', text)
+    if text.find('@') >= 0:
+        return False
+    count = 1
+    while count:
+        text, count = JSON_INNER_OBJECT_RE.subn('@', text)
+    return ONE_OBJECT_PER_LINE_RE.match(JSON_BLANKS_RE.sub('', text)) is not None
+
+def split_trace_chunk(chunk):
+    """Split the raw JSON of a Tracing.dataCollected message into the raw
+    JSON text of the individual events.  Chrome serializes one event per line
+    so the events can be split without parsing them.  Returns None if any
+    line isn't a single complete event (the chunk then needs to be decoded
+    as a whole)."""
+    start = chunk.find('"value":', 0, 200)
+    if start < 0:
+        return None
+    start = chunk.find('[', start)
+    end = chunk.rfind(']')
+    if start < 0 or end < start:
+        return None
+    events = chunk[start + 1:end]
+    if not is_one_object_per_line(events):
+        return None
+    trace_events = []
+    for event in events.split('\n'):
+        event = event.strip()
+        if event[-1:] == ',':
+            event = event[:-1].rstrip()
+        if len(event):
+            trace_events.append(event)
+    return trace_events
+
+def get_trace_event_category(event):
+    """Pull the category out of the raw JSON for a trace event (or None)"""
+    category = None
+    start = event.find('"cat":"')
+    if start >= 0:
+        start += 7
+        end = event.find('"', start)
+        if end >= start:
+            category = event[start:end]
+    return category
+
+def is_parser_trace_event(event):
+    """See if the raw trace event is in one of the categories Trace processes"""
+    category = get_trace_event_category(event)
+    if category is None:
+        return True
+    for check in TRACE_PARSER_CATEGORIES:
+        if category.find(check) >= 0:
+            return True
+    return False
+
+class TraceParserService(object):
+    """Long-lived trace parser process that is reused for every run.  It is forked before
+    the agent starts any threads (start_trace_parser) so the child can't inherit a lock
+    that another thread was holding at the time of the fork."""
+    def __init__(self):
+        self.commands = multiprocessing.Queue()
+        self.results = multiprocessing.Queue()
+        self.process = multiprocessing.Process(target=trace_parser_process,
+                                               args=(self.commands, self.results,
+                                                     os.getpid()))
+        self.process.daemon = True
+        self.process.start()
+        self.run_id = 0
+
+    def is_alive(self):
+        """Check that the parser process is still running"""
+        return self.process is not None and self.process.is_alive()
+
+    def start_run(self, path_base, netlog_format):
+        """Start parsing the trace of a new run"""
+        self.run_id += 1
+        self.commands.put(('start', self.run_id, path_base, netlog_format))
+
+    def add_chunk(self, chunk):
+        """Hand a raw trace chunk to the parser"""
+        self.commands.put(chunk)
+
+    def finish_run(self, timeout=600):
+        """Write the results for the current run and return the parser stats (None if the
+        parser died or timed out)"""
+        self.commands.put(('end', self.run_id))
+        end_time = monotonic.monotonic() + timeout
+        while monotonic.monotonic() < end_time:
+            try:
+                run_id, stats = self.results.get(True, 1)
+                if run_id == self.run_id:
+                    return stats
+            except Queue.Empty:
+                if not self.is_alive():
+                    logging.critical("The trace parser process exited unexpectedly")
+                    return None
+        logging.critical("Timed out waiting for the trace parser process")
+        self.stop()
+        return None
+
+    def stop(self):
+        """Shut down the parser process"""
+        if self.process is not None:
+            try:
+                self.commands.put(None)
+                self.process.join(10)
+                if self.process.is_alive():
+                    self.process.terminate()
+            except Exception:
+                pass
+            self.process = None
+
+TRACE_PARSER = None
+TRACE_PARSER_LOCK = threading.Lock()
+
+def start_trace_parser():
+    """Start the trace parser process (call before any threads are started)"""
+    return get_trace_parser()
+
+def get_trace_parser():
+    """Shared trace parser process (restarted if it died)"""
+    global TRACE_PARSER
+    with TRACE_PARSER_LOCK:
+        if TRACE_PARSER is None or not TRACE_PARSER.is_alive():
+            if TRACE_PARSER is not None:
+                TRACE_PARSER.stop()
+            try:
+                TRACE_PARSER = TraceParserService()
+            except Exception as err:
+                logging.critical("Error starting the trace parser process: %s", err.__str__())
+                TRACE_PARSER = None
+    return TRACE_PARSER
+
+def stop_trace_parser():
+    """Shut down the trace parser process"""
+    global TRACE_PARSER
+    with TRACE_PARSER_LOCK:
+        if TRACE_PARSER is not None:
+            TRACE_PARSER.stop()
+            TRACE_PARSER = None
+
+def trace_parser_process(commands, results, parent_pid):
+    """Trace parser process - feed the raw trace chunks for each run to Trace and write the
+    results when the run ends"""
+    from internal.support.trace_parser import Trace
+    run = None
+    while True:
+        try:
+            command = commands.get(True, 5)
+        except Queue.Empty:
+            # Exit if the agent went away without shutting us down
+            if os.getppid() != parent_pid:
+                break
+            continue
+        if command is None:
+            break
+        if isinstance(command, tuple):
+            if command[0] == 'start':
+                run = {'id': command[1], 'path_base': command[2], 'netlog_format': command[3],
+                       'parser': None,
+                       'stats': {'parse': 0.0, 'post_process': 0.0, 'parse_errors': 0}}
+            elif command[0] == 'end':
+                if run is not None and run['id'] == command[1]:
+                    write_trace_results(run)
+                    results.put((run['id'], run['stats']))
+                else:
+                    results.put((command[1], {'parse': 0.0, 'post_process': 0.0,
+                                              'parse_errors': 0}))
+                run = None
+        elif run is not None:
+            start = monotonic.monotonic()
+            try:
+                raw_events = split_trace_chunk(command)
+                if raw_events is not None:
+                    event_count = len(raw_events)
+                    trace_events = [json.loads(event) for event in raw_events
+                                    if is_parser_trace_event(event)]
+                else:
+                    msg = json.loads(command)
+                    trace_events = msg['params']['value'] \
+                        if 'params' in msg and 'value' in msg['params'] else []
+                    event_count = len(trace_events)
+                if event_count:
+                    if run['parser'] is None:
+                        run['parser'] = Trace()
+                        run['parser'].netlog_columns = run['netlog_format']['columns']
+                        run['parser'].netlog_bucket = run['netlog_format']['bucket']
+                    for trace_event in trace_events:
+                        run['parser'].ProcessTraceEvent(trace_event)
+            except Exception as err:
+                run['stats']['parse_errors'] += 1
+                logging.error("Error parsing a trace chunk: %s", err.__str__())
+            run['stats']['parse'] += monotonic.monotonic() - start
+
+def write_trace_results(run):
+    """Post-process the parsed trace for the run and write the results"""
+    trace_parser = run['parser']
+    path_base = run['path_base']
+    if trace_parser is not None and path_base is not None:
+        try:
+            start = monotonic.monotonic()
+            trace_parser.post_process_netlog_events()
+            trace_parser.ProcessTimelineEvents()
+            trace_parser.WriteUserTiming(path_base + '_user_timing.json.gz')
+            trace_parser.WriteCPUSlices(path_base + '_timeline_cpu.json.gz')
+            trace_parser.WriteScriptTimings(path_base + '_script_timing.json.gz')
+            trace_parser.WriteFeatureUsage(path_base + '_feature_usage.json.gz')
+            trace_parser.WriteInteractive(path_base + '_interactive.json.gz')
+            trace_parser.WriteNetlog(path_base + '_netlog_requests.json.gz')
+            trace_parser.WriteV8Stats(path_base + '_v8stats.json.gz')
+            run['stats']['post_process'] = monotonic.monotonic() - start
+        except Exception as err:
+            run['stats']['parse_errors'] += 1
+            logging.error("Error writing the trace results: %s", err.__str__())
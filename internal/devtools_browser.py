@@ -3,7 +3,6 @@
 # found in the LICENSE file.
 """Base class support for browsers that speak the dev tools protocol"""
 import glob
-import gzip
 import logging
 import os
 import re
@@ -11,8 +10,9 @@ import shutil
 import subprocess
 import time
 import monotonic
-import ujson as json
+from .compression import open_gzip
 from .optimization_checks import OptimizationChecks
+from .support import json_codec as json
 
 class DevtoolsBrowser(object):
     """Devtools Browser base"""
@@ -164,9 +164,13 @@ class DevtoolsBrowser(object):
                     if not task['combine_steps'] or not len(task['script']):
                         self.on_stop_recording(task)
                         recording = False
-                        self.on_start_processing(task)
-                        self.wait_for_processing(task)
-                        self.process_devtools_requests(task)
+                        if self.options.pipeline and not self.options.android and \
+                                not len(task['script']):
+                            # Leave the processing of the last step for the
+                            # background post-processing worker
+                            task['deferred_processing'] = self.defer_processing(task)
+                        else:
+                            self.process_step(task)
                         if task['log_data']:
                             # Move on to the next step
                             task['current_step'] += 1
@@ -177,6 +181,18 @@ class DevtoolsBrowser(object):
                 self.devtools.send_command('Page.navigate', {'url': 'about:blank'}, wait=True)
             self.task = None
 
+    def process_step(self, task):
+        """Process the captured data for the current step"""
+        self.on_start_processing(task)
+        self.wait_for_processing(task)
+        self.process_devtools_requests(task)
+
+    def defer_processing(self, task):
+        """Snapshot everything the processing of the current step needs so it can run
+        while the browser moves on to the next run"""
+        return DeferredProcessing(self.options, self.job, task, self.get_requests(),
+                                  self.use_devtools_video)
+
     def on_start_processing(self, task):
         """Start any processing of the captured data"""
         if task['log_data']:
@@ -217,18 +233,7 @@ class DevtoolsBrowser(object):
 
     def process_devtools_requests(self, task):
         """Process the devtools log and pull out the requests information"""
-        path_base = os.path.join(self.task['dir'], self.task['prefix'])
-        devtools_file = path_base + '_devtools.json.gz'
-        if os.path.isfile(devtools_file):
-            from internal.support.devtools_parser import DevToolsParser
-            out_file = path_base + '_devtools_requests.json.gz'
-            options = {'devtools': devtools_file, 'cached': task['cached'], 'out': out_file}
-            netlog = path_base + '_netlog_requests.json.gz'
-            options['netlog'] = netlog if os.path.isfile(netlog) else None
-            optimization = path_base + '_optimization.json.gz'
-            options['optimization'] = optimization if os.path.isfile(optimization) else None
-            parser = DevToolsParser(options)
-            parser.process()
+        process_devtools_requests(task)
 
     def run_js_file(self, file_name):
         """Execute one of our js scripts"""
@@ -247,7 +252,7 @@ class DevtoolsBrowser(object):
         user_timing = self.run_js_file('user_timing.js')
         if user_timing is not None:
             path = os.path.join(task['dir'], task['prefix'] + '_timed_events.json.gz')
-            with gzip.open(path, 'wb', 7) as outfile:
+            with open_gzip(path) as outfile:
                 outfile.write(json.dumps(user_timing))
         page_data = self.run_js_file('page_data.js')
         if page_data is not None:
@@ -260,7 +265,7 @@ class DevtoolsBrowser(object):
                          '};try{wptCustomMetric();}catch(e){};'
                 custom_metrics[name] = self.devtools.execute_js(script)
             path = os.path.join(task['dir'], task['prefix'] + '_metrics.json.gz')
-            with gzip.open(path, 'wb', 7) as outfile:
+            with open_gzip(path) as outfile:
                 outfile.write(json.dumps(custom_metrics))
 
     def process_command(self, command):
@@ -377,7 +382,7 @@ class DevtoolsBrowser(object):
                             if trace is not None and 'traceEvents' in trace:
                                 lighthouse_trace = os.path.join(task['dir'],
                                                                 'lighthouse_trace.json.gz')
-                            with gzip.open(lighthouse_trace, 'wb', 7) as f_out:
+                            with open_gzip(lighthouse_trace, 'trace') as f_out:
                                 f_out.write('{"traceEvents":[{}')
                                 for trace_event in trace['traceEvents']:
                                     f_out.write(",\n")
@@ -400,11 +405,11 @@ class DevtoolsBrowser(object):
                 if lh_report is not None and 'audits' in lh_report and \
                         'screenshots' in lh_report['audits']:
                     del lh_report['audits']['screenshots']
-                    with gzip.open(json_gzip, 'wb', 7) as f_out:
+                    with open_gzip(json_gzip) as f_out:
                         json.dump(lh_report, f_out)
                 else:
                     with open(json_file, 'rb') as f_in:
-                        with gzip.open(json_gzip, 'wb', 7) as f_out:
+                        with open_gzip(json_gzip) as f_out:
                             shutil.copyfileobj(f_in, f_out)
                 try:
                     os.remove(json_file)
@@ -419,9 +424,91 @@ class DevtoolsBrowser(object):
                         end = lh_report.find('\n    },', start)
                         if end >= 0:
                             lh_report = lh_report[:start] + lh_report[end + 7:]
-                    with gzip.open(html_gzip, 'wb', 7) as f_out:
+                    with open_gzip(html_gzip) as f_out:
                         f_out.write(lh_report)
                 try:
                     os.remove(html_file)
                 except Exception:
                     pass
+
+
+def process_devtools_requests(task):
+    """Process the devtools log and pull out the requests information"""
+    path_base = os.path.join(task['dir'], task['prefix'])
+    devtools_file = path_base + '_devtools.json.gz'
+    devtools_log = path_base + '_devtools.log'
+    devtools_index = path_base + '_devtools_index.json'
+    if os.path.isfile(devtools_file):
+        from internal.support.devtools_parser import DevToolsParser
+        out_file = path_base + '_devtools_requests.json.gz'
+        options = {'devtools': devtools_file, 'cached': task['cached'], 'out': out_file}
+        if os.path.isfile(devtools_log) and os.path.isfile(devtools_index):
+            options['devtools_index'] = devtools_index
+        netlog = path_base + '_netlog_requests.json.gz'
+        options['netlog'] = netlog if os.path.isfile(netlog) else None
+        optimization = path_base + '_optimization.json.gz'
+        options['optimization'] = optimization if os.path.isfile(optimization) else None
+        parser = DevToolsParser(options)
+        parser.process()
+    # The uncompressed log and index are only used locally, the server gets the json.gz
+    for path in [devtools_log, devtools_index]:
+        if os.path.isfile(path):
+            try:
+                os.remove(path)
+            except Exception:
+                pass
+
+
+class DeferredProcessing(object):
+    """Processing of the last step of a run, queued for the background post-processing
+    worker.  It only uses the state captured when the step stopped recording (task,
+    request details, pcap and video processing) and never touches the browser, which is
+    already running the next test."""
+    def __init__(self, options, job, task, requests, use_devtools_video):
+        self.options = options
+        self.job = job
+        self.task = task
+        self.requests = requests
+        self.use_devtools_video = use_devtools_video
+        self.step = task['current_step']
+        self.pcap_file = None
+        self.video_processing = None
+
+    def process(self, checkpoint=None):
+        """Run the processing stages in order, calling checkpoint() before each one"""
+        from .desktop_browser import finish_video_processing, process_pcap
+        task = self.task
+        stages = []
+        if task['log_data']:
+            stages.append(self.run_optimization_checks)
+            if self.use_devtools_video and self.job['video']:
+                stages.append(self.process_video)
+        if self.video_processing is not None:
+            stages.append(lambda: finish_video_processing(self.job, task,
+                                                          self.video_processing))
+        if self.pcap_file is not None and os.path.isfile(self.pcap_file):
+            stages.append(lambda: process_pcap(self.pcap_file, task))
+        stages.append(lambda: process_devtools_requests(task))
+        current_step = task['current_step']
+        task['current_step'] = self.step
+        try:
+            for stage in stages:
+                if checkpoint is not None:
+                    checkpoint()
+                stage()
+        finally:
+            task['current_step'] = current_step
+            self.requests = None
+            self.video_processing = None
+
+    def run_optimization_checks(self):
+        """Run the optimization checks against the request snapshot"""
+        optimization = OptimizationChecks(self.job, self.task, self.requests)
+        optimization.start()
+        optimization.join()
+
+    def process_video(self):
+        """Post process the devtools video"""
+        from internal.video_processing import VideoProcessing
+        video = VideoProcessing(self.options, self.job, self.task)
+        video.process()
@@ -5,7 +5,6 @@
 from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
 from datetime import datetime, timedelta
 import glob
-import gzip
 import logging
 import os
 import Queue
@@ -16,8 +15,9 @@ import threading
 import time
 import urlparse
 import monotonic
-import ujson as json
+from .compression import open_gzip
 from .desktop_browser import DesktopBrowser
+from .support import json_codec as json
 
 """ Orange page that changes itself to white on navigation
 <html>
@@ -245,7 +245,7 @@ class Firefox(DesktopBrowser):
         user_timing = self.run_js_file('user_timing.js')
         if user_timing is not None:
             path = os.path.join(task['dir'], task['prefix'] + '_timed_events.json.gz')
-            with gzip.open(path, 'wb', 7) as outfile:
+            with open_gzip(path) as outfile:
                 outfile.write(json.dumps(user_timing))
         logging.debug("Collecting page-level metrics")
         page_data = self.run_js_file('page_data.js')
@@ -262,7 +262,7 @@ class Firefox(DesktopBrowser):
                 if custom_metrics[name] is not None:
                     logging.debug(custom_metrics[name])
             path = os.path.join(task['dir'], task['prefix'] + '_metrics.json.gz')
-            with gzip.open(path, 'wb', 7) as outfile:
+            with open_gzip(path) as outfile:
                 outfile.write(json.dumps(custom_metrics))
 
     def process_message(self, message):
@@ -442,7 +442,7 @@ class Firefox(DesktopBrowser):
                                       base_name, length, start_pos)
                         with open(path, 'rb') as f_in:
                             f_in.seek(start_pos)
-                            with gzip.open(dest, 'wb', 7) as f_out:
+                            with open_gzip(dest, 'netlog') as f_out:
                                 while length > 0:
                                     read_bytes = min(length, 1024 * 1024)
                                     buff = f_in.read(read_bytes)
@@ -585,7 +585,7 @@ class Firefox(DesktopBrowser):
         result['requests'] = self.merge_requests(request_timings)
         result['pageData'] = self.calculate_page_stats(result['requests'])
         devtools_file = os.path.join(task['dir'], task['prefix'] + '_devtools_requests.json.gz')
-        with gzip.open(devtools_file, 'wb', 7) as f_out:
+        with open_gzip(devtools_file) as f_out:
             json.dump(result, f_out)
 
     def get_empty_request(self, request_id, url):
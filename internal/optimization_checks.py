@@ -14,7 +14,7 @@ import subprocess
 import threading
 import time
 import monotonic
-import ujson as json
+from .support import json_codec as json
 
 class OptimizationChecks(object):
     """Threaded optimization checks"""
@@ -604,14 +604,15 @@ class OptimizationChecks(object):
                                     check['score'] = int(target_size * 100 / content_length)
                                 else:
                                     check['score'] = 100
-                    elif sniff_type == 'png' and 'response_body' in request:
+                    elif sniff_type == 'png':
                         if content_length < 1400:
                             check['score'] = 100
                         else:
                             image_chunks = ["iCCP", "tIME", "gAMA", "PLTE", "acTL", "IHDR", "cHRM",
                                             "bKGD", "tRNS", "sBIT", "sRGB", "pHYs", "hIST", "vpAg",
                                             "oFFs", "fcTL", "fdAT", "IDAT"]
-                            body = request['response_body']
+                            with open(request['body'], 'rb') as f_in:
+                                body = f_in.read()
                             image_size = len(body)
                             valid = True
                             target_size = 8
@@ -685,11 +686,11 @@ class OptimizationChecks(object):
         for request_id in self.requests:
             try:
                 request = self.requests[request_id]
-                if 'response_body' in request:
-                    body = request['response_body']
-                    sniff_type = self.sniff_content(body)
-                    if sniff_type == 'jpeg':
-                        content_length = len(request['response_body'])
+                if 'body' in request and self.sniff_file_content(request['body']) == 'jpeg':
+                    with open(request['body'], 'rb') as f_in:
+                        body = f_in.read()
+                    if body:
+                        content_length = len(body)
                         check = {'size': content_length, 'scan_count': 0}
                         pos = 0
                         try:
@@ -6,6 +6,14 @@ import logging
 import os
 import platform
 import subprocess
+import threading
+
+# Cleared while a browser is recording so background work can wait for it to finish
+RECORDING_IDLE = threading.Event()
+RECORDING_IDLE.set()
+# gettid() syscall numbers (python 2 has no way to get the kernel thread ID)
+GETTID_SYSCALL = {'x86_64': 186, 'i386': 224, 'i686': 224, 'aarch64': 178,
+                  'armv6l': 224, 'armv7l': 224}
 
 def kill_all(exe, force, timeout=30):
     """Terminate all instances of the given process"""
@@ -16,6 +24,16 @@ def kill_all(exe, force, timeout=30):
             subprocess.call(['taskkill', '/F', '/T', '/IM', exe])
         else:
             subprocess.call(['taskkill', '/IM', exe])
+    elif 'WPT_SLOT' in os.environ:
+        # Only touch the processes belonging to this test slot
+        for proc in find_processes(exe):
+            try:
+                if force:
+                    proc.kill()
+                else:
+                    proc.terminate()
+            except Exception:
+                pass
     elif plat == "Linux" or plat == "Darwin":
         if force:
             subprocess.call(['killall', '-s', 'SIGKILL', exe])
@@ -23,19 +41,27 @@ def kill_all(exe, force, timeout=30):
             subprocess.call(['killall', exe])
     wait_for_all(exe, timeout)
 
-def wait_for_all(exe, timeout=30):
-    """Wait for the given process to exit"""
+def find_processes(exe):
+    """Find the running instances of the given executable (launched by this slot if running
+    multiple test slots, they inherit the WPT_SLOT environment variable)"""
     import psutil
     processes = []
+    slot = os.environ.get('WPT_SLOT')
     for proc in psutil.process_iter():
         try:
             pinfo = proc.as_dict(attrs=['pid', 'name', 'exe'])
-        except psutil.NoSuchProcess:
-            pass
-        else:
             if 'exe' in pinfo and pinfo['exe'] is not None and\
                     os.path.basename(pinfo['exe']) == exe:
-                processes.append(proc)
+                if slot is None or proc.environ().get('WPT_SLOT') == slot:
+                    processes.append(proc)
+        except psutil.Error:
+            pass
+    return processes
+
+def wait_for_all(exe, timeout=30):
+    """Wait for the given process to exit"""
+    import psutil
+    processes = find_processes(exe)
     if len(processes):
         logging.debug("Waiting up to %d seconds for %s to exit", timeout, exe)
         psutil.wait_procs(processes, timeout=timeout)
@@ -82,6 +108,44 @@ def run_elevated(command, args):
     return ret
 # pylint: enable=E0611,E0401
 
+def set_recording(recording):
+    """Flag that a browser is (or is no longer) recording"""
+    if recording:
+        RECORDING_IDLE.clear()
+    else:
+        RECORDING_IDLE.set()
+
+def wait_for_recording_idle():
+    """Block until no browser is recording"""
+    while not RECORDING_IDLE.is_set():
+        RECORDING_IDLE.wait(1)
+
+def get_allowed_cpus():
+    """CPUs the agent is allowed to run on (empty if the affinity isn't available)"""
+    cpus = []
+    try:
+        import psutil
+        cpus = sorted(psutil.Process().cpu_affinity())
+    except Exception:
+        pass
+    return cpus
+
+def pin_current_thread(cpus):
+    """Restrict the calling thread (and anything it launches) to the given CPUs (Linux)"""
+    ret = False
+    if platform.system() == 'Linux' and platform.machine() in GETTID_SYSCALL:
+        try:
+            import ctypes
+            import psutil
+            libc = ctypes.CDLL(None, use_errno=True)
+            thread_id = libc.syscall(GETTID_SYSCALL[platform.machine()])
+            if thread_id > 0:
+                psutil.Process(thread_id).cpu_affinity(list(cpus))
+                ret = True
+        except Exception as err:
+            logging.debug("Error setting the thread CPU affinity: %s", err.__str__())
+    return ret
+
 # pylint: disable=E1101
 def get_free_disk_space():
     """Return the number of bytes free on the given disk in Gigabytes (floating)"""
@@ -0,0 +1,204 @@
+# Copyright 2017 Google Inc. All rights reserved.
+# Use of this source code is governed by the Apache 2.0 license that can be
+# found in the LICENSE file.
+"""Run several isolated test slots on one host (Linux only).
+Each slot is a separate agent process with its own Xvfb display, work/profile
+directories (agent name suffix), devtools port range, CPU set and network
+namespace (so each slot gets its own NetEm traffic-shaping)."""
+import getpass
+import logging
+import multiprocessing
+import os
+import re
+import signal
+import subprocess
+import sys
+import time
+
+PORTS_PER_SLOT = 500
+# Each slot's namespace is connected to the host over a veth pair with its own /30
+SLOT_NETWORK = '10.209.{0:d}.{1:d}'
+
+def get_slot_name(slot):
+    """Network namespace (and cgroup) name for the slot"""
+    return 'wptslot{0:d}'.format(slot)
+
+def get_slot_cpus(slot, slots):
+    """List of the CPUs dedicated to the given slot (empty if there aren't enough to share)"""
+    cpus = []
+    try:
+        cpu_count = multiprocessing.cpu_count()
+        per_slot = cpu_count // slots
+        if per_slot > 0:
+            cpus = range(slot * per_slot, (slot + 1) * per_slot)
+    except Exception:
+        pass
+    return cpus
+
+def get_slot_port(slot):
+    """First devtools port for the slot"""
+    return 9222 + (slot if slot is not None else 0) * PORTS_PER_SLOT
+
+class SlotManager(object):
+    """Launches and supervises the agent process for each slot"""
+    def __init__(self, options, root_path):
+        self.options = options
+        self.root_path = root_path
+        self.slots = options.slots
+        self.processes = [None] * self.slots
+        self.namespaces = []
+        self.must_exit = False
+        self.user = getpass.getuser()
+        self.use_netns = options.shaper is None or options.shaper[:5] == 'netem'
+
+    def run(self):
+        """Start the slots and restart any that exit until we are asked to stop"""
+        signal.signal(signal.SIGTERM, self.signal_handler)
+        signal.signal(signal.SIGINT, self.signal_handler)
+        exit_file = os.path.join(self.root_path, 'exit')
+        try:
+            for slot in xrange(self.slots):
+                if self.use_netns and not self.create_namespace(slot):
+                    logging.critical('Error creating the network namespace for slot %d', slot)
+                    return
+            print "Running {0:d} agent slots, hit Ctrl+C to exit".format(self.slots)
+            while True:
+                running = False
+                for slot in xrange(self.slots):
+                    process = self.processes[slot]
+                    if process is not None and process.poll() is None:
+                        running = True
+                    elif not self.must_exit and \
+                            (process is None or (self.options.exit <= 0 and
+                                                 not os.path.isfile(exit_file))):
+                        if process is not None:
+                            logging.critical('Slot %d exited (%d), restarting', slot,
+                                             process.returncode)
+                        self.processes[slot] = self.launch(slot)
+                        running = True
+                if not running:
+                    break
+                time.sleep(1)
+            # All of the slots have seen the exit file (they leave it in place for each other)
+            if os.path.isfile(exit_file):
+                try:
+                    os.remove(exit_file)
+                except Exception:
+                    pass
+        finally:
+            self.stop()
+            for slot in list(self.namespaces):
+                self.remove_namespace(slot)
+
+    def signal_handler(self, *_):
+        """Pass Ctrl+C/SIGTERM on to the slots"""
+        if self.must_exit:
+            self.stop(True)
+            exit(1)
+        print "Will exit after the slots complete their tests.  Hit Ctrl+C again to exit now"
+        self.must_exit = True
+        for process in self.processes:
+            if process is not None and process.poll() is None:
+                try:
+                    os.kill(process.pid, signal.SIGTERM)
+                except Exception:
+                    pass
+
+    def stop(self, force=False):
+        """Wait for (or kill) the slot processes"""
+        for process in self.processes:
+            if process is not None:
+                try:
+                    if force:
+                        process.kill()
+                    process.wait()
+                except Exception:
+                    pass
+
+    def launch(self, slot):
+        """Launch the agent process for a slot"""
+        command = []
+        if self.use_netns:
+            # Run the agent in the namespace as the current user
+            command.extend(['sudo', 'ip', 'netns', 'exec', get_slot_name(slot),
+                            'sudo', '-H', '-u', self.user, '--',
+                            'env', 'PATH=' + os.environ.get('PATH', '')])
+        cpus = get_slot_cpus(slot, self.slots)
+        if cpus:
+            command.extend(['taskset', '-c', ','.join([str(cpu) for cpu in cpus])])
+        command.extend([sys.executable, os.path.join(self.root_path, 'wptagent.py')])
+        command.extend(sys.argv[1:])
+        command.extend(['--slot', str(slot), '--xvfb'])
+        logging.debug(' '.join(command))
+        return subprocess.Popen(command, cwd=self.root_path)
+
+    def sudo(self, args, namespace=None):
+        """Run a networking command as root (optionally in a namespace)"""
+        command = ['sudo']
+        if namespace is not None:
+            command.extend(['ip', 'netns', 'exec', namespace])
+        command.extend(args)
+        logging.debug(' '.join(command))
+        return subprocess.call(command) == 0
+
+    def create_namespace(self, slot):
+        """Set up the network namespace for a slot, NATed through the host"""
+        name = get_slot_name(slot)
+        host_if = 'wpt{0:d}h'.format(slot)
+        slot_if = 'wpt{0:d}s'.format(slot)
+        host_ip = SLOT_NETWORK.format(slot, 1)
+        slot_ip = SLOT_NETWORK.format(slot, 2)
+        subnet = SLOT_NETWORK.format(slot, 0) + '/30'
+        self.remove_namespace(slot)
+        self.namespaces.append(slot)
+        ok = self.sudo(['ip', 'netns', 'add', name]) and \
+             self.sudo(['ip', 'link', 'add', host_if, 'type', 'veth', 'peer', 'name', slot_if]) and \
+             self.sudo(['ip', 'link', 'set', slot_if, 'netns', name]) and \
+             self.sudo(['ip', 'addr', 'add', host_ip + '/30', 'dev', host_if]) and \
+             self.sudo(['ip', 'link', 'set', host_if, 'up']) and \
+             self.sudo(['ip', 'link', 'set', 'lo', 'up'], name) and \
+             self.sudo(['ip', 'addr', 'add', slot_ip + '/30', 'dev', slot_if], name) and \
+             self.sudo(['ip', 'link', 'set', slot_if, 'up'], name) and \
+             self.sudo(['ip', 'route', 'add', 'default', 'via', host_ip], name) and \
+             self.sudo(['sysctl', '-q', '-w', 'net.ipv4.ip_forward=1']) and \
+             self.sudo(['iptables', '-t', 'nat', '-A', 'POSTROUTING', '-s', subnet,
+                        '-j', 'MASQUERADE']) and \
+             self.sudo(['iptables', '-I', 'FORWARD', '-i', host_if, '-j', 'ACCEPT']) and \
+             self.sudo(['iptables', '-I', 'FORWARD', '-o', host_if, '-j', 'ACCEPT'])
+        if ok:
+            self.write_resolv_conf(name)
+        return ok
+
+    def write_resolv_conf(self, name):
+        """Local resolvers (i.e. systemd-resolved on 127.0.0.53) aren't reachable from
+        inside the namespace so fall back to public DNS for those"""
+        try:
+            resolv = ''
+            if os.path.isfile('/etc/resolv.conf'):
+                with open('/etc/resolv.conf', 'rb') as f_in:
+                    resolv = f_in.read()
+            if not re.search(r'^nameserver\s+(?!127\.)(?!::1)', resolv, re.MULTILINE):
+                resolv = 'nameserver 8.8.8.8\nnameserver 8.8.4.4\n'
+                path = os.path.join('/etc/netns', name)
+                self.sudo(['mkdir', '-p', path])
+                process = subprocess.Popen(['sudo', 'tee', os.path.join(path, 'resolv.conf')],
+                                           stdin=subprocess.PIPE, stdout=open(os.devnull, 'wb'))
+                process.communicate(resolv)
+        except Exception:
+            pass
+
+    def remove_namespace(self, slot):
+        """Tear down the network namespace for a slot"""
+        name = get_slot_name(slot)
+        host_if = 'wpt{0:d}h'.format(slot)
+        subnet = SLOT_NETWORK.format(slot, 0) + '/30'
+        with open(os.devnull, 'wb') as devnull:
+            for command in [['sudo', 'iptables', '-t', 'nat', '-D', 'POSTROUTING', '-s', subnet,
+                             '-j', 'MASQUERADE'],
+                            ['sudo', 'iptables', '-D', 'FORWARD', '-i', host_if, '-j', 'ACCEPT'],
+                            ['sudo', 'iptables', '-D', 'FORWARD', '-o', host_if, '-j', 'ACCEPT'],
+                            ['sudo', 'ip', 'link', 'del', host_if],
+                            ['sudo', 'ip', 'netns', 'del', name]]:
+                subprocess.call(command, stdout=devnull, stderr=devnull)
+        if slot in self.namespaces:
+            self.namespaces.remove(slot)
@@ -0,0 +1,376 @@
+#!/usr/bin/python
+"""
+Copyright 2017 Google Inc. All Rights Reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Regression check for the CPU time slices: processes each recorded trace with the
+original slice accounting (kept below as BaselineTrace), the current pure python
+accounting (trace_parser.py --nonumpy) and the numpy one, diffs the resulting
+_timeline_cpu data against the original and reports the time each one took.
+Exits with a non-zero status on any difference.
+
+--synthetic generates a script-heavy trace (deeply nested script events on the main
+thread, many events per slice) to time the engines on dense slices.
+"""
+import gzip
+import logging
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+
+try:
+    from . import json_codec as json
+    from . import trace_parser
+except (ImportError, ValueError):
+    import json_codec as json
+    import trace_parser
+
+
+class BaselineTrace(trace_parser.Trace):
+    """Trace with the CPU slice accounting from before the numpy engine (the
+    ProcessTimelineEvents, ProcessTimelineEvent and AdjustTimelineSlice code as it
+    was), the reference the current engines are checked against"""
+    def ProcessTimelineEvents(self):
+        if len(self.timeline_events) and self.end_time > self.start_time:
+            # Figure out how big each slice should be in usecs. Size it to a
+            # power of 10 where we have at least 2000 slices
+            exp = 0
+            last_exp = 0
+            slice_count = self.end_time - self.start_time
+            while slice_count > 2000:
+                last_exp = exp
+                exp += 1
+                slice_count = int(
+                    math.ceil(float(self.end_time - self.start_time) / float(pow(10, exp))))
+            self.cpu['total_usecs'] = self.end_time - self.start_time
+            self.cpu['slice_usecs'] = int(pow(10, last_exp))
+            slice_count = int(math.ceil(
+                float(self.end_time - self.start_time) / float(self.cpu['slice_usecs'])))
+
+            # Create the empty time slices for all of the threads
+            self.cpu['slices'] = {}
+            for thread in self.threads.keys():
+                self.cpu['slices'][thread] = {'total': [0.0] * slice_count}
+                for name in self.threads[thread].keys():
+                    self.cpu['slices'][thread][name] = [0.0] * slice_count
+
+            # Go through all of the timeline events recursively and account for
+            # the time they consumed
+            for timeline_event in self.timeline_events:
+                self.ProcessTimelineEvent(timeline_event, None)
+            if self.interactive_end is not None and self.interactive_end - \
+                    self.interactive_start > 500000:
+                self.interactive.append([int(math.ceil(self.interactive_start / 1000.0)),
+                                         int(math.floor(self.interactive_end / 1000.0))])
+
+            # Go through all of the fractional times and convert the float
+            # fractional times to integer usecs
+            for thread in self.cpu['slices'].keys():
+                del self.cpu['slices'][thread]['total']
+                for name in self.cpu['slices'][thread].keys():
+                    for slice in range(len(self.cpu['slices'][thread][name])):
+                        self.cpu['slices'][thread][name][slice] =\
+                            int(self.cpu['slices'][thread][name]
+                                [slice] * self.cpu['slice_usecs'])
+
+    def ProcessTimelineEvent(self, timeline_event, parent, stack = None):
+        start = timeline_event['s'] - self.start_time
+        end = timeline_event['e'] - self.start_time
+        if stack is None:
+            stack = {}
+        if end > start:
+            elapsed = end - start
+            thread = timeline_event['t']
+            name = self.event_name_lookup[timeline_event['n']]
+
+            # Keep track of periods on the main thread where at least 500ms are
+            # available with no tasks longer than 50ms
+            if 'main_thread' in self.cpu and thread == self.cpu['main_thread']:
+                if elapsed > 50000:
+                    if start - self.interactive_start > 500000:
+                        self.interactive.append(
+                            [int(math.ceil(self.interactive_start / 1000.0)),
+                             int(math.floor(start / 1000.0))])
+                    self.interactive_start = end
+                    self.interactive_end = None
+                else:
+                    self.interactive_end = end
+
+            if 'js' in timeline_event:
+                script = timeline_event['js']
+                js_start = start / 1000.0
+                js_end = end / 1000.0
+                if self.scripts is None:
+                    self.scripts = {}
+                if 'main_thread' not in self.scripts and 'main_thread' in self.cpu:
+                    self.scripts['main_thread'] = self.cpu['main_thread']
+                if thread not in self.scripts:
+                    self.scripts[thread] = {}
+                if script not in self.scripts[thread]:
+                    self.scripts[thread][script] = {}
+                if name not in self.scripts[thread][script]:
+                    self.scripts[thread][script][name] = []
+                if thread not in stack:
+                    stack[thread] = {}
+                if script not in stack[thread]:
+                    stack[thread][script] = {}
+                if name not in stack[thread][script]:
+                    stack[thread][script][name] = []
+                # make sure the script duration isn't already covered by a
+                # parent event
+                new_duration = True
+                if len(stack[thread][script][name]):
+                    for period in stack[thread][script][name]:
+                        if len(period) >= 2 and js_start >= period[0] and js_end <= period[1]:
+                            new_duration = False
+                            break
+                if new_duration:
+                    self.scripts[thread][script][name].append([js_start, js_end])
+                    stack[thread][script][name].append([js_start, js_end])
+
+            slice_usecs = self.cpu['slice_usecs']
+            first_slice = int(float(start) / float(slice_usecs))
+            last_slice = int(float(end) / float(slice_usecs))
+            for slice_number in xrange(first_slice, last_slice + 1):
+                slice_start = slice_number * slice_usecs
+                slice_end = slice_start + slice_usecs
+                used_start = max(slice_start, start)
+                used_end = min(slice_end, end)
+                slice_elapsed = used_end - used_start
+                self.AdjustTimelineSlice(
+                    thread, slice_number, name, parent, slice_elapsed)
+
+            # Recursively process any child events
+            if 'c' in timeline_event:
+                for child in timeline_event['c']:
+                    self.ProcessTimelineEvent(child, name, dict(stack))
+
+    # Add the time to the given slice and subtract the time from a parent event
+    def AdjustTimelineSlice(self, thread, slice_number, name, parent, elapsed):
+        try:
+            # Don't bother adjusting if both the current event and parent are the same category
+            # since they would just cancel each other out.
+            if name != parent:
+                fraction = min(1.0, float(elapsed) /
+                               float(self.cpu['slice_usecs']))
+                self.cpu['slices'][thread][name][slice_number] += fraction
+                self.cpu['slices'][thread]['total'][slice_number] += fraction
+                if parent is not None and \
+                        self.cpu['slices'][thread][parent][slice_number] >= fraction:
+                    self.cpu['slices'][thread][parent][slice_number] -= fraction
+                    self.cpu['slices'][thread]['total'][slice_number] -= fraction
+                # Make sure we didn't exceed 100% in this slice
+                self.cpu['slices'][thread][name][slice_number] = min(
+                    1.0, self.cpu['slices'][thread][name][slice_number])
+
+                # make sure we don't exceed 100% for any slot
+                if self.cpu['slices'][thread]['total'][slice_number] > 1.0:
+                    available = max(0.0, 1.0 - fraction)
+                    for slice_name in self.cpu['slices'][thread].keys():
+                        if slice_name != name:
+                            self.cpu['slices'][thread][slice_name][slice_number] =\
+                                min(self.cpu['slices'][thread]
+                                    [slice_name][slice_number], available)
+                            available = max(0.0, available - \
+                                            self.cpu['slices'][thread][slice_name][slice_number])
+                    self.cpu['slices'][thread]['total'][slice_number] = min(
+                        1.0, max(0.0, 1.0 - available))
+        except BaseException:
+            pass
+
+
+def process_trace(path, engine, reorder_window, is_timeline):
+    """Process the trace with the given slice engine ('baseline', 'python' or 'numpy'),
+    returns the cpu data, the total time and the time spent on the slices"""
+    if engine == 'baseline':
+        trace = BaselineTrace()
+    else:
+        trace = trace_parser.Trace()
+        trace.vectorize_slices = engine == 'numpy'
+    # Time the slice accounting on its own (the trace loading is the same for all of them)
+    slice_time = [0.0]
+    process_timeline_events = trace.ProcessTimelineEvents
+
+    def timed_process_timeline_events():
+        """Time the wrapped ProcessTimelineEvents"""
+        slice_start = time.time()
+        process_timeline_events()
+        slice_time[0] += time.time() - slice_start
+    trace.ProcessTimelineEvents = timed_process_timeline_events
+    start = time.time()
+    if is_timeline:
+        trace.ProcessTimeline(path)
+    elif engine == 'baseline':
+        # The original code had no reorder window
+        trace.Process(path)
+    else:
+        trace.Process(path, reorder_window)
+    return trace.cpu, time.time() - start, slice_time[0]
+
+
+def diff_slices(expected, actual):
+    """List the differences between the two sets of cpu data"""
+    diffs = []
+    for key in ['main_thread', 'total_usecs', 'slice_usecs']:
+        if expected.get(key) != actual.get(key):
+            diffs.append('{0}: {1} != {2}'.format(key, expected.get(key), actual.get(key)))
+    expected_slices = expected.get('slices', {})
+    actual_slices = actual.get('slices', {})
+    for thread in sorted(set(expected_slices.keys()) | set(actual_slices.keys())):
+        if thread not in expected_slices or thread not in actual_slices:
+            diffs.append('thread {0} is only in one of the outputs'.format(thread))
+            continue
+        names = set(expected_slices[thread].keys()) | set(actual_slices[thread].keys())
+        for name in sorted(names):
+            expected_values = expected_slices[thread].get(name)
+            actual_values = actual_slices[thread].get(name)
+            if expected_values is None or actual_values is None:
+                diffs.append('{0} {1} is only in one of the outputs'.format(thread, name))
+            elif expected_values != actual_values:
+                mismatched = [index for index in range(max(len(expected_values),
+                                                           len(actual_values)))
+                              if index >= len(expected_values) or
+                              index >= len(actual_values) or
+                              expected_values[index] != actual_values[index]]
+                index = mismatched[0]
+                diffs.append('{0} {1}: {2:d} slices differ, first at {3:d} ({4} != {5})'.format(
+                    thread, name, len(mismatched), index,
+                    expected_values[index] if index < len(expected_values) else None,
+                    actual_values[index] if index < len(actual_values) else None))
+    return diffs
+
+
+def compare(files, reorder_window, is_timeline):
+    """Compare the slice engines against the original accounting on each file, returns
+    the number of mismatches"""
+    engines = ['python']
+    if trace_parser.np is not None:
+        engines.append('numpy')
+    failures = 0
+    for path in files:
+        expected, elapsed, slice_time = process_trace(path, 'baseline', None, is_timeline)
+        times = ['baseline {0:0.3f}s (slices {1:0.3f}s)'.format(elapsed, slice_time)]
+        diffs = []
+        for engine in engines:
+            actual, elapsed, slice_time = process_trace(path, engine, reorder_window,
+                                                        is_timeline)
+            times.append('{0} {1:0.3f}s (slices {2:0.3f}s)'.format(engine, elapsed, slice_time))
+            engine_diffs = diff_slices(expected, actual)
+            # The serialized output is what gets uploaded so compare that too
+            if not engine_diffs and json.dumps(expected, sort_keys=True) != \
+                    json.dumps(actual, sort_keys=True):
+                engine_diffs.append('the serialized outputs differ')
+            diffs.extend(['{0}: {1}'.format(engine, diff) for diff in engine_diffs])
+        status = 'OK' if not diffs else 'MISMATCH'
+        if not diffs and 'slices' not in expected:
+            status = 'OK (no CPU slices, the main thread was not found)'
+        print('{0}: {1} ({2})'.format(path, status, ', '.join(times)))
+        for diff in diffs:
+            print('    ' + diff)
+        if diffs:
+            failures += 1
+    return failures
+
+
+def generate_script_heavy_trace(path, seconds, seed=0):
+    """Write a synthetic trace of a script-heavy page: back to back tasks on the main
+    thread, each a tree of nested script, layout and paint events, plus some
+    background thread activity"""
+    rand = random.Random(seed)
+    events = []
+    start = 1000000
+    events.append({'pid': 1, 'tid': 1, 'ts': start, 'ph': 'X', 'dur': 5,
+                   'cat': 'devtools.timeline', 'name': 'ResourceSendRequest',
+                   'args': {'data': {'url': 'https://www.example.com/'}}})
+    names = ['FunctionCall', 'EvaluateScript', 'v8.compile', 'Layout', 'UpdateLayerTree',
+             'Paint', 'ParseHTML', 'TimerFire', 'EventDispatch', 'RecalculateStyles']
+
+    def add_event(tid, event_start, duration, depth):
+        name = rand.choice(names)
+        event = {'pid': 1, 'tid': tid, 'ts': event_start, 'ph': 'X', 'dur': duration,
+                 'cat': 'devtools.timeline', 'name': name, 'args': {}}
+        if name in ['FunctionCall', 'EvaluateScript', 'v8.compile']:
+            event['args']['data'] = {'url': 'https://cdn.example.com/js/{0:d}.js'.format(
+                rand.randint(1, 50))}
+        events.append(event)
+        # Fill most of the event with nested children
+        child_start = event_start + rand.randint(0, 20)
+        while depth < 6 and child_start < event_start + duration - 20:
+            child_duration = rand.randint(5, max(5, (event_start + duration - child_start) / 2))
+            add_event(tid, child_start, child_duration, depth + 1)
+            child_start += child_duration + rand.randint(0, 20)
+
+    end = start + seconds * 1000000
+    task_start = start + 100
+    while task_start < end:
+        duration = rand.randint(100, 60000)
+        add_event(1, task_start, duration, 0)
+        task_start += duration + rand.randint(0, 2000)
+    for tid in [2, 3]:
+        task_start = start + 100
+        while task_start < end:
+            duration = rand.randint(100, 5000)
+            add_event(tid, task_start, duration, 3)
+            task_start += duration + rand.randint(1000, 50000)
+    with gzip.open(path, 'wb') as f_out:
+        f_out.write('{"traceEvents":[\n')
+        f_out.write(',\n'.join([json.dumps(event) for event in events]))
+        f_out.write('\n]}')
+    return len(events)
+
+
+def main():
+    """Main entry-point when running on the command-line"""
+    import argparse
+    parser = argparse.ArgumentParser(description='Compare the python and numpy CPU slice '
+                                                 'accounting on recorded traces.',
+                                     prog='compare_cpu_slices')
+    parser.add_argument('-w', '--window', type=int,
+                        help="Stream the traces using a reorder window of the given number "
+                             "of events.")
+    parser.add_argument('-l', '--timeline', action='store_true', default=False,
+                        help="The files are timelines instead of traces.")
+    parser.add_argument('-s', '--synthetic', type=int, nargs='?', const=10,
+                        help="Also check a generated script-heavy trace of the given "
+                             "number of seconds (defaults to 10).")
+    parser.add_argument('files', nargs='*',
+                        help="Recorded traces (_trace.json or _trace.json.gz).")
+    options, _ = parser.parse_known_args()
+    logging.basicConfig(level=logging.CRITICAL)
+    if trace_parser.np is None:
+        print('numpy is not installed, only checking the python slice accounting')
+    files = list(options.files)
+    synthetic = None
+    if options.synthetic:
+        handle, synthetic = tempfile.mkstemp(suffix='_trace.json.gz')
+        os.close(handle)
+        count = generate_script_heavy_trace(synthetic, options.synthetic)
+        print('Generated a {0:d} second script-heavy trace with {1:d} events'.format(
+            options.synthetic, count))
+        files.append(synthetic)
+    if not files:
+        parser.error("No traces to compare.")
+    try:
+        failures = compare(files, options.window, options.timeline)
+    finally:
+        if synthetic is not None:
+            os.remove(synthetic)
+    if failures:
+        sys.exit(1)
+
+if '__main__' == __name__:
+    main()
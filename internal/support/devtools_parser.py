@@ -16,24 +16,59 @@ limitations under the License.
 """
 import gzip
 import logging
+import collections
+import operator
 import os
 import re
+import struct
 import time
 import urlparse
 
-# try a fast json parser if it is installed
+# shared json codec (uses the fastest json library that is installed)
 try:
-    import ujson as json
-except BaseException:
-    import json
+    from . import json_codec as json
+except (ImportError, ValueError):
+    import json_codec as json
+
+NETLOG_NUMBER_RE = re.compile(r'^\d+\.?(\d+)?$')
+# Number of devtools events held back to put them in timestamp order while streaming
+# (an event can arrive up to this many events late)
+REORDER_WINDOW = 10000
+# netlog request fields that are copied to the request (netlog name: request name)
+NETLOG_FIELDS = {'dns_start': 'dns_start',
+                 'dns_end': 'dns_end',
+                 'connect_start': 'connect_start',
+                 'connect_end': 'connect_end',
+                 'ssl_start': 'ssl_start',
+                 'ssl_end': 'ssl_end',
+                 'start': 'load_start',
+                 'priority': 'priority',
+                 'protocol': 'protocol',
+                 'socket': 'socket',
+                 'stream_id': 'http2_stream_id',
+                 'parent_stream_id': 'http2_stream_dependency',
+                 'weight': 'http2_stream_weight',
+                 'exclusive': 'http2_stream_exclusive'}
+
+def netlog_value(value):
+    """Convert a netlog field for the request (non-negative numbers become ints)"""
+    if type(value) is int and value >= 0:
+        return value
+    text = str(value).strip()
+    if NETLOG_NUMBER_RE.match(text):
+        return int(round(float(text)))
+    return str(value)
 
 class DevToolsParser(object):
     """Main class"""
     def __init__(self, options):
         self.devtools_file = options['devtools']
+        self.devtools_index = options['devtools_index'] if 'devtools_index' in options else None
         self.netlog_requests_file = options['netlog'] if 'netlog' in options else None
         self.optimization = options['optimization'] if 'optimization' in options else None
         self.cached = options['cached'] if 'cached' in options else False
+        self.reorder_window = options['reorder_window'] if 'reorder_window' in options and \
+            options['reorder_window'] else REORDER_WINDOW
         self.out_file = options['out']
         self.result = {'pageData': {}, 'requests': []}
 
@@ -72,26 +107,26 @@ class DevToolsParser(object):
         """Load the events we are interested in"""
         net_requests = []
         page_data = {'endTime': 0}
-        _, ext = os.path.splitext(self.devtools_file)
-        if ext.lower() == '.gz':
-            f_in = gzip.open(self.devtools_file, 'rb')
-        else:
-            f_in = open(self.devtools_file, 'r')
-        raw_events = json.load(f_in)
-        # sort all of the events by timestamp
-        if len(raw_events):
-            raw_events.sort(key=lambda x: x['params']['timestamp'] if \
-                ('params' in x and 'timestamp' in x['params']) else 0)
-        f_in.close()
-        if raw_events is not None and len(raw_events):
+        raw_events = self.load_devtools_events()
+        if raw_events is not None:
             end_timestamp = None
             first_timestamp = None
             raw_requests = {}
             id_map = {}
+            untimed_main_frame = None
+            needs_main_frame = []
             for raw_event in raw_events:
                 if 'method' in raw_event and 'params' in raw_event:
                     method = raw_event['method']
                     params = raw_event['params']
+                    # Events without a timestamp sort ahead of all of the others so the only
+                    # one that affects the requests is the last main frame navigation.
+                    # Requests that need it get it once the pass is complete.
+                    if 'timestamp' not in params:
+                        if method == 'Page.frameNavigated' and 'frame' in params and \
+                                'id' in params['frame'] and 'parentId' not in params['frame']:
+                            untimed_main_frame = params['frame']['id']
+                        continue
                     # Adjust all of the timestamps to be relative to the start of navigation
                     # and in milliseconds
                     if first_timestamp is None and 'timestamp' in params and \
@@ -163,6 +198,8 @@ class DevToolsParser(object):
                                 request_id = new_id
                             request['id'] = request_id
                             raw_requests[request_id] = dict(request)
+                            if 'frame_id' not in request:
+                                needs_main_frame.append(raw_requests[request_id])
                         elif request_id in raw_requests:
                             request = raw_requests[request_id]
                             if 'endTime' not in request or timestamp > request['endTime']:
@@ -221,6 +258,12 @@ class DevToolsParser(object):
                             'domContentLoadedEventStart' not in page_data:
                         page_data['domContentLoadedEventStart'] = params['timestamp']
                         page_data['domContentLoadedEventEnd'] = params['timestamp']
+            if untimed_main_frame is not None:
+                for request in needs_main_frame:
+                    request['frame_id'] = untimed_main_frame
+                if 'main_frame' not in page_data:
+                    page_data['main_frame'] = untimed_main_frame
+            needs_main_frame = None
             # go through and error-out any requests that started but never got
             # a response or error
             if end_timestamp is not None:
@@ -261,6 +304,91 @@ class DevToolsParser(object):
         return net_requests, page_data
 
 
+    def load_devtools_events(self):
+        """Iterate over the raw devtools events in timestamp order"""
+        if self.devtools_index is not None and os.path.isfile(self.devtools_index):
+            return self.read_indexed_events()
+        return self.read_devtools_events()
+
+    def read_devtools_events(self):
+        """Stream the json array of events written by the agent (one event per line)
+        through a bounded reorder window.  Any other layout is loaded and sorted."""
+        _, ext = os.path.splitext(self.devtools_file)
+        if ext.lower() == '.gz':
+            f_in = gzip.open(self.devtools_file, 'rb')
+        else:
+            f_in = open(self.devtools_file, 'r')
+        with f_in:
+            if f_in.readline().rstrip() not in ['[{}', '[{},']:
+                f_in.seek(0)
+                raw_events = json.load(f_in)
+                # sort all of the events by timestamp
+                if raw_events is not None and len(raw_events):
+                    raw_events.sort(key=lambda x: x['params']['timestamp'] if \
+                        ('params' in x and 'timestamp' in x['params']) else 0)
+                    for raw_event in raw_events:
+                        yield raw_event
+                return
+            # Events are held back in a window and sorted in batches (the sort is stable so
+            # events with the same timestamp stay in the order they arrived).  Once twice
+            # the window is pending the earliest half is released.
+            pending = []
+            last_timestamp = None
+            late_events = 0
+            for line in json.iter_lines(f_in):
+                if line[-1:] == ',':
+                    line = line[:-1]
+                if not line or line == ']':
+                    continue
+                try:
+                    raw_event = json.loads(line)
+                except Exception:
+                    logging.warning("Invalid devtools event: %s", line[:100])
+                    continue
+                if 'params' in raw_event and 'timestamp' in raw_event['params']:
+                    pending.append((raw_event['params']['timestamp'], raw_event))
+                    if len(pending) >= 2 * self.reorder_window:
+                        pending.sort(key=operator.itemgetter(0))
+                        ready = pending[:self.reorder_window]
+                        pending = pending[self.reorder_window:]
+                        if last_timestamp is not None and ready[0][0] < last_timestamp:
+                            late_events += len([entry for entry in ready
+                                                if entry[0] < last_timestamp])
+                        last_timestamp = ready[-1][0]
+                        for entry in ready:
+                            yield entry[1]
+                        ready = None
+                else:
+                    yield raw_event
+            pending.sort(key=operator.itemgetter(0))
+            for entry in pending:
+                yield entry[1]
+            if late_events:
+                logging.warning("%d devtools events arrived outside of the %d event reorder "
+                                "window", late_events, self.reorder_window)
+
+    def read_indexed_events(self):
+        """Stream the events from the length-prefixed devtools log using the sidecar
+        index (offset and timestamp of each event) to visit them in timestamp order"""
+        with open(self.devtools_index, 'rb') as f_in:
+            index = json.load(f_in)
+        log_file = os.path.join(os.path.dirname(self.devtools_index), index['log'])
+        # (timestamp, offset) keeps events with the same timestamp in the order they arrived
+        records = [(entry[1], entry[0]) for entry in index['events']]
+        for request_id in index['requests']:
+            records.extend([(entry[1], entry[0]) for entry in index['requests'][request_id]])
+        index = None
+        records.sort()
+        with open(log_file, 'rb') as f_in:
+            position = 0
+            for _, offset in records:
+                if offset != position:
+                    f_in.seek(offset)
+                length = struct.unpack('>I', f_in.read(4))[0]
+                data = f_in.read(length + 1)
+                position = offset + length + 5
+                yield json.loads(data)
+
     def process_requests(self, raw_requests, raw_page_data):
         """Process the raw requests into high-level requests"""
         self.result = {'pageData': {}, 'requests': []}
@@ -543,20 +671,7 @@ class DevToolsParser(object):
         """Merge the data from the netlog requests file"""
         page_data = self.result['pageData']
         requests = self.result['requests']
-        mapping = {'dns_start': 'dns_start',
-                   'dns_end': 'dns_end',
-                   'connect_start': 'connect_start',
-                   'connect_end': 'connect_end',
-                   'ssl_start': 'ssl_start',
-                   'ssl_end': 'ssl_end',
-                   'start': 'load_start',
-                   'priority': 'priority',
-                   'protocol': 'protocol',
-                   'socket': 'socket',
-                   'stream_id': 'http2_stream_id',
-                   'parent_stream_id': 'http2_stream_dependency',
-                   'weight': 'http2_stream_weight',
-                   'exclusive': 'http2_stream_exclusive'}
+        mapping = NETLOG_FIELDS
         if self.netlog_requests_file is not None and os.path.isfile(self.netlog_requests_file):
             _, ext = os.path.splitext(self.netlog_requests_file)
             if ext.lower() == '.gz':
@@ -565,28 +680,7 @@ class DevToolsParser(object):
                 f_in = open(self.netlog_requests_file, 'r')
             netlog = json.load(f_in)
             f_in.close()
-            for request in requests:
-                if 'full_url' in request:
-                    for entry in netlog:
-                        if 'url' in entry and 'start' in entry and 'claimed' not in entry and \
-                                entry['url'] == request['full_url']:
-                            entry['claimed'] = True
-                            for key in mapping:
-                                if key in entry:
-                                    if re.match(r'^\d+\.?(\d+)?$', str(entry[key]).strip()):
-                                        request[mapping[key]] = \
-                                                int(round(float(str(entry[key]).strip())))
-                                    else:
-                                        request[mapping[key]] = str(entry[key])
-                            if 'first_byte' in entry:
-                                request['ttfb_ms'] = int(round(entry['first_byte'] -
-                                                               entry['start']))
-                            if 'end' in entry:
-                                request['load_ms'] = int(round(entry['end'] -
-                                                               entry['start']))
-                            if 'pushed' in entry and entry['pushed']:
-                                request['was_pushed'] = 1
-                            break
+            self.merge_netlog_entries(requests, netlog)
             # Add any requests we didn't know about
             index = 0
             for entry in netlog:
@@ -698,6 +792,35 @@ class DevToolsParser(object):
                         break
                 index += 1
 
+    def merge_netlog_entries(self, requests, netlog):
+        """Copy the netlog data to the matching requests, marking the entries claimed"""
+        # Index the netlog entries by URL (in file order) so each request claims
+        # the first unclaimed entry for its URL without scanning the whole list
+        entries_by_url = {}
+        for entry in netlog:
+            if 'url' in entry and 'start' in entry:
+                if entry['url'] not in entries_by_url:
+                    entries_by_url[entry['url']] = collections.deque()
+                entries_by_url[entry['url']].append(entry)
+        fields = NETLOG_FIELDS.items()
+        for request in requests:
+            if 'full_url' in request and request['full_url'] in entries_by_url:
+                entries = entries_by_url[request['full_url']]
+                if entries:
+                    entry = entries.popleft()
+                    entry['claimed'] = True
+                    for key, field in fields:
+                        if key in entry:
+                            request[field] = netlog_value(entry[key])
+                    if 'first_byte' in entry:
+                        request['ttfb_ms'] = int(round(entry['first_byte'] -
+                                                       entry['start']))
+                    if 'end' in entry:
+                        request['load_ms'] = int(round(entry['end'] -
+                                                       entry['start']))
+                    if 'pushed' in entry and entry['pushed']:
+                        request['was_pushed'] = 1
+
     def process_page_data(self):
         """Walk through the sorted requests and generate the page-level stats"""
         page_data = self.result['pageData']
@@ -853,6 +976,116 @@ class DevToolsParser(object):
                 page_data['score_progressive_jpeg'] = int(round(progressive_bytes * 100 /
                                                                 progressive_total_bytes))
 
+##########################################################################
+#   Benchmark
+##########################################################################
+def reference_merge_netlog_entries(requests, netlog):
+    """The previous merge, a scan of the whole netlog for every request (kept to
+    check and time merge_netlog_entries against)"""
+    for request in requests:
+        if 'full_url' in request:
+            for entry in netlog:
+                if 'url' in entry and 'start' in entry and 'claimed' not in entry and \
+                        entry['url'] == request['full_url']:
+                    entry['claimed'] = True
+                    for key in NETLOG_FIELDS:
+                        if key in entry:
+                            if re.match(r'^\d+\.?(\d+)?$', str(entry[key]).strip()):
+                                request[NETLOG_FIELDS[key]] = \
+                                        int(round(float(str(entry[key]).strip())))
+                            else:
+                                request[NETLOG_FIELDS[key]] = str(entry[key])
+                    if 'first_byte' in entry:
+                        request['ttfb_ms'] = int(round(entry['first_byte'] -
+                                                       entry['start']))
+                    if 'end' in entry:
+                        request['load_ms'] = int(round(entry['end'] -
+                                                       entry['start']))
+                    if 'pushed' in entry and entry['pushed']:
+                        request['was_pushed'] = 1
+                    break
+
+
+def generate_netlog_page(count, seed=0):
+    """Synthetic page of count requests and its netlog: duplicate URLs, 5% of the
+    requests missing from the netlog, 300 netlog-only requests and field values
+    of mixed types"""
+    import random
+    rand = random.Random(seed)
+    urls = ['https://www{0:d}.example.com/resource/{1:d}.js?v={2:d}'.format(
+        index % 40, index, index % 7) for index in xrange(max(1, count * 7 / 10))]
+    requests = []
+    netlog = []
+    for index in xrange(count):
+        url = urls[rand.randint(0, len(urls) - 1)]
+        start = index * 2.5 + rand.random()
+        requests.append({'id': '1000.{0:d}'.format(index), 'full_url': url,
+                         'load_start': int(start), 'frame_id': 'F1', 'responseCode': 200})
+        if rand.random() < 0.05:
+            continue
+        entry = {'url': url, 'start': start, 'first_byte': start + rand.random() * 100,
+                 'end': start + 100 + rand.random() * 500, 'priority': 'HIGHEST',
+                 'protocol': rand.choice(['h2', 'http/1.1', 'quic/1+spdy/3']),
+                 'socket': rand.randint(1, 50), 'stream_id': rand.randint(1, 999),
+                 'weight': str(rand.randint(1, 256)), 'exclusive': rand.choice([True, False]),
+                 'dns_start': ' {0:0.3f} '.format(start - 10), 'dns_end': start - 5,
+                 'connect_start': -1, 'connect_end': -1}
+        if rand.random() < 0.01:
+            entry['pushed'] = True
+        netlog.append(entry)
+    for index in xrange(300):
+        start = count * 2.5 + index
+        netlog.append({'url': 'https://other.example.com/netlog/{0:d}'.format(index),
+                       'start': start, 'end': start + 50, 'bytes_in': 1024,
+                       'response_headers': ['HTTP/1.1 200 OK', 'content-type: text/plain']})
+    netlog.sort(key=lambda entry: entry['start'])
+    return requests, netlog
+
+
+def benchmark(count, iterations):
+    """Time the netlog merge on a synthetic page against the previous linear scan
+    and check that both produce the same requests"""
+    import copy
+    import tempfile
+    requests, netlog = generate_netlog_page(count)
+    print('{0:d} requests, {1:d} netlog entries'.format(len(requests), len(netlog)))
+    results = {}
+    parser = DevToolsParser({'devtools': None, 'out': None})
+    for name, merge in [('linear scan', reference_merge_netlog_entries),
+                        ('url index', parser.merge_netlog_entries)]:
+        best = None
+        for _ in range(iterations):
+            run_requests = copy.deepcopy(requests)
+            run_netlog = copy.deepcopy(netlog)
+            start = time.time()
+            merge(run_requests, run_netlog)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results[name] = run_requests
+        print('    {0:28s} {1:9.3f} s'.format('merge (' + name + ')', best))
+    if results['linear scan'] != results['url index']:
+        print('    MISMATCH: the merged requests differ')
+        return False
+    # Full process_netlog_requests() including loading the netlog file
+    handle, path = tempfile.mkstemp(suffix='.json')
+    try:
+        with os.fdopen(handle, 'w') as f_out:
+            json.dump(netlog, f_out)
+        best = None
+        for _ in range(iterations):
+            parser = DevToolsParser({'devtools': None, 'netlog': path, 'out': None})
+            parser.result = {'pageData': {'main_frame': 'F1'},
+                             'requests': copy.deepcopy(requests)}
+            start = time.time()
+            parser.process_netlog_requests()
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print('    {0:28s} {1:9.3f} s'.format('process_netlog_requests', best))
+    finally:
+        os.remove(path)
+    return True
+
+
 def main():
     """Main entry point"""
     import argparse
@@ -862,11 +1095,21 @@ def main():
                         help="Increase verbosity (specify multiple times for more)" \
                              ". -vvvv for full debug output.")
     parser.add_argument('-d', '--devtools', help="Input devtools file.")
+    parser.add_argument('-i', '--index',
+                        help="Input devtools log index file (optional, streams the "
+                             "length-prefixed devtools log instead of loading the json).")
+    parser.add_argument('-w', '--window', type=int,
+                        help="Number of events to hold back to put the devtools events in "
+                             "timestamp order (defaults to 10000).")
     parser.add_argument('-n', '--netlog', help="Input netlog requests file (optional).")
     parser.add_argument('-p', '--optimization', help="Input optimization results file (optional).")
     parser.add_argument('-c', '--cached', action='store_true', default=False,
                         help="Test was of a cached page.")
     parser.add_argument('-o', '--out', help="Output requests json file.")
+    parser.add_argument('-b', '--benchmark', type=int, nargs='?', const=5000,
+                        help="Time the netlog merge on a synthetic page with the given "
+                             "number of requests (defaults to 5000) instead of processing "
+                             "a devtools file.")
     options, _ = parser.parse_known_args()
 
     # Set up logging
@@ -882,16 +1125,23 @@ def main():
     logging.basicConfig(
         level=log_level, format="%(asctime)s.%(msecs)03d - %(message)s", datefmt="%H:%M:%S")
 
+    if options.benchmark:
+        if not benchmark(options.benchmark, 3):
+            exit(1)
+        return
+
     if not options.devtools or not options.out:
         parser.error("Input devtools or output file is not specified.")
 
     start = time.time()
     opt = {'devtools': options.devtools,
+           'devtools_index': options.index,
+           'reorder_window': options.window,
            'netlog': options.netlog,
            'optimization': options.optimization,
            'cached': options.cached,
            'out': options.out}
-    devtools = DevTools(opt)
+    devtools = DevToolsParser(opt)
     devtools.process()
     end = time.time()
     elapsed = end - start
@@ -22,9 +22,9 @@ import re
 import urlparse
 import monotonic
 try:
-    import ujson as json
-except BaseException:
-    import json
+    from . import json_codec as json
+except (ImportError, ValueError):
+    import json_codec as json
 
 class FirefoxLogParser(object):
     """Handle parsing of firefox logs"""
@@ -0,0 +1,229 @@
+#!/usr/bin/python
+"""
+Copyright 2017 Google Inc. All Rights Reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+JSON encoding and decoding for the agent and the support scripts.
+The fastest installed backend is picked at import time (orjson, ujson, simplejson
+then the standard library).  Set WPT_JSON_BACKEND to force one of them or call
+set_backend().  Run this file directly to benchmark the backends on recorded
+artifacts.
+
+Output format: unlike json.dumps() with its default arguments, dumps() and dump()
+write compact json with no whitespace after the ',' and ':' separators, whichever
+backend is used (the fast encoders can't add it).  The documents decode to the same
+values but the artifacts are smaller and not byte-for-byte identical to the ones
+written by the standard library.  orjson also writes non-ASCII characters as UTF-8
+instead of \\u escapes.  Pass indent or sort_keys to get the standard library output.
+
+load() decodes a whole document in memory.  Only json arrays written with one entry
+per line (dump_array()) can be decoded incrementally, with iter_array_lines().
+"""
+import gzip
+import logging
+import os
+import time
+
+READ_SIZE = 1024 * 1024
+# Backends in order of preference
+BACKENDS = ['orjson', 'ujson', 'simplejson', 'json']
+
+
+class Backend(object):
+    """Adapter that gives every json library the same loads/dumps interface"""
+    def __init__(self, name):
+        self.name = name
+        self.module = __import__(name)
+        self.orjson_options = None
+        if name == 'orjson':
+            self.orjson_options = self.module.OPT_NON_STR_KEYS | \
+                self.module.OPT_SERIALIZE_NUMPY
+        elif name == 'simplejson' and not self.module._speedups:
+            raise ImportError('simplejson is missing the C speedups')
+
+    def loads(self, data):
+        """Decode a json string"""
+        return self.module.loads(data)
+
+    def dumps(self, obj):
+        """Encode to a compact json string"""
+        if self.orjson_options is not None:
+            return self.module.dumps(obj, option=self.orjson_options).decode('utf-8')
+        if self.name == 'ujson':
+            return self.module.dumps(obj, escape_forward_slashes=False)
+        return self.module.dumps(obj, separators=(',', ':'))
+
+
+def load_backend(name=None):
+    """Load the named backend or the fastest one that is installed"""
+    names = [name] if name else BACKENDS
+    for backend_name in names:
+        try:
+            return Backend(backend_name)
+        except (ImportError, AttributeError):
+            pass
+    if name:
+        logging.warning("JSON backend %s is not available, using the standard library", name)
+    return Backend('json')
+
+BACKEND = load_backend(os.environ.get('WPT_JSON_BACKEND'))
+# The standard library handles the odd things the fast encoders refuse (huge ints,
+# formatted output)
+STDLIB = Backend('json')
+
+
+def set_backend(name):
+    """Switch the backend used by the module-level functions"""
+    global BACKEND
+    BACKEND = load_backend(name)
+    return BACKEND.name
+
+
+def loads(data):
+    """Decode a json string"""
+    return BACKEND.loads(data)
+
+
+def dumps(obj, indent=None, sort_keys=False):
+    """Encode to a compact json string (no whitespace after the separators, unlike
+    the standard library's defaults).  Setting indent or sort_keys uses the standard
+    library with its default separators."""
+    if indent is None and not sort_keys:
+        try:
+            return BACKEND.dumps(obj)
+        except (TypeError, OverflowError):
+            pass
+    return STDLIB.module.dumps(obj, indent=indent, sort_keys=sort_keys)
+
+
+def load(f_in):
+    """Decode a json document from a file object.  This is not a streaming decode,
+    the whole document is read into memory first (in large blocks so gzip files are
+    not read a line at a time).  Use iter_array_lines() for one-entry-per-line
+    arrays."""
+    chunks = []
+    while True:
+        chunk = f_in.read(READ_SIZE)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    data = chunks[0][:0].join(chunks) if chunks else ''
+    chunks = None
+    return BACKEND.loads(data)
+
+
+def dump(obj, f_out, indent=None, sort_keys=False):
+    """Encode a json document to a file object"""
+    f_out.write(dumps(obj, indent=indent, sort_keys=sort_keys))
+
+
+def dump_array(items, f_out):
+    """Stream an iterable to a file object as a json array with one entry per line
+    (the layout that iter_array_lines() reads back without loading the whole array)"""
+    separator = '['
+    for item in items:
+        f_out.write(separator)
+        f_out.write(dumps(item))
+        separator = ',\n'
+    f_out.write('[]' if separator == '[' else '\n]')
+
+
+def iter_lines(f_in):
+    """Split a file object into lines a block at a time (much faster than readline on
+    a gzip file)"""
+    remainder = ''
+    while True:
+        block = f_in.read(READ_SIZE)
+        if not block:
+            break
+        lines = (remainder + block).split('\n')
+        remainder = lines.pop()
+        for line in lines:
+            yield line.rstrip()
+    if remainder:
+        yield remainder.rstrip()
+
+
+def iter_array_lines(f_in):
+    """Decode the entries of a json array that has one entry per line, one at a time.
+    Lines that are not valid json are logged and skipped."""
+    for line in iter_lines(f_in):
+        if line[:1] == '[':
+            line = line[1:]
+        if line[-1:] == ',':
+            line = line[:-1]
+        if not line or line == ']':
+            continue
+        try:
+            yield BACKEND.loads(line)
+        except Exception:
+            logging.warning("Invalid json entry: %s", line[:100])
+
+
+##########################################################################
+#   Benchmark
+##########################################################################
+def open_artifact(path, mode):
+    """Open a (possibly gzipped) artifact"""
+    _, ext = os.path.splitext(path)
+    if ext.lower() == '.gz':
+        return gzip.open(path, mode + 'b')
+    return open(path, mode)
+
+
+def benchmark(files, iterations):
+    """Time the decode and encode of each artifact with every installed backend"""
+    backends = []
+    for name in BACKENDS:
+        try:
+            backends.append(Backend(name))
+        except (ImportError, AttributeError):
+            pass
+    for path in files:
+        with open_artifact(path, 'r') as f_in:
+            data = f_in.read()
+        if not isinstance(data, str):
+            data = data.decode('utf-8')
+        print('{0} ({1:d} bytes)'.format(os.path.basename(path), len(data)))
+        for backend in backends:
+            try:
+                start = time.time()
+                for _ in range(iterations):
+                    obj = backend.loads(data)
+                decode_time = (time.time() - start) / iterations
+                start = time.time()
+                for _ in range(iterations):
+                    backend.dumps(obj)
+                encode_time = (time.time() - start) / iterations
+                print('    {0:12s} decode {1:9.2f} ms   encode {2:9.2f} ms'.format(
+                    backend.name, decode_time * 1000.0, encode_time * 1000.0))
+            except Exception as err:
+                print('    {0:12s} failed: {1}'.format(backend.name, err))
+            obj = None
+
+
+def main():
+    """Main entry-point when running on the command-line"""
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark the json backends on artifacts.',
+                                     prog='json_codec')
+    parser.add_argument('-i', '--iterations', type=int, default=3,
+                        help="Number of times to decode and encode each file (default 3).")
+    parser.add_argument('files', nargs='+',
+                        help="Recorded artifacts (.json or .json.gz) to benchmark.")
+    options, _ = parser.parse_known_args()
+    benchmark(options.files, max(1, options.iterations))
+
+if '__main__' == __name__:
+    main()
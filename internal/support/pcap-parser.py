@@ -15,13 +15,17 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 import gzip
-import json
 import logging
 import math
 import os
 import struct
 import time
 
+try:
+  from . import json_codec as json
+except (ImportError, ValueError):
+  import json_codec as json
+
 #Globals
 options = None
 
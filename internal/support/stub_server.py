@@ -0,0 +1,210 @@
+#!/usr/bin/python
+"""
+Copyright 2017 Google Inc. All Rights Reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import cgi
+import logging
+import os
+import threading
+import time
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+try:
+    from . import json_codec as json
+except (ImportError, ValueError):
+    import json_codec as json
+
+########################################################################################
+#   Minimal stand-in for the WebPageTest server work API for testing the agent locally.
+#   Serves /work/getwork.php (with long-poll support through the wait parameter),
+#   accepts /work/resultimage.php and /work/workdone.php uploads and lets jobs be
+#   queued at runtime with /work/addjob.php?url=<url>[&runs=N&browser=B&location=L]
+#
+#   python internal/support/stub_server.py --port 8888 --url https://www.google.com/
+#   python wptagent.py --server http://127.0.0.1:8888/work/ --location Test --longpoll 30
+########################################################################################
+class JobQueue(object):
+    """Pending jobs per location"""
+    def __init__(self):
+        self.jobs = {}
+        self.count = 0
+        self.condition = threading.Condition()
+
+    def add(self, job, location):
+        """Queue a job for the given location (None for any location)"""
+        with self.condition:
+            self.count += 1
+            if 'Test ID' not in job:
+                job['Test ID'] = time.strftime('%y%m%d_') + 'STUB_{0:d}'.format(self.count)
+            if 'browser' not in job:
+                job['browser'] = 'Chrome'
+            if 'runs' not in job:
+                job['runs'] = 1
+            if 'fvonly' not in job:
+                job['fvonly'] = 1
+            if location not in self.jobs:
+                self.jobs[location] = []
+            self.jobs[location].append(job)
+            self.condition.notify_all()
+        logging.info('Queued job %s for location %s', job['Test ID'], location)
+
+    def get(self, location, wait):
+        """Get the next job for the location, waiting up to wait seconds for one"""
+        end_time = time.time() + wait
+        with self.condition:
+            while True:
+                for key in [location, None]:
+                    if key in self.jobs and self.jobs[key]:
+                        return self.jobs[key].pop(0)
+                remaining = end_time - time.time()
+                if remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Request handler for the work API"""
+    def get_params(self):
+        """Parse the query parameters"""
+        params = {}
+        query = urlparse.urlparse(self.path).query
+        for key, values in urlparse.parse_qs(query).iteritems():
+            params[key] = values[0]
+        return params
+
+    def send(self, status, body='', content_type='text/plain'):
+        """Send a complete response"""
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        """getwork.php and addjob.php"""
+        path = urlparse.urlparse(self.path).path
+        params = self.get_params()
+        if path.endswith('/getwork.php'):
+            wait = 0
+            if 'wait' in params:
+                try:
+                    wait = min(int(params['wait']), self.server.options.maxwait)
+                except Exception:
+                    pass
+            job = self.server.jobs.get(params.get('location'), wait)
+            if job is None:
+                self.send(200)
+            else:
+                logging.info('Assigned job %s to %s', job['Test ID'], params.get('pc'))
+                self.send(200, json.dumps(job), 'application/json')
+        elif path.endswith('/addjob.php') and 'url' in params:
+            job = {'url': params['url']}
+            if 'runs' in params:
+                job['runs'] = int(params['runs'])
+            if 'browser' in params:
+                job['browser'] = params['browser']
+            self.server.jobs.add(job, params.get('location'))
+            self.send(200, json.dumps(job), 'application/json')
+        else:
+            self.send(404)
+
+    def do_POST(self):
+        """resultimage.php and workdone.php uploads"""
+        path = urlparse.urlparse(self.path).path
+        params = self.get_params()
+        if path.endswith('/resultimage.php') or path.endswith('/workdone.php'):
+            size = 0
+            filename = None
+            if self.headers.getheader('content-type', '').startswith('multipart/form-data'):
+                form = cgi.FieldStorage(fp=self.rfile, headers=self.headers,
+                                        environ={'REQUEST_METHOD': 'POST'})
+                if 'file' in form and form['file'].filename:
+                    data = form['file'].value
+                    size = len(data)
+                    filename = os.path.basename(form['file'].filename)
+                    if path.endswith('/workdone.php'):
+                        filename = '{0}_{1}_{2}_{3}'.format(params.get('id'), params.get('run'),
+                                                            params.get('cached'), filename)
+                    if self.server.options.out is not None:
+                        out_dir = os.path.join(self.server.options.out,
+                                               str(params.get('id')))
+                        if not os.path.isdir(out_dir):
+                            os.makedirs(out_dir)
+                        with open(os.path.join(out_dir, filename), 'wb') as f_out:
+                            f_out.write(data)
+            else:
+                length = int(self.headers.getheader('content-length', 0))
+                if length:
+                    self.rfile.read(length)
+            logging.info('%s: %s %s (%d bytes)', os.path.basename(path), params.get('id'),
+                         filename, size)
+            if path.endswith('/workdone.php') and 'done' in params:
+                logging.info('Test %s complete', params.get('id'))
+            self.send(200)
+        else:
+            self.send(404)
+
+    def log_message(self, fmt, *args):
+        """Route the request log through logging"""
+        logging.debug(fmt, *args)
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    """Threaded HTTP server (long-polls block a thread each)"""
+    daemon_threads = True
+
+def main():
+    """Startup and initialization"""
+    import argparse
+    parser = argparse.ArgumentParser(description='Local stub for the WebPageTest work API.',
+                                     prog='stub_server')
+    parser.add_argument('-v', '--verbose', action='count',
+                        help="Increase verbosity (specify multiple times for more).")
+    parser.add_argument('--port', type=int, default=8888, help="Port to listen on.")
+    parser.add_argument('--url', action='append',
+                        help="URL to queue a test for (can be specified multiple times).")
+    parser.add_argument('--job', action='append',
+                        help="JSON file with a job to queue (can be specified multiple times).")
+    parser.add_argument('--location', help="Location to queue the jobs for (defaults to any).")
+    parser.add_argument('--out', help="Directory to store the uploaded results in.")
+    parser.add_argument('--maxwait', type=int, default=60,
+                        help="Maximum time to hold a long-poll request (defaults to 60).")
+    options = parser.parse_args()
+
+    log_level = logging.CRITICAL
+    if options.verbose == 1:
+        log_level = logging.INFO
+    elif options.verbose >= 2:
+        log_level = logging.DEBUG
+    logging.basicConfig(level=log_level, format="%(asctime)s.%(msecs)03d - %(message)s",
+                        datefmt="%H:%M:%S")
+
+    server = StubServer(('', options.port), StubHandler)
+    server.options = options
+    server.jobs = JobQueue()
+    if options.url:
+        for url in options.url:
+            server.jobs.add({'url': url}, options.location)
+    if options.job:
+        for job_file in options.job:
+            with open(job_file, 'rb') as f_in:
+                server.jobs.add(json.load(f_in), options.location)
+    print "Serving the work API on http://127.0.0.1:{0:d}/work/".format(options.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if '__main__' == __name__:
+    main()
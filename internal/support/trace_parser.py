@@ -14,19 +14,231 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
+import collections
 import gzip
+import heapq
 import logging
 import math
 import os
 import re
 import time
 import urlparse
+from array import array
 
-# try a fast json parser if it is installed
+# shared json codec (uses the fastest json library that is installed)
 try:
-    import ujson as json
+    from . import json_codec as json
+except (ImportError, ValueError):
+    import json_codec as json
+
+# use numpy for the CPU time slices if it is available
+try:
+    import numpy as np
 except BaseException:
-    import json
+    np = None
+
+##########################################################################
+#   Netlog source graph
+##########################################################################
+class NetlogChunks(object):
+    """Timeline of the bytes read or written in each chunk, packed into columns.
+    With a bucket size, chunks that land in the same time bucket as the previous one are
+    coalesced into it (keeping the time of the last chunk)."""
+    __slots__ = ['ts', 'bytes']
+    def __init__(self):
+        self.ts = array('d')
+        self.bytes = array('l')
+
+    def __len__(self):
+        return len(self.ts)
+
+    def add(self, timestamp, byte_count, bucket=None):
+        """Record a chunk"""
+        if bucket and len(self.ts) and \
+                int(timestamp // bucket) == int(self.ts[-1] // bucket):
+            self.ts[-1] = timestamp
+            self.bytes[-1] += byte_count
+        else:
+            self.ts.append(timestamp)
+            self.bytes.append(byte_count)
+
+    def to_list(self):
+        """The chunks as a list of {'ts', 'bytes'} dicts"""
+        return [{'ts': int(timestamp) if timestamp.is_integer() else timestamp,
+                 'bytes': byte_count}
+                for timestamp, byte_count in zip(self.ts, self.bytes)]
+
+    def to_columns(self):
+        """The chunks as parallel 'ts' and 'bytes' lists"""
+        return {'ts': [int(timestamp) if timestamp.is_integer() else timestamp
+                       for timestamp in self.ts],
+                'bytes': self.bytes.tolist()}
+
+
+class NetlogUrlRequest(object):
+    """URL_REQUEST source (data holds the fields that are reported for the request)"""
+    __slots__ = ['id', 'data', 'stream_job', 'h2_session']
+    def __init__(self, source_id):
+        self.id = source_id
+        self.data = {'bytes_in': 0, 'chunks': NetlogChunks()}
+        self.stream_job = None
+        self.h2_session = None
+
+
+class NetlogStreamJob(object):
+    """HTTP_STREAM_JOB source (links a request to the socket or h2 session it used)"""
+    __slots__ = ['id', 'url_request', 'socket', 'h2_session']
+    def __init__(self, source_id):
+        self.id = source_id
+        self.url_request = None
+        self.socket = None
+        self.h2_session = None
+
+
+class NetlogConnectJob(object):
+    """CONNECT_JOB source (links a socket to its DNS lookup)"""
+    __slots__ = ['id', 'socket', 'dns']
+    def __init__(self, source_id):
+        self.id = source_id
+        self.socket = None
+        self.dns = None
+
+
+class NetlogSocket(object):
+    """SOCKET source"""
+    __slots__ = ['id', 'data', 'dns', 'claimed']
+    def __init__(self, source_id):
+        self.id = source_id
+        self.data = {'bytes_out': 0, 'bytes_in': 0,
+                     'chunks_out': NetlogChunks(), 'chunks_in': NetlogChunks()}
+        self.dns = None
+        self.claimed = False
+
+
+class NetlogH2Session(object):
+    """HTTP2_SESSION source"""
+    __slots__ = ['id', 'socket', 'streams']
+    def __init__(self, source_id):
+        self.id = source_id
+        self.socket = None
+        self.streams = {}
+
+    def get_stream(self, stream_id):
+        """Get (or create) the stream with the given ID"""
+        stream = self.streams.get(stream_id)
+        if stream is None:
+            stream = NetlogH2Stream()
+            self.streams[stream_id] = stream
+        return stream
+
+
+class NetlogH2Stream(object):
+    """One stream of a h2 session (data holds the fields that get copied to the request)"""
+    __slots__ = ['data', 'url_request']
+    def __init__(self):
+        self.data = {'bytes_in': 0, 'chunks': NetlogChunks()}
+        self.url_request = None
+
+
+class NetlogDns(object):
+    """HOST_RESOLVER_IMPL_JOB source"""
+    __slots__ = ['id', 'host', 'start', 'end', 'claimed']
+    def __init__(self, source_id):
+        self.id = source_id
+        self.host = None
+        self.start = None
+        self.end = None
+        self.claimed = False
+
+
+class NetlogGraph(object):
+    """The netlog sources by type and ID.  Edges between the sources are recorded as
+    object references when the events that create them are seen and the derived request
+    fields (socket, h2 session, stream details) are resolved once all of the events are in
+    so the order the sources are bound in does not matter."""
+    def __init__(self):
+        self.url_request = {}
+        self.stream_job = {}
+        self.connect_job = {}
+        self.socket = {}
+        self.h2_session = {}
+        self.dns = {}
+        # url -> requests that have not started (candidates for adopting a pushed stream)
+        self.pending = {}
+        self.next_request_id = 1000000
+
+    @staticmethod
+    def get_source(table, node_class, source_id):
+        """Get (or create) the source with the given ID"""
+        node = table.get(source_id)
+        if node is None:
+            node = node_class(source_id)
+            table[source_id] = node
+        return node
+
+    def new_request_id(self):
+        """Allocate an ID for a request that is not a netlog source of its own"""
+        request_id = self.next_request_id
+        self.next_request_id += 1
+        return request_id
+
+    def set_request_url(self, request, url):
+        """Set the request URL and index it if the request has not started yet"""
+        request.data['url'] = url
+        if 'start' not in request.data:
+            if url not in self.pending:
+                self.pending[url] = collections.deque()
+            self.pending[url].append(request)
+
+    def claim_pending_request(self, url):
+        """Remove and return the oldest request for the url that has not started.
+        Entries that have since started or changed their URL are dropped on the way."""
+        queue = self.pending.get(url)
+        while queue:
+            request = queue.popleft()
+            if request.data.get('url') == url and 'start' not in request.data and \
+                    'phantom' not in request.data:
+                return request
+        return None
+
+    def resolve(self):
+        """Resolve the deferred edges into the request and socket fields"""
+        for connect_job in self.connect_job.itervalues():
+            if connect_job.socket is not None and connect_job.dns is not None:
+                connect_job.socket.dns = connect_job.dns
+        for request in self.url_request.itervalues():
+            socket = None
+            h2_session = request.h2_session
+            if request.stream_job is not None:
+                socket = request.stream_job.socket
+                if request.stream_job.h2_session is not None:
+                    h2_session = request.stream_job.h2_session
+            if socket is None and h2_session is not None:
+                socket = h2_session.socket
+            if socket is not None:
+                request.data['socket'] = socket.id
+            if h2_session is not None:
+                request.data['h2_session'] = h2_session.id
+                if 'stream_id' in request.data:
+                    stream = h2_session.streams.get(request.data['stream_id'])
+                    if stream is not None:
+                        self.copy_stream(stream.data, request.data)
+
+    @staticmethod
+    def copy_stream(stream, request):
+        """Copy the http/2 stream details over to the request"""
+        for key in ['request_headers', 'response_headers', 'exclusive',
+                    'parent_stream_id', 'weight']:
+            if key in stream:
+                request[key] = stream[key]
+        if 'first_byte' not in request and 'first_byte' in stream:
+            request['first_byte'] = stream['first_byte']
+        if 'end' not in request and 'end' in stream:
+            request['end'] = stream['end']
+        if stream['bytes_in'] > request['bytes_in']:
+            request['bytes_in'] = stream['bytes_in']
+            request['chunks'] = stream['chunks']
+
 
 ##########################################################################
 #   Trace processing
@@ -51,10 +263,20 @@ class Trace():
         self.cpu = {'main_thread': None}
         self.feature_usage = None
         self.feature_usage_start_time = None
-        self.netlog = {'bytes_in': 0, 'bytes_out': 0, 'next_request_id': 1000000}
+        self.netlog = NetlogGraph()
         self.netlog_requests = None
+        # Write the netlog chunk timelines as columns instead of a list of dicts
+        self.netlog_columns = False
+        # Coalesce the netlog chunks into buckets of this many microseconds
+        self.netlog_bucket = None
         self.v8stats = None
         self.v8stack = {}
+        self.reorder_window = None
+        self.reorder_sequence = 0
+        self.reorder_last_ts = None
+        self.reorder_late_events = 0
+        self.vectorize_slices = np is not None
+        self.slice_ops = None
         return
 
     ##########################################################################
@@ -101,10 +323,21 @@ class Trace():
     ##########################################################################
     #   Top-level processing
     ##########################################################################
-    def Process(self, trace):
+    def Process(self, trace, reorder_window=None):
+        """Load and process the given trace file.
+
+        By default all of the events are loaded and sorted before processing.
+        If a reorder_window is provided the trace is streamed instead and only
+        that many events are held in memory at a time (in a heap ordered by
+        timestamp).  Traces written by the agent are nearly sorted so a
+        window of a few thousand events produces identical results."""
         f = None
         line_mode = False
+        vectorize_slices = self.vectorize_slices
         self.__init__()
+        self.vectorize_slices = vectorize_slices
+        if reorder_window is not None and reorder_window > 0:
+            self.reorder_window = int(reorder_window)
         logging.debug("Loading trace: %s", trace)
         try:
             file_name, ext = os.path.splitext(trace)
@@ -130,7 +363,9 @@ class Trace():
         self.ProcessTraceEvents()
 
     def ProcessTimeline(self, timeline):
+        vectorize_slices = self.vectorize_slices
         self.__init__()
+        self.vectorize_slices = vectorize_slices
         self.cpu['main_thread'] = '0'
         self.threads['0'] = {}
         events = None
@@ -181,11 +416,39 @@ class Trace():
                 cat.find('rail') >= 0 or \
                 cat.find('netlog') >= 0 or \
                 cat.find('v8') >= 0:
-            self.trace_events.append(trace_event)
+            if self.reorder_window is not None:
+                # Streaming mode, keep a bounded heap of pending events and
+                # process the oldest one whenever the window is full.
+                # The sequence number keeps the ordering stable for events
+                # with the same timestamp (matching the full sort).
+                self.reorder_sequence += 1
+                heapq.heappush(self.trace_events,
+                               (trace_event['ts'], self.reorder_sequence, trace_event))
+                if len(self.trace_events) > self.reorder_window:
+                    self.ProcessReorderedEvent(heapq.heappop(self.trace_events)[2])
+            else:
+                self.trace_events.append(trace_event)
+
+    def ProcessReorderedEvent(self, trace_event):
+        """Process an event that came out of the streaming reorder window"""
+        if self.reorder_last_ts is not None and trace_event['ts'] < self.reorder_last_ts:
+            self.reorder_late_events += 1
+        else:
+            self.reorder_last_ts = trace_event['ts']
+        self.ProcessTraceEvent(trace_event)
 
     def ProcessTraceEvents(self):
+        if self.reorder_window is not None:
+            # drain whatever is left in the streaming window
+            logging.debug("Processing %d buffered trace events", len(self.trace_events))
+            while len(self.trace_events):
+                self.ProcessReorderedEvent(heapq.heappop(self.trace_events)[2])
+            if self.reorder_late_events:
+                logging.warning("%d trace events arrived outside of the %d event reorder "
+                                "window, increase the window size for exact results",
+                                self.reorder_late_events, self.reorder_window)
         # sort the raw trace events by timestamp and then process them
-        if len(self.trace_events):
+        elif len(self.trace_events):
             logging.debug("Sorting %d trace events", len(self.trace_events))
             self.trace_events.sort(key=lambda trace_event: trace_event['ts'])
             logging.debug("Processing trace events")
@@ -365,9 +628,15 @@ class Trace():
                     self.cpu['slices'][thread][name] = [0.0] * slice_count
 
             # Go through all of the timeline events recursively and account for
-            # the time they consumed
+            # the time they consumed.  When numpy is available the per-slice
+            # accounting is deferred and done in bulk afterwards.
+            if self.vectorize_slices:
+                self.slice_ops = []
             for timeline_event in self.timeline_events:
                 self.ProcessTimelineEvent(timeline_event, None)
+            if self.slice_ops is not None:
+                self.ProcessTimelineSlices(slice_count)
+                self.slice_ops = None
             if self.interactive_end is not None and self.interactive_end - \
                     self.interactive_start > 500000:
                 self.interactive.append([int(math.ceil(self.interactive_start / 1000.0)),
@@ -438,23 +707,181 @@ class Trace():
                     self.scripts[thread][script][name].append([js_start, js_end])
                     stack[thread][script][name].append([js_start, js_end])
 
-            slice_usecs = self.cpu['slice_usecs']
-            first_slice = int(float(start) / float(slice_usecs))
-            last_slice = int(float(end) / float(slice_usecs))
-            for slice_number in xrange(first_slice, last_slice + 1):
-                slice_start = slice_number * slice_usecs
-                slice_end = slice_start + slice_usecs
-                used_start = max(slice_start, start)
-                used_end = min(slice_end, end)
-                slice_elapsed = used_end - used_start
-                self.AdjustTimelineSlice(
-                    thread, slice_number, name, parent, slice_elapsed)
+            if self.slice_ops is not None:
+                self.slice_ops.append((thread, name, parent, start, end))
+            else:
+                self.AdjustTimelineSlices(thread, name, parent, start, end)
 
             # Recursively process any child events
             if 'c' in timeline_event:
                 for child in timeline_event['c']:
                     self.ProcessTimelineEvent(child, name, dict(stack))
 
+    def AdjustTimelineSlices(self, thread, name, parent, start, end):
+        """Account for the time of one event in each of the slices it covers"""
+        slice_usecs = self.cpu['slice_usecs']
+        first_slice = int(float(start) / float(slice_usecs))
+        last_slice = int(float(end) / float(slice_usecs))
+        for slice_number in xrange(first_slice, last_slice + 1):
+            slice_start = slice_number * slice_usecs
+            slice_end = slice_start + slice_usecs
+            used_start = max(slice_start, start)
+            used_end = min(slice_end, end)
+            slice_elapsed = used_end - used_start
+            self.AdjustTimelineSlice(
+                thread, slice_number, name, parent, slice_elapsed)
+
+    def ProcessTimelineSlices(self, slice_count):
+        """Apply the deferred slice accounting using numpy.
+
+        Every event/slice pair becomes an operation on a (thread, slice) cell.
+        Operations on different cells are independent so they are applied in
+        waves where each wave holds at most one operation per cell, in the
+        same order that AdjustTimelineSlice would have applied them.  This
+        produces exactly the same floating point results as the per-slice
+        loop.  Falls back to the per-slice loop if anything goes wrong."""
+        ops = self.slice_ops
+        try:
+            if len(ops):
+                self.ProcessTimelineSlicesVectorized(ops, slice_count)
+        except Exception:
+            logging.exception('Error processing vectorized CPU slices, falling back')
+            for thread in self.cpu['slices'].keys():
+                for name in self.cpu['slices'][thread].keys():
+                    self.cpu['slices'][thread][name] = [0.0] * slice_count
+            for op in ops:
+                self.AdjustTimelineSlices(op[0], op[1], op[2], op[3], op[4])
+
+    def ProcessTimelineSlicesVectorized(self, ops, slice_count):
+        """Vectorized version of AdjustTimelineSlices over all events"""
+        slices = self.cpu['slices']
+        slice_usecs = self.cpu['slice_usecs']
+        # One matrix row for every thread/name (including the totals) in the
+        # same order the dictionaries iterate in.
+        rows = {}
+        thread_rows = {}
+        total_rows = {}
+        row_names = []
+        for thread in slices.keys():
+            thread_rows[thread] = []
+            for name in slices[thread].keys():
+                rows[(thread, name)] = len(row_names)
+                thread_rows[thread].append(len(row_names))
+                row_names.append((thread, name))
+            total_rows[thread] = rows[(thread, 'total')]
+        thread_ids = {}
+        for thread in thread_rows:
+            thread_ids[thread] = len(thread_ids)
+
+        # Flatten the events (already in processing order), dropping the ones
+        # that would be no-ops because the parent has the same name
+        count = len(ops)
+        starts = np.empty(count, dtype=np.float64)
+        ends = np.empty(count, dtype=np.float64)
+        name_rows = np.empty(count, dtype=np.int64)
+        parent_rows = np.empty(count, dtype=np.int64)
+        total_idx = np.empty(count, dtype=np.int64)
+        thread_idx = np.empty(count, dtype=np.int64)
+        index = 0
+        for thread, name, parent, start, end in ops:
+            if name != parent:
+                starts[index] = start
+                ends[index] = end
+                name_rows[index] = rows[(thread, name)]
+                parent_rows[index] = rows[(thread, parent)] if parent is not None else -1
+                total_idx[index] = total_rows[thread]
+                thread_idx[index] = thread_ids[thread]
+                index += 1
+        if not index:
+            return
+        starts = starts[:index]
+        ends = ends[:index]
+        if starts.min() < 0:
+            raise ValueError('Negative event start times are not supported')
+
+        # Expand every event into one operation per slice it covers
+        first = (starts / float(slice_usecs)).astype(np.int64)
+        last = (ends / float(slice_usecs)).astype(np.int64)
+        spans = last - first + 1
+        event = np.repeat(np.arange(index), spans)
+        offsets = np.cumsum(spans) - spans
+        slice_numbers = first[event] + (np.arange(len(event)) - offsets[event])
+        slice_start = slice_numbers * slice_usecs
+        elapsed = np.minimum(slice_start + slice_usecs, ends[event]) - \
+            np.maximum(slice_start, starts[event])
+        fractions = np.minimum(1.0, elapsed / float(slice_usecs))
+        # slices past the end raised (and ignored) an IndexError and zero-length
+        # slices do not change anything
+        keep = np.logical_and(slice_numbers < slice_count, fractions > 0)
+        event = event[keep]
+        slice_numbers = slice_numbers[keep]
+        fractions = fractions[keep]
+        if not len(event):
+            return
+
+        # Rank each operation within its (thread, slice) cell, preserving the
+        # processing order, and apply the operations one rank at a time
+        cells = thread_idx[:index][event] * slice_count + slice_numbers
+        order = np.argsort(cells, kind='mergesort')
+        sorted_cells = cells[order]
+        cell_start = np.ones(len(order), dtype=bool)
+        cell_start[1:] = sorted_cells[1:] != sorted_cells[:-1]
+        positions = np.arange(len(order))
+        first_position = np.maximum.accumulate(np.where(cell_start, positions, 0))
+        ranks = np.empty(len(order), dtype=np.int64)
+        ranks[order] = positions - first_position
+        wave_order = np.argsort(ranks, kind='mergesort')
+        wave_sizes = np.bincount(ranks)
+
+        values = np.zeros((len(row_names), slice_count), dtype=np.float64)
+        wave_start = 0
+        for wave_size in wave_sizes:
+            wave = wave_order[wave_start:wave_start + wave_size]
+            wave_start += wave_size
+            events = event[wave]
+            cols = slice_numbers[wave]
+            fraction = fractions[wave]
+            name_row = name_rows[:index][events]
+            parent_row = parent_rows[:index][events]
+            total_row = total_idx[:index][events]
+            values[name_row, cols] += fraction
+            values[total_row, cols] += fraction
+            has_parent = parent_row >= 0
+            if has_parent.any():
+                p_rows = parent_row[has_parent]
+                p_cols = cols[has_parent]
+                p_fraction = fraction[has_parent]
+                subtract = values[p_rows, p_cols] >= p_fraction
+                if subtract.any():
+                    values[p_rows[subtract], p_cols[subtract]] -= p_fraction[subtract]
+                    values[total_row[has_parent][subtract], p_cols[subtract]] -= \
+                        p_fraction[subtract]
+            values[name_row, cols] = np.minimum(1.0, values[name_row, cols])
+            # make sure we don't exceed 100% for any slot
+            over = values[total_row, cols] > 1.0
+            if over.any():
+                over_threads = thread_idx[:index][events[over]]
+                for thread in thread_rows:
+                    in_thread = over_threads == thread_ids[thread]
+                    if not in_thread.any():
+                        continue
+                    o_cols = cols[over][in_thread]
+                    o_name = name_row[over][in_thread]
+                    available = np.maximum(0.0, 1.0 - fraction[over][in_thread])
+                    for row in thread_rows[thread]:
+                        other = o_name != row
+                        current = values[row, o_cols]
+                        clamped = np.where(other, np.minimum(current, available), current)
+                        values[row, o_cols] = clamped
+                        available = np.where(other, np.maximum(0.0, available - clamped),
+                                             available)
+                    values[total_rows[thread], o_cols] = \
+                        np.minimum(1.0, np.maximum(0.0, 1.0 - available))
+
+        for row in xrange(len(row_names)):
+            thread, name = row_names[row]
+            slices[thread][name] = values[row].tolist()
+
     # Add the time to the given slice and subtract the time from a parent event
     def AdjustTimelineSlice(self, thread, slice_number, name, parent, elapsed):
         try:
@@ -560,234 +987,161 @@ class Trace():
         """Post-process the raw netlog events into request data"""
         if self.netlog_requests is not None:
             return self.netlog_requests
+        netlog = self.netlog
+        netlog.resolve()
         requests = []
-        if 'url_request' in self.netlog:
-            for request_id in self.netlog['url_request']:
-                request = self.netlog['url_request'][request_id]
-                if 'url' in request and request['url'][:16] != 'http://127.0.0.1' and \
-                        'start' in request:
-                    # Copy any http/2 info over
-                    if 'h2_session' in self.netlog and \
-                            'h2_session' in request and \
-                            request['h2_session'] in self.netlog['h2_session']:
-                        h2_session = self.netlog['h2_session'][request['h2_session']]
-                        if 'stream_id' in request and \
-                                'stream' in h2_session and \
-                                request['stream_id'] in h2_session['stream']:
-                            stream = h2_session['stream'][request['stream_id']]
-                            if 'request_headers' in stream:
-                                request['request_headers'] = stream['request_headers']
-                            if 'response_headers' in stream:
-                                request['response_headers'] = stream['response_headers']
-                            if 'exclusive' in stream:
-                                request['exclusive'] = stream['exclusive']
-                            if 'parent_stream_id' in stream:
-                                request['parent_stream_id'] = stream['parent_stream_id']
-                            if 'weight' in stream:
-                                request['weight'] = stream['weight']
-                            if 'first_byte' not in request and 'first_byte' in stream:
-                                request['first_byte'] = stream['first_byte']
-                            if 'end' not in request and 'end' in stream:
-                                request['end'] = stream['end']
-                            if stream['bytes_in'] > request['bytes_in']:
-                                request['bytes_in'] = stream['bytes_in']
-                                request['chunks'] = stream['chunks']
-                    if 'phantom' not in request:
-                        requests.append(request)
-            if len(requests):
-                # Sort the requests by the start time
-                requests.sort(key=lambda x: x['start'])
-                # Assign the socket connect time to the first request on each socket
-                if 'socket' in self.netlog:
-                    for request in requests:
-                        if 'socket' in request and request['socket'] in self.netlog['socket']:
-                            socket = self.netlog['socket'][request['socket']]
-                            if 'claimed' not in socket:
-                                socket['claimed'] = True
-                                if 'connect_start' in socket:
-                                    request['connect_start'] = socket['connect_start']
-                                if 'connect_end' in socket:
-                                    request['connect_end'] = socket['connect_end']
-                                if 'ssl_start' in socket:
-                                    request['ssl_start'] = socket['ssl_start']
-                                if 'ssl_end' in socket:
-                                    request['ssl_end'] = socket['ssl_end']
-                # Assign the DNS lookup to the first request that connected to the DocumentSetDomain
-                if 'dns' in self.netlog:
-                    # Build a mapping of the DNS lookups for each domain
-                    dns_lookups = {}
-                    for dns_id in self.netlog['dns']:
-                        dns = self.netlog['dns'][dns_id]
-                        if 'host' in dns and 'start' in dns:
-                            hostname = dns['host']
-                            if hostname not in dns_lookups:
-                                dns_lookups[hostname] = dns
-                            elif dns['start'] < dns_lookups[hostname]['start']:
-                                dns_lookups[hostname] = dns
-                    # Go through the requests and assign the DNS lookups as needed
-                    for request in requests:
-                        if 'connect_start' in request:
-                            hostname = urlparse.urlparse(request['url']).hostname
-                            if hostname in dns_lookups and 'claimed' not in dns_lookups[hostname]:
-                                dns = dns_lookups[hostname]
-                                dns['claimed'] = True
-                                request['dns_start'] = dns['start']
-                                if 'end' in dns:
-                                    request['dns_end'] = dns['end']
-                # Find the start timestamp if we didn't have one already
-                times = ['dns_start', 'dns_end',
-                         'connect_start', 'connect_end',
-                         'ssl_start', 'ssl_end',
-                         'start', 'first_byte', 'end']
+        for node in netlog.url_request.itervalues():
+            request = node.data
+            if 'url' in request and request['url'][:16] != 'http://127.0.0.1' and \
+                    'start' in request and 'phantom' not in request:
+                requests.append(request)
+        if len(requests):
+            # Sort the requests by the start time
+            requests.sort(key=lambda x: x['start'])
+            # Assign the socket connect time to the first request on each socket
+            for request in requests:
+                if 'socket' in request and request['socket'] in netlog.socket:
+                    socket = netlog.socket[request['socket']]
+                    if not socket.claimed:
+                        socket.claimed = True
+                        for key in ['connect_start', 'connect_end', 'ssl_start', 'ssl_end']:
+                            if key in socket.data:
+                                request[key] = socket.data[key]
+                        # Use the lookup that the socket's connect job waited on if we know it
+                        dns = socket.dns
+                        if dns is not None and not dns.claimed and dns.start is not None:
+                            dns.claimed = True
+                            request['dns_start'] = dns.start
+                            if dns.end is not None:
+                                request['dns_end'] = dns.end
+            # Assign the DNS lookup to the first request that connected to the DocumentSetDomain
+            if netlog.dns:
+                # Build a mapping of the DNS lookups for each domain
+                dns_lookups = {}
+                for dns in netlog.dns.itervalues():
+                    if dns.host is not None and dns.start is not None:
+                        if dns.host not in dns_lookups or \
+                                dns.start < dns_lookups[dns.host].start:
+                            dns_lookups[dns.host] = dns
+                # Go through the requests and assign the DNS lookups as needed
+                for request in requests:
+                    if 'connect_start' in request and 'dns_start' not in request:
+                        hostname = urlparse.urlparse(request['url']).hostname
+                        if hostname in dns_lookups and not dns_lookups[hostname].claimed:
+                            dns = dns_lookups[hostname]
+                            dns.claimed = True
+                            request['dns_start'] = dns.start
+                            if dns.end is not None:
+                                request['dns_end'] = dns.end
+            # Find the start timestamp if we didn't have one already
+            times = ['dns_start', 'dns_end',
+                     'connect_start', 'connect_end',
+                     'ssl_start', 'ssl_end',
+                     'start', 'first_byte', 'end']
+            for request in requests:
+                for time_name in times:
+                    if time_name in request:
+                        if self.start_time is None or request[time_name] < self.start_time:
+                            self.start_time = request[time_name]
+            # Go through and adjust all of the times to be relative in ms
+            if self.start_time is not None:
                 for request in requests:
                     for time_name in times:
                         if time_name in request:
-                            if self.start_time is None or request[time_name] < self.start_time:
-                                self.start_time = request[time_name]
-                # Go through and adjust all of the times to be relative in ms
-                if self.start_time is not None:
-                    for request in requests:
-                        for time_name in times:
-                            if time_name in request:
-                                request[time_name] = \
-                                        float(request[time_name] - self.start_time) / 1000.0
-                else:
-                    requests = []
+                            request[time_name] = \
+                                    float(request[time_name] - self.start_time) / 1000.0
+                    if self.netlog_columns:
+                        request['chunks'] = request['chunks'].to_columns()
+                    else:
+                        request['chunks'] = request['chunks'].to_list()
+            else:
+                requests = []
         if not len(requests):
             requests = None
         self.netlog_requests = requests
         return requests
 
     def ProcessNetlogConnectJobEvent(self, trace_event):
-        """Connect jobs link sockets to DNS lookups/group names"""
-        if 'connect_job' not in self.netlog:
-            self.netlog['connect_job'] = {}
-        request_id = trace_event['id']
-        if request_id not in self.netlog['connect_job']:
-            self.netlog['connect_job'][request_id] = {}
+        """Connect jobs link sockets to DNS lookups"""
+        netlog = self.netlog
+        entry = netlog.get_source(netlog.connect_job, NetlogConnectJob, trace_event['id'])
         params = trace_event['args']['params'] if 'params' in trace_event['args'] else {}
-        entry = self.netlog['connect_job'][request_id]
-        name = trace_event['name']
         if 'source_dependency' in params and 'id' in params['source_dependency']:
-            if name == 'CONNECT_JOB_SET_SOCKET':
-                socket_id = params['source_dependency']['id']
-                entry['socket'] = socket_id
-                if 'socket' in self.netlog and socket_id in self.netlog['socket']:
-                    if 'group' in entry:
-                        self.netlog['socket'][socket_id]['group'] = entry['group']
-                    if 'dns' in entry:
-                        self.netlog['socket'][socket_id]['dns'] = entry['dns']
-        if 'group_name' in params:
-            entry['group'] = params['group_name']
+            if trace_event['name'] == 'CONNECT_JOB_SET_SOCKET':
+                entry.socket = netlog.get_source(netlog.socket, NetlogSocket,
+                                                 params['source_dependency']['id'])
 
     def ProcessNetlogStreamJobEvent(self, trace_event):
-        """Strem jobs leank requests to sockets"""
-        if 'stream_job' not in self.netlog:
-            self.netlog['stream_job'] = {}
-        request_id = trace_event['id']
-        if request_id not in self.netlog['stream_job']:
-            self.netlog['stream_job'][request_id] = {}
+        """Stream jobs link requests to sockets and h2 sessions"""
+        netlog = self.netlog
+        entry = netlog.get_source(netlog.stream_job, NetlogStreamJob, trace_event['id'])
         params = trace_event['args']['params'] if 'params' in trace_event['args'] else {}
-        entry = self.netlog['stream_job'][request_id]
         name = trace_event['name']
         if 'source_dependency' in params and 'id' in params['source_dependency']:
+            source_id = params['source_dependency']['id']
             if name == 'SOCKET_POOL_BOUND_TO_SOCKET':
-                socket_id = params['source_dependency']['id']
-                entry['socket'] = socket_id
-                if 'url_request' in entry and entry['urlrequest'] in self.netlog['urlrequest']:
-                    self.netlog['urlrequest'][entry['urlrequest']]['socket'] = socket_id
+                entry.socket = netlog.get_source(netlog.socket, NetlogSocket, source_id)
             if name == 'HTTP_STREAM_JOB_BOUND_TO_REQUEST':
-                url_request_id = params['source_dependency']['id']
-                entry['url_request'] = url_request_id
-                if url_request_id in self.netlog['url_request']:
-                    url_request = self.netlog['url_request'][url_request_id]
-                    if 'socket' in entry:
-                        url_request['socket'] = entry['socket']
-                    if 'h2_session' in entry:
-                        url_request['h2_session'] = entry['h2_session']
+                entry.url_request = netlog.get_source(netlog.url_request, NetlogUrlRequest,
+                                                      source_id)
+                entry.url_request.stream_job = entry
             if name == 'HTTP2_SESSION_POOL_IMPORTED_SESSION_FROM_SOCKET' or \
                     name == 'HTTP2_SESSION_POOL_FOUND_EXISTING_SESSION':
-                h2_session_id = params['source_dependency']['id']
-                entry['h2_session'] = h2_session_id
-                if 'url_request' in entry and entry['urlrequest'] in self.netlog['urlrequest']:
-                    self.netlog['urlrequest'][entry['urlrequest']]['h2_session'] = h2_session_id
+                entry.h2_session = netlog.get_source(netlog.h2_session, NetlogH2Session,
+                                                     source_id)
 
     def ProcessNetlogHttp2SessionEvent(self, trace_event):
         """Raw H2 session information (linked to sockets and requests)"""
-        if 'h2_session' not in self.netlog:
-            self.netlog['h2_session'] = {}
-        session_id = trace_event['id']
-        if session_id not in self.netlog['h2_session']:
-            self.netlog['h2_session'][session_id] = {'stream': {}}
+        netlog = self.netlog
+        entry = netlog.get_source(netlog.h2_session, NetlogH2Session, trace_event['id'])
         params = trace_event['args']['params'] if 'params' in trace_event['args'] else {}
-        entry = self.netlog['h2_session'][session_id]
         name = trace_event['name']
         if 'source_dependency' in params and 'id' in params['source_dependency']:
             if name == 'HTTP2_SESSION_INITIALIZED':
-                socket_id = params['source_dependency']['id']
-                entry['socket'] = socket_id
-                if 'socket' in self.netlog and socket_id in self.netlog['socket']:
-                    self.netlog['socket']['h2_session'] = session_id
-        if 'host' not in entry and 'host' in params:
-            entry['host'] = params['host']
-        if 'protocol' not in entry and 'protocol' in params:
-            entry['protocol'] = params['protocol']
+                entry.socket = netlog.get_source(netlog.socket, NetlogSocket,
+                                                 params['source_dependency']['id'])
         if 'stream_id' in params:
-            stream_id = params['stream_id']
-            if stream_id not in entry['stream']:
-                entry['stream'][stream_id] = {'bytes_in': 0, 'chunks': []}
-            stream = entry['stream'][stream_id]
+            stream = entry.get_stream(params['stream_id'])
+            stream_data = stream.data
             if 'exclusive' in params:
-                stream['exclusive'] = params['exclusive']
+                stream_data['exclusive'] = params['exclusive']
             if 'parent_stream_id' in params:
-                stream['parent_stream_id'] = params['parent_stream_id']
+                stream_data['parent_stream_id'] = params['parent_stream_id']
             if 'weight' in params:
-                stream['weight'] = params['weight']
+                stream_data['weight'] = params['weight']
             if 'url' in params:
-                stream['url'] = params['url']
-                if 'url_request' in stream:
-                    request_id = stream['url_request']
-                    if 'url_request' in self.netlog and request_id in self.netlog['url_request']:
-                        request = self.netlog['url_request'][request_id]
-                        request['url'] = params['url']
+                stream_data['url'] = params['url']
+                if stream.url_request is not None:
+                    netlog.set_request_url(stream.url_request, params['url'])
             if name == 'HTTP2_SESSION_RECV_DATA' and 'size' in params:
-                stream['end'] = trace_event['ts']
-                if 'first_byte' not in stream:
-                    stream['first_byte'] = trace_event['ts']
-                stream['bytes_in'] += params['size']
-                stream['chunks'].append({'ts': trace_event['ts'], 'bytes': params['size']})
+                stream_data['end'] = trace_event['ts']
+                if 'first_byte' not in stream_data:
+                    stream_data['first_byte'] = trace_event['ts']
+                stream_data['bytes_in'] += params['size']
+                stream_data['chunks'].add(trace_event['ts'], params['size'], self.netlog_bucket)
             if name == 'HTTP2_SESSION_SEND_HEADERS':
                 if 'headers' in params:
-                    stream['request_headers'] = params['headers']
+                    stream_data['request_headers'] = params['headers']
             if name == 'HTTP2_SESSION_RECV_HEADERS':
-                if 'first_byte' not in stream:
-                    stream['first_byte'] = trace_event['ts']
-                stream['end'] = trace_event['ts']
+                if 'first_byte' not in stream_data:
+                    stream_data['first_byte'] = trace_event['ts']
+                stream_data['end'] = trace_event['ts']
                 if 'headers' in params:
-                    stream['response_headers'] = params['headers']
-            if name == 'HTTP2_STREAM_ADOPTED_PUSH_STREAM' and 'url' in params and \
-                    'url_request' in self.netlog:
-                # Find the phantom request with the matching url and mark it
-                for request_id in self.netlog['url_request']:
-                    request = self.netlog['url_request'][request_id]
-                    if 'url' in request and params['url'] == request['url'] and \
-                            'start' not in request:
-                        request['phantom'] = True
-                        break
+                    stream_data['response_headers'] = params['headers']
+            if name == 'HTTP2_STREAM_ADOPTED_PUSH_STREAM' and 'url' in params:
+                # The request that adopted the push never goes out on the wire
+                request = netlog.claim_pending_request(params['url'])
+                if request is not None:
+                    request.data['phantom'] = True
         if name == 'HTTP2_SESSION_RECV_PUSH_PROMISE' and 'promised_stream_id' in params:
             # Create a fake request to match the push
-            if 'url_request' not in self.netlog:
-                self.netlog['url_request'] = {}
-            request_id = self.netlog['next_request_id']
-            self.netlog['next_request_id'] += 1
-            self.netlog['url_request'][request_id] = {'bytes_in': 0, 'chunks': []}
-            request = self.netlog['url_request'][request_id]
+            request_id = netlog.new_request_id()
+            request = NetlogUrlRequest(request_id)
+            netlog.url_request[request_id] = request
             stream_id = params['promised_stream_id']
-            if stream_id not in entry['stream']:
-                entry['stream'][stream_id] = {'bytes_in': 0, 'chunks': []}
-            stream = entry['stream'][stream_id]
+            stream = entry.get_stream(stream_id)
             if 'headers' in params:
-                stream['request_headers'] = params['headers']
+                stream.data['request_headers'] = params['headers']
                 # synthesize a URL from the request headers
                 scheme = None
                 authority = None
@@ -804,49 +1158,36 @@ class Trace():
                         path = match.group(1)
                 if scheme is not None and authority is not None and path is not None:
                     url = '{0}://{1}{2}'.format(scheme, authority, path)
-                    request['url'] = url
-                    stream['url'] = url
-            request['protocol'] = 'HTTP/2'
-            request['h2_session'] = session_id
-            request['stream_id'] = stream_id
-            request['start'] = trace_event['ts']
-            request['pushed'] = True
-            stream['pushed'] = True
-            stream['url_request'] = request_id
-            if 'socket' in entry:
-                request['socket'] = entry['socket']
+                    request.data['url'] = url
+                    stream.data['url'] = url
+            request.data['protocol'] = 'HTTP/2'
+            request.data['stream_id'] = stream_id
+            request.data['start'] = trace_event['ts']
+            request.data['pushed'] = True
+            request.h2_session = entry
+            stream.data['pushed'] = True
+            stream.url_request = request
 
     def ProcessNetlogDnsEvent(self, trace_event):
-        if 'dns' not in self.netlog:
-            self.netlog['dns'] = {}
-        request_id = trace_event['id']
-        if request_id not in self.netlog['dns']:
-            self.netlog['dns'][request_id] = {}
+        netlog = self.netlog
+        entry = netlog.get_source(netlog.dns, NetlogDns, trace_event['id'])
         params = trace_event['args']['params'] if 'params' in trace_event['args'] else {}
-        entry = self.netlog['dns'][request_id]
         name = trace_event['name']
         if 'source_dependency' in params and 'id' in params['source_dependency']:
             parent_id = params['source_dependency']['id']
-            if 'connect_job' in self.netlog and parent_id in self.netlog['connect_job']:
-                self.netlog['connect_job'][parent_id]['dns'] = request_id
-        if 'start' not in entry and name == 'HOST_RESOLVER_IMPL_ATTEMPT_STARTED':
-            entry['start'] = trace_event['ts']
+            if parent_id in netlog.connect_job:
+                netlog.connect_job[parent_id].dns = entry
+        if entry.start is None and name == 'HOST_RESOLVER_IMPL_ATTEMPT_STARTED':
+            entry.start = trace_event['ts']
         if name == 'HOST_RESOLVER_IMPL_ATTEMPT_FINISHED':
-            entry['end'] = trace_event['ts']
-        if 'host' not in entry and 'host' in params:
-            entry['host'] = params['host']
-        if 'address_list' in params:
-            entry['address_list'] = params['address_list']
+            entry.end = trace_event['ts']
+        if entry.host is None and 'host' in params:
+            entry.host = params['host']
 
     def ProcessNetlogSocketEvent(self, trace_event):
-        if 'socket' not in self.netlog:
-            self.netlog['socket'] = {}
-        request_id = trace_event['id']
-        if request_id not in self.netlog['socket']:
-            self.netlog['socket'][request_id] = {'bytes_out': 0, 'bytes_in': 0,
-                                                 'chunks_out': [], 'chunks_in': []}
+        netlog = self.netlog
+        entry = netlog.get_source(netlog.socket, NetlogSocket, trace_event['id']).data
         params = trace_event['args']['params'] if 'params' in trace_event['args'] else {}
-        entry = self.netlog['socket'][request_id]
         name = trace_event['name']
         if 'address' in params:
             entry['address'] = params['address']
@@ -863,33 +1204,31 @@ class Trace():
             entry['ssl_end'] = trace_event['ts']
         if name == 'SOCKET_BYTES_SENT' and 'byte_count' in params:
             entry['bytes_out'] += params['byte_count']
-            entry['chunks_out'].append({'ts': trace_event['ts'], 'bytes': params['byte_count']})
+            entry['chunks_out'].add(trace_event['ts'], params['byte_count'], self.netlog_bucket)
         if name == 'SOCKET_BYTES_RECEIVED' and 'byte_count' in params:
             entry['bytes_in'] += params['byte_count']
-            entry['chunks_in'].append({'ts': trace_event['ts'], 'bytes': params['byte_count']})
+            entry['chunks_in'].add(trace_event['ts'], params['byte_count'], self.netlog_bucket)
         if name == 'SSL_CERTIFICATES_RECEIVED' and 'certificates' in params:
             if 'certificates' not in entry:
                 entry['certificates'] = []
             entry['certificates'].extend(params['certificates'])
 
     def ProcessNetlogUrlRequestEvent(self, trace_event):
-        if 'url_request' not in self.netlog:
-            self.netlog['url_request'] = {}
+        netlog = self.netlog
         request_id = trace_event['id']
-        if request_id not in self.netlog['url_request']:
-            self.netlog['url_request'][request_id] = {'bytes_in': 0, 'chunks': []}
+        node = netlog.get_source(netlog.url_request, NetlogUrlRequest, request_id)
+        entry = node.data
         params = trace_event['args']['params'] if 'params' in trace_event['args'] else {}
-        entry = self.netlog['url_request'][request_id]
         name = trace_event['name']
         if 'priority' in params:
             entry['priority'] = params['priority']
         if 'method' in params:
             entry['method'] = params['method']
-        if 'url' in params:
-            entry['url'] = params['url']
         if 'start' not in entry and name == 'HTTP_TRANSACTION_SEND_REQUEST' and \
                 trace_event['ph'] == 'e':
             entry['start'] = trace_event['ts']
+        if 'url' in params:
+            netlog.set_request_url(node, params['url'])
         if 'headers' in params and name == 'HTTP_TRANSACTION_SEND_REQUEST_HEADERS':
             entry['request_headers'] = params['headers']
         if 'headers' in params and name == 'HTTP_TRANSACTION_HTTP2_SEND_REQUEST_HEADERS':
@@ -908,7 +1247,7 @@ class Trace():
         if 'byte_count' in params and name == 'URL_REQUEST_JOB_BYTES_READ':
             entry['end'] = trace_event['ts']
             entry['bytes_in'] += params['byte_count']
-            entry['chunks'].append({'ts': trace_event['ts'], 'bytes': params['byte_count']})
+            entry['chunks'].add(trace_event['ts'], params['byte_count'], self.netlog_bucket)
         if 'byte_count' in params and name == 'URL_REQUEST_JOB_FILTERED_BYTES_READ':
             entry['end'] = trace_event['ts']
             if 'uncompressed_bytes_in' not in entry:
@@ -917,10 +1256,10 @@ class Trace():
         if 'stream_id' in params:
             entry['stream_id'] = params['stream_id']
         if name == 'URL_REQUEST_REDIRECTED':
-            new_id = self.netlog['next_request_id']
-            self.netlog['next_request_id'] += 1
-            self.netlog['url_request'][new_id] = entry
-            del self.netlog['url_request'][request_id]
+            # The redirected request keeps its links, the source carries on as a new request
+            node.id = netlog.new_request_id()
+            netlog.url_request[node.id] = node
+            del netlog.url_request[request_id]
 
 
     #######################################################################
@@ -993,6 +1332,17 @@ def main():
                         help="Output list of interactive times.")
     parser.add_argument('-n', '--netlog', help="Output netlog details file.")
     parser.add_argument('-s', '--stats', help="Output v8 Call stats file.")
+    parser.add_argument('--nonumpy', action='store_true', default=False,
+                        help="Use the pure python CPU slice accounting even if numpy is "
+                             "available (for comparing results).")
+    parser.add_argument('-w', '--window', type=int,
+                        help="Stream the trace using a reorder window of the given number of "
+                             "events instead of loading and sorting the whole trace.")
+    parser.add_argument('--netlogcolumns', action='store_true', default=False,
+                        help="Write the netlog request chunks as 'ts' and 'bytes' columns.")
+    parser.add_argument('--netlogbucket', type=float,
+                        help="Coalesce the netlog request chunks into buckets of the given "
+                             "number of milliseconds.")
     options, unknown = parser.parse_known_args()
 
     # Set up logging
@@ -1013,8 +1363,13 @@ def main():
 
     start = time.time()
     trace = Trace()
+    if options.nonumpy:
+        trace.vectorize_slices = False
+    trace.netlog_columns = options.netlogcolumns
+    if options.netlogbucket:
+        trace.netlog_bucket = options.netlogbucket * 1000.0
     if options.trace:
-        trace.Process(options.trace)
+        trace.Process(options.trace, options.window)
     elif options.timeline:
         trace.ProcessTimeline(options.timeline)
 
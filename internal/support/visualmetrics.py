@@ -29,7 +29,6 @@ SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."""
 import gc
 import glob
 import gzip
-import json
 import logging
 import math
 import os
@@ -39,6 +38,11 @@ import shutil
 import subprocess
 import tempfile
 
+try:
+    from . import json_codec as json
+except (ImportError, ValueError):
+    import json_codec as json
+
 # Globals
 options = None
 client_viewport = None
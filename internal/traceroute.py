@@ -2,13 +2,13 @@
 # Use of this source code is governed by the Apache 2.0 license that can be
 # found in the LICENSE file.
 """Logic for running a traceroute test"""
-import gzip
 import logging
 import os
 import platform
 import re
 import subprocess
 import urlparse
+from .compression import open_gzip
 
 class Traceroute(object):
     """Traceroute (desktop)"""
@@ -35,7 +35,7 @@ class Traceroute(object):
                 last_hop, results = self.unix_traceroute(hostname)
             if last_hop > 0 and results is not None and len(results):
                 out_file = os.path.join(task['dir'], task['prefix']) + '_traceroute.txt.gz'
-                with gzip.open(out_file, 'wb', 7) as f_out:
+                with open_gzip(out_file) as f_out:
                     f_out.write('Hop,IP,ms,FQDN\n')
                     if 0 in results:
                         f_out.write('-1,{0},0,{1}\n'.format(results[0]['addr'], hostname))
@@ -313,7 +313,8 @@ class NetEm(object):
                     self.in_interface = 'ifb0'
                 # Set up the ifb interface so inbound traffic can be shaped
                 if self.in_interface.startswith('ifb'):
-                    if self.options.dockerized:
+                    # Network namespaces (docker, test slots) need their own ifb device
+                    if self.options.dockerized or self.options.slot is not None:
                         subprocess.call(['sudo', 'ip', 'link', 'add', 'ifb0', 'type', 'ifb'])
                     else:
                         subprocess.call(['sudo', 'modprobe', 'ifb'])
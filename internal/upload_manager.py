@@ -0,0 +1,197 @@
+# Copyright 2017 Google Inc. All rights reserved.
+# Use of this source code is governed by the Apache 2.0 license that can be
+# found in the LICENSE file.
+"""Concurrent, resumable uploading of the test results"""
+import logging
+import os
+import Queue
+import random
+import shutil
+import threading
+import time
+import monotonic
+from .support import json_codec as json
+from .zip_stream import MultipartBody, ZipStream
+
+UPLOAD_THREADS = 4
+UPLOAD_RETRIES = 5
+# Files larger than this are uploaded individually, everything else goes in result.zip
+SEPARATE_UPLOAD_SIZE = 100000
+
+class UploadManager(object):
+    """Uploads the result files for test runs over a pool of worker threads.
+    Each run is moved into a spool directory with a manifest so that
+    interrupted uploads can be resumed when the agent restarts."""
+    def __init__(self, spool_dir, post_data):
+        self.spool_dir = spool_dir
+        self.post_data = post_data
+        self.uploads = Queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Start the worker threads"""
+        with self.lock:
+            if not self.threads:
+                for _ in xrange(UPLOAD_THREADS):
+                    thread = threading.Thread(target=self.upload_thread)
+                    thread.daemon = True
+                    thread.start()
+                    self.threads.append(thread)
+
+    def upload_thread(self):
+        """Worker thread for uploading individual files"""
+        while True:
+            upload = self.uploads.get()
+            upload['result'] = self.post(upload['url'], upload['data'], upload['path'],
+                                         upload['upload_name'])
+            upload['done'].set()
+
+    def post(self, url, data, file_path, filename):
+        """Post with retries and exponential backoff (with jitter)"""
+        ok = False
+        attempt = 0
+        while not ok and attempt < UPLOAD_RETRIES:
+            if attempt:
+                delay = min(60, 2 ** attempt) * random.uniform(0.5, 1.0)
+                logging.debug('Retrying upload of %s in %0.1f seconds', filename, delay)
+                time.sleep(delay)
+            attempt += 1
+            ok = self.post_data(url, data, file_path, filename)
+        return ok
+
+    def spool(self, task, url, data, workdone_data, upload_video, keep_video):
+        """Move the results for the given task into the spool, returns the manifest path"""
+        manifest = None
+        if os.path.isdir(task['dir']):
+            if not os.path.isdir(self.spool_dir):
+                os.makedirs(self.spool_dir)
+            name = os.path.basename(task['dir'])
+            entry = os.path.join(self.spool_dir, name)
+            index = 0
+            while os.path.exists(entry) or os.path.exists(entry + '.json'):
+                index += 1
+                entry = os.path.join(self.spool_dir, '{0}-{1:d}'.format(name, index))
+            # Delete any video files that may have squeaked by
+            if not keep_video:
+                for filename in os.listdir(task['dir']):
+                    if filename[-4:] == '.mp4' and filename.find('rendered_video') == -1:
+                        try:
+                            os.remove(os.path.join(task['dir'], filename))
+                        except Exception:
+                            pass
+            shutil.move(task['dir'], entry)
+            video_directories = task['video_directories'] if upload_video else []
+            manifest = entry + '.json'
+            with open(manifest, 'wb') as f_out:
+                json.dump({'dir': entry,
+                           'url': url,
+                           'data': data,
+                           'workdone_data': workdone_data,
+                           'prefix': task['prefix'],
+                           'video_directories': video_directories}, f_out)
+        return manifest
+
+    def upload(self, manifest, url=None, workdone_data=None):
+        """Upload a spooled run (or just post workdone if there are no files).
+        Returns True if the workdone was confirmed."""
+        self.start()
+        start = monotonic.monotonic()
+        entry = None
+        body = None
+        if manifest is not None:
+            with open(manifest, 'rb') as f_in:
+                entry = json.load(f_in)
+            url = entry['url']
+            workdone_data = entry['workdone_data']
+        if entry is not None and os.path.isdir(entry['dir']):
+            # Queue the separate uploads for the large files
+            pending = []
+            needs_zip = []
+            files = []
+            for video_subdirectory in entry['video_directories']:
+                video_dir = os.path.join(entry['dir'], video_subdirectory)
+                if os.path.isdir(video_dir):
+                    for filename in os.listdir(video_dir):
+                        filepath = os.path.join(video_dir, filename)
+                        if os.path.isfile(filepath):
+                            files.append({'path': filepath,
+                                          'zip_name': video_subdirectory + '/' + filename,
+                                          'upload_name': entry['prefix'] + '_' + filename})
+            for filename in os.listdir(entry['dir']):
+                filepath = os.path.join(entry['dir'], filename)
+                if os.path.isfile(filepath):
+                    files.append({'path': filepath, 'zip_name': filename,
+                                  'upload_name': filename})
+            for item in files:
+                if os.path.getsize(item['path']) > SEPARATE_UPLOAD_SIZE:
+                    logging.debug('Uploading %s (%d bytes)', item['upload_name'],
+                                  os.path.getsize(item['path']))
+                    item['url'] = url + "resultimage.php"
+                    item['data'] = entry['data']
+                    item['done'] = threading.Event()
+                    item['result'] = False
+                    self.uploads.put(item)
+                    pending.append(item)
+                else:
+                    needs_zip.append(item)
+            # Anything that failed to upload separately goes in the zip
+            for item in pending:
+                while not item['done'].is_set():
+                    item['done'].wait(1)
+                if item['result']:
+                    try:
+                        os.remove(item['path'])
+                    except Exception:
+                        pass
+                else:
+                    needs_zip.append(item)
+            # Zip the remaining files (streamed straight into the request)
+            if len(needs_zip):
+                for zipitem in needs_zip:
+                    logging.debug('Zipping %s (%d bytes)', zipitem['zip_name'],
+                                  os.path.getsize(zipitem['path']))
+                body = MultipartBody('file', 'result.zip',
+                                     ZipStream([(zipitem['path'], zipitem['zip_name'])
+                                                for zipitem in needs_zip]))
+        # Post the workdone event for the task (with the zip attached)
+        logging.debug('Uploading result zip')
+        ok = self.post(url + "workdone.php", workdone_data, body, 'result.zip')
+        if ok:
+            if entry is not None:
+                if os.path.isdir(entry['dir']):
+                    shutil.rmtree(entry['dir'], ignore_errors=True)
+                try:
+                    os.remove(manifest)
+                except Exception:
+                    pass
+        else:
+            logging.critical('Upload of the test result failed, it will be retried later')
+        logging.debug('Upload took %0.3f seconds', monotonic.monotonic() - start)
+        return ok
+
+    def get_spooled(self):
+        """List the manifests for any results left in the spool"""
+        manifests = []
+        if os.path.isdir(self.spool_dir):
+            for filename in sorted(os.listdir(self.spool_dir)):
+                if filename[-5:] == '.json':
+                    manifests.append(os.path.join(self.spool_dir, filename))
+        return manifests
+
+    def resume(self):
+        """Retry any uploads left over from a previous session (in the background)"""
+        manifests = self.get_spooled()
+        if manifests:
+            logging.info('Resuming %d spooled uploads', len(manifests))
+            thread = threading.Thread(target=self.resume_thread, args=(manifests,))
+            thread.daemon = True
+            thread.start()
+
+    def resume_thread(self, manifests):
+        """Upload the spooled results"""
+        for manifest in manifests:
+            try:
+                self.upload(manifest)
+            except Exception as err:
+                logging.critical('Error resuming upload %s: %s', manifest, err.__str__())
@@ -3,21 +3,34 @@
 # found in the LICENSE file.
 """Main entry point for interfacing with WebPageTest server"""
 from datetime import datetime
-import gzip
 import logging
 import os
 import platform
+import random
 import re
 import shutil
 import subprocess
+import threading
 import time
 import urllib
-import zipfile
 import monotonic
-import ujson as json
+from .compression import compress_file, wait_for_compression, write_gzip
+from .slots import PORTS_PER_SLOT, get_slot_port
+from .support import json_codec as json
+from .upload_manager import UploadManager
 
 DEFAULT_JPEG_QUALITY = 30
 
+class ThreadLogFilter(logging.Filter):
+    """Only pass the log records from (or not from) one thread"""
+    def __init__(self, thread_id, include):
+        logging.Filter.__init__(self)
+        self.thread_id = thread_id
+        self.include = include
+
+    def filter(self, record):
+        return (record.thread == self.thread_id) == self.include
+
 class WebPageTest(object):
     """Controller for interfacing with the WebPageTest server"""
     # pylint: disable=E0611
@@ -26,12 +39,23 @@ class WebPageTest(object):
         import requests
         self.job = None
         self.first_failure = None
+        # Work polling state (adaptive backoff and prefetching). The prefetch
+        # thread polls while the uploads are still running so the polling state
+        # is guarded by poll_lock and the work requests use their own session.
+        self.idle_count = 0
+        self.poll_held = False
+        self.poll_lock = threading.Lock()
+        self.prefetch_thread = None
+        self.prefetched_job = None
         self.session = requests.Session()
+        self.poll_session = requests.Session()
         self.options = options
         self.test_run_count = 0
         self.log_formatter = logging.Formatter(fmt="%(asctime)s.%(msecs)03d - %(message)s",
                                                datefmt="%H:%M:%S")
         self.log_handler = None
+        # Records from the post-processing thread go to its own task's log
+        self.log_filter = None
         # Configurable options
         self.url = options.server
         self.location = ''
@@ -56,6 +80,10 @@ class WebPageTest(object):
                         machine = match.group(2)
                         hostname = 'VM{0}-{1}'.format(server, machine)
         self.pc_name = hostname if options.name is None else options.name
+        # Each test slot polls for work as a separate agent with its own ports
+        if options.slot is not None:
+            self.pc_name = '{0}-{1:d}'.format(self.pc_name, options.slot)
+        self.base_port = get_slot_port(options.slot)
         self.auth_name = options.username
         self.auth_password = options.password if options.password is not None else ''
         self.validate_server_certificate = options.validcertificate
@@ -78,14 +106,15 @@ class WebPageTest(object):
         elif self.options.gce:
             self.load_from_gce()
         # Set the session authentication options
-        if self.auth_name is not None:
-            self.session.auth = (self.auth_name, self.auth_password)
-        self.session.verify = self.validate_server_certificate
-        if options.cert is not None:
-            if options.certkey is not None:
-                self.session.cert = (options.cert, options.certkey)
-            else:
-                self.session.cert = options.cert
+        for session in [self.session, self.poll_session]:
+            if self.auth_name is not None:
+                session.auth = (self.auth_name, self.auth_password)
+            session.verify = self.validate_server_certificate
+            if options.cert is not None:
+                if options.certkey is not None:
+                    session.cert = (options.cert, options.certkey)
+                else:
+                    session.cert = options.cert
         # Set up the temporary directories
         self.workdir = os.path.join(workdir, self.pc_name)
         self.persistent_dir = self.workdir + '.data'
@@ -110,6 +139,10 @@ class WebPageTest(object):
                     self.version = git_date.strftime('%y%m%d.%H%m%S')
         except Exception:
             pass
+        # Resume any uploads left over from a previous run of the agent
+        self.uploader = UploadManager(os.path.join(self.persistent_dir, 'uploads'),
+                                      self.post_data)
+        self.uploader.resume()
         # Load the discovered browser margins
         self.margins = {}
         margins_file = os.path.join(self.persistent_dir, 'margins.json')
@@ -221,7 +254,58 @@ class WebPageTest(object):
 
 
     def get_test(self):
-        """Get a job from the server"""
+        """Get a job from the server (or the one that was prefetched)"""
+        job = None
+        if self.prefetch_thread is not None:
+            self.prefetch_thread.join()
+            self.prefetch_thread = None
+            job = self.prefetched_job
+            self.prefetched_job = None
+        if job is None:
+            job = self.fetch_test()
+        self.job = job
+        return job
+
+    def prefetch_test(self):
+        """Start checking for the next job in the background while the current one finishes"""
+        if self.prefetch_thread is None and self.url is not None and \
+                self.cpu_scale_multiplier is not None:
+            self.prefetched_job = None
+            self.prefetch_thread = threading.Thread(target=self.prefetch_thread_proc)
+            self.prefetch_thread.daemon = True
+            self.prefetch_thread.start()
+
+    def prefetch_thread_proc(self):
+        """Background thread for prefetching the next job"""
+        try:
+            self.prefetched_job = self.fetch_test()
+        except Exception:
+            pass
+
+    def get_poll_delay(self):
+        """Time to wait before checking for work again.
+        Backs off exponentially (up to --maxpolling) while there is no work and
+        adds jitter so a fleet of agents doesn't poll in lock-step."""
+        with self.poll_lock:
+            poll_held = self.poll_held
+            idle_count = self.idle_count
+        if poll_held:
+            # The server already held the request for the long-poll interval
+            return random.uniform(0, 1)
+        max_delay = self.options.polling
+        if self.options.maxpolling is not None:
+            max_delay = max(max_delay, self.options.maxpolling)
+        delay = min(max_delay, self.options.polling * 2 ** min(max(idle_count - 1, 0), 10))
+        return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+    def fetch_test(self):
+        """Check the server for a job (one poll at a time, from either thread)"""
+        with self.poll_lock:
+            return self.poll_for_work()
+
+    def poll_for_work(self):
+        """Check the server for a job, rotating through the test locations.
+        Only called with poll_lock held, it updates the polling state."""
         import requests
         from .os_util import get_free_disk_space
         if self.cpu_scale_multiplier is None:
@@ -229,6 +313,7 @@ class WebPageTest(object):
         if self.url is None:
             return None
         job = None
+        self.poll_held = False
         locations = list(self.test_locations) if len(self.test_locations) > 1 else [self.location]
         location = str(locations.pop(0))
         # Shuffle the list order
@@ -250,6 +335,8 @@ class WebPageTest(object):
                 url += "&ec2zone=" + urllib.quote_plus(self.zone)
             if self.options.android:
                 url += '&apk=1'
+            if self.options.slots > 1:
+                url += '&slots={0:d}'.format(self.options.slots)
             if self.version is not None:
                 url += '&version={0}'.format(self.version)
             if self.screen_width is not None:
@@ -258,9 +345,17 @@ class WebPageTest(object):
                 url += '&screenheight={0:d}'.format(self.screen_height)
             free_disk = get_free_disk_space()
             url += '&freedisk={0:0.3f}'.format(free_disk)
+            # Only the last location in the rotation is long-polled
+            hold = 0
+            if self.options.longpoll and (not locations or count == 3):
+                hold = self.options.longpoll
+                url += '&wait={0:d}'.format(hold)
             logging.info("Checking for work: %s", url)
             try:
-                response = self.session.get(url, timeout=30)
+                start = monotonic.monotonic()
+                response = self.poll_session.get(url, timeout=30 + hold)
+                if hold and monotonic.monotonic() - start >= hold * 0.9:
+                    self.poll_held = True
                 if self.options.alive:
                     with open(self.options.alive, 'a'):
                         os.utime(self.options.alive, None)
@@ -324,19 +419,17 @@ class WebPageTest(object):
                 time.sleep(0.1)
             except Exception:
                 pass
-        self.job = job
+        if job is None:
+            self.idle_count += 1
+        else:
+            self.idle_count = 0
+            self.poll_held = False
         return job
 
     def get_task(self, job):
         """Create a task object for the next test run or return None if the job is done"""
         task = None
-        if self.log_handler is not None:
-            try:
-                self.log_handler.close()
-                logging.getLogger().removeHandler(self.log_handler)
-                self.log_handler = None
-            except Exception:
-                pass
+        self.close_task_log()
         if 'current_state' not in job or not job['current_state']['done']:
             if 'run' in job:
                 # Sharded test, running one run only
@@ -371,9 +464,10 @@ class WebPageTest(object):
                         'activity_time': 2,
                         'combine_steps': False,
                         'video_directories': [],
+                        'compression_jobs': [],
                         'page_data': {}}
                 # Set up the task configuration options
-                task['port'] = 9222 + (self.test_run_count % 500)
+                task['port'] = self.base_port + (self.test_run_count % PORTS_PER_SLOT)
                 task['task_prefix'] = "{0:d}".format(run)
                 if task['cached']:
                     task['task_prefix'] += "_Cached"
@@ -401,6 +495,8 @@ class WebPageTest(object):
                     try:
                         self.log_handler = logging.FileHandler(task['debug_log'])
                         self.log_handler.setFormatter(self.log_formatter)
+                        if self.log_filter is not None:
+                            self.log_handler.addFilter(self.log_filter)
                         logging.getLogger().addHandler(self.log_handler)
                     except Exception:
                         pass
@@ -436,9 +532,50 @@ class WebPageTest(object):
                 pass
         return task
 
+    def close_task_log(self, task=None):
+        """Stop logging to the debug log file (only if it belongs to the given task)"""
+        log_handler = self.log_handler
+        if log_handler is not None:
+            if task is None or ('debug_log' in task and
+                                log_handler.baseFilename == os.path.abspath(task['debug_log'])):
+                try:
+                    self.log_handler = None
+                    log_handler.close()
+                    logging.getLogger().removeHandler(log_handler)
+                except Exception:
+                    pass
+
+    def exclude_thread_from_task_log(self, thread_id):
+        """Keep the given (background) thread's log records out of the current task's log"""
+        self.log_filter = ThreadLogFilter(thread_id, False)
+        if self.log_handler is not None:
+            self.log_handler.addFilter(self.log_filter)
+
+    def open_thread_log(self, task):
+        """Append the calling thread's log records to the task's debug log"""
+        log_handler = None
+        if 'debug_log' in task:
+            try:
+                log_handler = logging.FileHandler(task['debug_log'])
+                log_handler.setFormatter(self.log_formatter)
+                log_handler.addFilter(ThreadLogFilter(threading.current_thread().ident, True))
+                logging.getLogger().addHandler(log_handler)
+            except Exception:
+                log_handler = None
+        return log_handler
+
+    def close_thread_log(self, log_handler):
+        """Stop logging to a handler from open_thread_log"""
+        if log_handler is not None:
+            try:
+                logging.getLogger().removeHandler(log_handler)
+                log_handler.close()
+            except Exception:
+                pass
+
     def running_another_test(self, task):
         """Increment the port for Chrome and the run count"""
-        task['port'] = 9222 + (self.test_run_count % 500)
+        task['port'] = self.base_port + (self.test_run_count % PORTS_PER_SLOT)
         self.test_run_count += 1
 
     def build_script(self, job, task):
@@ -589,22 +726,9 @@ class WebPageTest(object):
         cpu_pct = None
         self.update_browser_viewport(task)
         # Stop logging to the file
-        if self.log_handler is not None:
-            try:
-                self.log_handler.close()
-                logging.getLogger().removeHandler(self.log_handler)
-                self.log_handler = None
-            except Exception:
-                pass
+        self.close_task_log(task)
         if 'debug_log' in task and os.path.isfile(task['debug_log']):
-            debug_out = task['debug_log'] + '.gz'
-            with open(task['debug_log'], 'rb') as f_in:
-                with gzip.open(debug_out, 'wb', 7) as f_out:
-                    shutil.copyfileobj(f_in, f_out)
-            try:
-                os.remove(task['debug_log'])
-            except Exception:
-                pass
+            compress_file(task['debug_log'], artifact='debug_log')
         # Write out the accumulated page_data
         if task['page_data']:
             if 'browser' in self.job:
@@ -616,8 +740,9 @@ class WebPageTest(object):
             path = os.path.join(task['dir'], task['prefix'] + '_page_data.json.gz')
             json_page_data = json.dumps(task['page_data'])
             logging.debug('Page Data: %s', json_page_data)
-            with gzip.open(path, 'wb', 7) as outfile:
-                outfile.write(json_page_data)
+            write_gzip(path, json_page_data, 'page_data')
+        # Make sure the background compression of this run's artifacts has finished
+        wait_for_compression(task['compression_jobs'])
         data = {'id': task['id'],
                 'location': self.location,
                 'run': str(task['run']),
@@ -629,72 +754,22 @@ class WebPageTest(object):
             data['ec2'] = self.instance_id
         if self.zone is not None:
             data['ec2zone'] = self.zone
-        needs_zip = []
-        zip_path = None
-        if os.path.isdir(task['dir']):
-            # upload any video images
-            if bool(self.job['video']) and len(task['video_directories']):
-                for video_subdirectory in task['video_directories']:
-                    video_dir = os.path.join(task['dir'], video_subdirectory)
-                    if os.path.isdir(video_dir):
-                        for filename in os.listdir(video_dir):
-                            filepath = os.path.join(video_dir, filename)
-                            if os.path.isfile(filepath):
-                                name = video_subdirectory + '/' + filename
-                                if os.path.getsize(filepath) > 100000:
-                                    logging.debug('Uploading %s (%d bytes)', filename,
-                                                  os.path.getsize(filepath))
-                                    if self.post_data(self.url + "resultimage.php", data,
-                                                      filepath, task['prefix'] + '_' + filename):
-                                        os.remove(filepath)
-                                    else:
-                                        needs_zip.append({'path': filepath, 'name': name})
-                                else:
-                                    needs_zip.append({'path': filepath, 'name': name})
-            # Upload the separate large files (> 100KB)
-            for filename in os.listdir(task['dir']):
-                filepath = os.path.join(task['dir'], filename)
-                if os.path.isfile(filepath):
-                    # Delete any video files that may have squeaked by
-                    if not self.job['keepvideo'] and filename[-4:] == '.mp4' and \
-                            filename.find('rendered_video') == -1:
-                        try:
-                            os.remove(filepath)
-                        except Exception:
-                            pass
-                    elif os.path.getsize(filepath) > 100000:
-                        logging.debug('Uploading %s (%d bytes)', filename,
-                                      os.path.getsize(filepath))
-                        if self.post_data(self.url + "resultimage.php", data, filepath, filename):
-                            try:
-                                os.remove(filepath)
-                            except Exception:
-                                pass
-                        else:
-                            needs_zip.append({'path': filepath, 'name': filename})
-                    else:
-                        needs_zip.append({'path': filepath, 'name': filename})
-            # Zip the remaining files
-            if len(needs_zip):
-                zip_path = os.path.join(task['dir'], "result.zip")
-                with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_STORED) as zip_file:
-                    for zipitem in needs_zip:
-                        logging.debug('Storing %s (%d bytes)', zipitem['name'],
-                                      os.path.getsize(zipitem['path']))
-                        zip_file.write(zipitem['path'], zipitem['name'])
-                        try:
-                            os.remove(zipitem['path'])
-                        except Exception:
-                            pass
-        # Post the workdone event for the task (with the zip attached)
+        workdone_data = dict(data)
         if task['done']:
-            data['done'] = '1'
+            workdone_data['done'] = '1'
         if task['error'] is not None:
-            data['error'] = task['error']
+            workdone_data['error'] = task['error']
         if cpu_pct is not None:
-            data['cpu'] = '{0:0.2f}'.format(cpu_pct)
-        logging.debug('Uploading result zip')
-        self.post_data(self.url + "workdone.php", data, zip_path, 'result.zip')
+            workdone_data['cpu'] = '{0:0.2f}'.format(cpu_pct)
+        # Move the results into the upload spool and upload them. workdone is
+        # only posted after all of the separate file uploads have completed.
+        manifest = None
+        try:
+            manifest = self.uploader.spool(task, self.url, data, workdone_data,
+                                           bool(self.job['video']), self.job['keepvideo'])
+        except Exception as err:
+            logging.critical("Error spooling the test results: %s", err.__str__())
+        self.uploader.upload(manifest, self.url, workdone_data)
         # Clean up so we don't leave directories lying around
         if os.path.isdir(task['dir']):
             try:
@@ -708,7 +783,7 @@ class WebPageTest(object):
                 pass
 
     def post_data(self, url, data, file_path, filename):
-        """Send a multi-part post"""
+        """Send a multi-part post (file_path can also be a streamed MultipartBody)"""
         import requests
         ret = True
         # pass the data fields as query params and any files as post data
@@ -718,12 +793,21 @@ class WebPageTest(object):
                 url += key + '=' + urllib.quote_plus(data[key]) + '&'
         logging.debug(url)
         try:
-            if file_path is not None and os.path.isfile(file_path):
-                self.session.post(url,
-                                  files={'file':(filename, open(file_path, 'rb'))},
-                                  timeout=300,)
+            if file_path is not None and hasattr(file_path, 'read'):
+                # Streamed body (result zip)
+                file_path.seek(0)
+                response = self.session.post(url, data=file_path,
+                                             headers={'Content-Type': file_path.content_type},
+                                             timeout=300)
+            elif file_path is not None and os.path.isfile(file_path):
+                with open(file_path, 'rb') as f_in:
+                    response = self.session.post(url, files={'file':(filename, f_in)},
+                                                 timeout=300)
             else:
-                self.session.post(url)
+                response = self.session.post(url, timeout=300)
+            if response.status_code >= 400:
+                logging.error("Upload failed with HTTP status %d", response.status_code)
+                ret = False
         except requests.exceptions.RequestException as err:
             logging.critical("Upload: %s", err.strerror)
             ret = False
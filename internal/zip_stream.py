@@ -0,0 +1,199 @@
+# Copyright 2017 Google Inc. All rights reserved.
+# Use of this source code is governed by the Apache 2.0 license that can be
+# found in the LICENSE file.
+"""Zip archives generated on the fly as a streaming (multipart) request body"""
+import binascii
+import os
+import random
+import struct
+import time
+import zipfile
+import zlib
+
+# Files that are already compressed are stored as-is, everything else is deflated
+STORED_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.gz', '.zip', '.mp4', '.webm', '.br']
+CHUNK_SIZE = 64 * 1024
+# Compressed data for files up to this size is kept in memory between the sizing and
+# streaming passes, larger files are compressed again while streaming
+CACHE_SIZE = 1024 * 1024
+
+class ZipStream(object):
+    """Iterable zip archive built from files on disk.
+    The sizes and CRCs are calculated up-front so the local headers are complete
+    (no data descriptors) and the total length is known before anything is sent."""
+    def __init__(self, files):
+        self.entries = []
+        self.length = 0
+        for path, zip_name in files:
+            self.add(path, zip_name)
+        self.length += sum([len(self.central_header(entry)) for entry in self.entries])
+        self.length += struct.calcsize(zipfile.structEndArchive)
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return self.generate()
+
+    def add(self, path, zip_name):
+        """Scan the file to get the CRC and compressed size"""
+        ext = os.path.splitext(zip_name)[1].lower()
+        entry = {'path': path,
+                 'name': zip_name.encode('utf-8') if isinstance(zip_name, unicode) else zip_name,
+                 'method': zipfile.ZIP_STORED if ext in STORED_EXTENSIONS else \
+                           zipfile.ZIP_DEFLATED,
+                 'date_time': time.localtime(os.path.getmtime(path))[0:6],
+                 'crc': 0,
+                 'size': 0,
+                 'compressed_size': 0,
+                 'data': None,
+                 'offset': self.length}
+        cache = [] if entry['method'] == zipfile.ZIP_DEFLATED else None
+        for chunk in self.read_file(entry, True):
+            entry['compressed_size'] += len(chunk)
+            if cache is not None:
+                if entry['compressed_size'] <= CACHE_SIZE:
+                    cache.append(chunk)
+                else:
+                    cache = None
+        if cache is not None:
+            entry['data'] = ''.join(cache)
+        self.length += len(self.local_header(entry)) + entry['compressed_size']
+        self.entries.append(entry)
+
+    def read_file(self, entry, scan):
+        """Generate the (compressed) file data, updating the CRC and size on the scan pass"""
+        compressor = None
+        if entry['method'] == zipfile.ZIP_DEFLATED:
+            compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        with open(entry['path'], 'rb') as f_in:
+            while True:
+                data = f_in.read(CHUNK_SIZE)
+                if not data:
+                    break
+                if scan:
+                    entry['crc'] = binascii.crc32(data, entry['crc'])
+                    entry['size'] += len(data)
+                if compressor is not None:
+                    data = compressor.compress(data)
+                if data:
+                    yield data
+        if compressor is not None:
+            data = compressor.flush()
+            if data:
+                yield data
+
+    @staticmethod
+    def dos_date_time(entry):
+        """Pack the modification time in the zip (DOS) format"""
+        date_time = entry['date_time']
+        dos_date = (max(date_time[0], 1980) - 1980) << 9 | date_time[1] << 5 | date_time[2]
+        dos_time = date_time[3] << 11 | date_time[4] << 5 | (date_time[5] // 2)
+        return dos_date, dos_time
+
+    def local_header(self, entry):
+        """Build the local file header for an entry"""
+        dos_date, dos_time = self.dos_date_time(entry)
+        return struct.pack(zipfile.structFileHeader, zipfile.stringFileHeader, 20, 0, 0,
+                           entry['method'], dos_time, dos_date, entry['crc'] & 0xFFFFFFFF,
+                           entry['compressed_size'], entry['size'], len(entry['name']),
+                           0) + entry['name']
+
+    def central_header(self, entry):
+        """Build the central directory record for an entry"""
+        dos_date, dos_time = self.dos_date_time(entry)
+        return struct.pack(zipfile.structCentralDir, zipfile.stringCentralDir, 20, 3, 20, 0,
+                           0, entry['method'], dos_time, dos_date, entry['crc'] & 0xFFFFFFFF,
+                           entry['compressed_size'], entry['size'], len(entry['name']),
+                           0, 0, 0, 0, 0o600 << 16, entry['offset']) + entry['name']
+
+    def generate(self):
+        """Generate the archive in chunks"""
+        for entry in self.entries:
+            yield self.local_header(entry)
+            if entry['data'] is not None:
+                yield entry['data']
+            else:
+                size = 0
+                for chunk in self.read_file(entry, False):
+                    size += len(chunk)
+                    yield chunk
+                if size != entry['compressed_size']:
+                    raise IOError('{0} changed while it was being zipped'.format(entry['path']))
+        directory_offset = self.length - struct.calcsize(zipfile.structEndArchive)
+        directory_size = 0
+        for entry in self.entries:
+            record = self.central_header(entry)
+            directory_size += len(record)
+            yield record
+        directory_offset -= directory_size
+        yield struct.pack(zipfile.structEndArchive, zipfile.stringEndArchive, 0, 0,
+                          len(self.entries), len(self.entries), directory_size,
+                          directory_offset, 0)
+
+class MultipartBody(object):
+    """multipart/form-data request body with a single streamed file field.
+    Behaves as a read-only file so the HTTP client sends it in blocks with a
+    Content-Length (no chunked transfer encoding)."""
+    def __init__(self, field, filename, stream, content_type='application/zip'):
+        self.reader = None
+        self.buffer = ''
+        self.offset = 0
+        self.position = 0
+        self.boundary = '{0:032x}'.format(random.getrandbits(128))
+        self.content_type = 'multipart/form-data; boundary=' + self.boundary
+        self.stream = stream
+        self.header = '--{0}\r\nContent-Disposition: form-data; name="{1}"; ' \
+                      'filename="{2}"\r\nContent-Type: {3}\r\n\r\n'.format(
+                          self.boundary, field, filename, content_type)
+        self.footer = '\r\n--{0}--\r\n'.format(self.boundary)
+
+    def __len__(self):
+        return len(self.header) + len(self.stream) + len(self.footer)
+
+    def __iter__(self):
+        return self.generate()
+
+    def generate(self):
+        """Generate the body in chunks"""
+        yield self.header
+        for chunk in self.stream:
+            yield chunk
+        yield self.footer
+
+    def read(self, size=-1):
+        """Read the next block of the body"""
+        if self.reader is None:
+            self.reader = self.generate()
+        parts = []
+        available = 0
+        while size < 0 or available < size:
+            if self.offset >= len(self.buffer):
+                try:
+                    self.buffer = next(self.reader)
+                    self.offset = 0
+                except StopIteration:
+                    break
+                continue
+            count = len(self.buffer) - self.offset
+            if size >= 0:
+                count = min(count, size - available)
+            parts.append(self.buffer[self.offset:self.offset + count])
+            self.offset += count
+            available += count
+        data = ''.join(parts)
+        self.position += len(data)
+        return data
+
+    def tell(self):
+        """Current read position"""
+        return self.position
+
+    def seek(self, offset, whence=0):
+        """Only rewinding to the start is supported (for retries and redirects)"""
+        if offset != 0 or whence != 0:
+            raise IOError('MultipartBody can only be rewound to the start')
+        self.reader = None
+        self.buffer = ''
+        self.offset = 0
+        self.position = 0
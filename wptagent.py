@@ -7,9 +7,11 @@ import atexit
 import logging
 import os
 import platform
+import Queue
 import signal
 import subprocess
 import sys
+import threading
 import time
 import traceback
 
@@ -20,6 +22,8 @@ class WPTAgent(object):
         from internal.webpagetest import WebPageTest
         from internal.traffic_shaping import TrafficShaper
         from internal.adb import Adb
+        from internal.compression import configure
+        configure(options)
         self.must_exit = False
         self.options = options
         self.capture_display = None
@@ -32,6 +36,10 @@ class WPTAgent(object):
         self.adb = Adb(self.options, self.persistent_work_dir) if self.options.android else None
         self.browsers = Browsers(options, browsers, self.adb)
         self.shaper = TrafficShaper(options)
+        self.post_queue = None
+        self.post_thread = None
+        self.post_cpus = None
+        self.start_time = None
         atexit.register(self.cleanup)
         signal.signal(signal.SIGTERM, self.signal_handler)
         signal.signal(signal.SIGINT, self.signal_handler)
@@ -39,19 +47,25 @@ class WPTAgent(object):
     def run_testing(self):
         """Main testing flow"""
         import monotonic
-        start_time = monotonic.monotonic()
+        self.start_time = monotonic.monotonic()
         browser = None
         exit_file = os.path.join(self.root_path, 'exit')
+        if self.options.pipeline:
+            self.start_post_processing()
         while not self.must_exit:
             try:
                 if os.path.isfile(exit_file):
-                    try:
-                        os.remove(exit_file)
-                    except Exception:
-                        pass
+                    # When running as a slot the manager removes it after all slots exit
+                    if self.options.slot is None:
+                        try:
+                            os.remove(exit_file)
+                        except Exception:
+                            pass
                     self.must_exit = True
                     break
                 if self.browsers.is_ready():
+                    if self.post_queue is not None:
+                        self.post_queue.join()
                     self.job = self.wpt.get_test()
                     if self.job is not None:
                         self.job['capture_display'] = self.capture_display
@@ -78,13 +92,13 @@ class WPTAgent(object):
                                     '{0}'.format(msg)
                                 logging.critical("Unhandled exception running test: %s", msg)
                                 traceback.print_exc(file=sys.stdout)
-                            self.wpt.upload_task_result(self.task)
+                            self.finish_task()
                             # Set up for the next run
                             self.task = self.wpt.get_task(self.job)
                 if self.job is not None:
                     self.job = None
                 else:
-                    self.sleep(self.options.polling)
+                    self.sleep(self.wpt.get_poll_delay())
             except Exception as err:
                 msg = ''
                 if err is not None and err.__str__() is not None:
@@ -98,9 +112,84 @@ class WPTAgent(object):
                     browser.on_stop_recording(None)
                     browser = None
             if self.options.exit > 0:
-                run_time = (monotonic.monotonic() - start_time) / 60.0
+                run_time = (monotonic.monotonic() - self.start_time) / 60.0
                 if run_time > self.options.exit:
                     break
+        if self.post_queue is not None:
+            self.post_queue.join()
+
+    def start_post_processing(self):
+        """Start the background worker for post-processing and uploading runs"""
+        from internal.os_util import get_allowed_cpus, pin_current_thread
+        # Give the worker (and the processing tools it launches) its own CPU and keep the
+        # main thread (and the browsers it launches) off of it
+        cpus = get_allowed_cpus() if platform.system() == "Linux" else []
+        if len(cpus) > 1 and pin_current_thread(cpus[:-1]):
+            self.post_cpus = cpus[-1:]
+            logging.debug("Post-processing on CPU %d, testing on CPUs %s", cpus[-1],
+                          ','.join([str(cpu) for cpu in cpus[:-1]]))
+        self.post_queue = Queue.Queue()
+        self.post_thread = threading.Thread(target=self.post_processing_thread)
+        self.post_thread.daemon = True
+        self.post_thread.start()
+
+    def post_processing_thread(self):
+        """Post-process and upload the completed runs in the background.  Each processing
+        stage and the upload wait until no browser is recording so they don't compete with
+        the test being measured for the GIL, CPU or network (a stage that is already
+        running when a recording starts runs to completion)."""
+        from internal.os_util import pin_current_thread, wait_for_recording_idle
+        self.wpt.exclude_thread_from_task_log(threading.current_thread().ident)
+        if self.post_cpus is not None:
+            pin_current_thread(self.post_cpus)
+        if platform.system() == "Linux":
+            try:
+                os.nice(10)
+            except Exception:
+                pass
+        while True:
+            task = self.post_queue.get()
+            wait_for_recording_idle()
+            log_handler = self.wpt.open_thread_log(task)
+            try:
+                if 'deferred_processing' in task and task['deferred_processing']:
+                    processor = task['deferred_processing']
+                    task['deferred_processing'] = None
+                    processor.process(wait_for_recording_idle)
+            except Exception as err:
+                logging.critical("Unhandled exception post-processing test: %s", err.__str__())
+                traceback.print_exc(file=sys.stdout)
+            # The debug log is compressed for the upload
+            self.wpt.close_thread_log(log_handler)
+            wait_for_recording_idle()
+            try:
+                self.wpt.upload_task_result(task)
+            except Exception as err:
+                logging.critical("Unhandled exception uploading test: %s", err.__str__())
+                traceback.print_exc(file=sys.stdout)
+            self.post_queue.task_done()
+
+    def finish_task(self):
+        """Post-process and upload the current run (in the background if pipelining)"""
+        if self.options.prefetch and self.task['done'] and not self.exiting():
+            self.wpt.prefetch_test()
+        if self.post_queue is not None:
+            self.wpt.close_task_log(self.task)
+            self.post_queue.put(self.task)
+            # The last run of a job has to be uploaded before asking for more work
+            if self.task['done']:
+                self.post_queue.join()
+        else:
+            self.wpt.upload_task_result(self.task)
+
+    def exiting(self):
+        """Check to see if the agent is going to exit after the current job"""
+        import monotonic
+        exiting = self.must_exit or os.path.isfile(os.path.join(self.root_path, 'exit'))
+        if not exiting and self.options.exit > 0 and self.start_time is not None:
+            run_time = (monotonic.monotonic() - self.start_time) / 60.0
+            exiting = run_time > self.options.exit
+        return exiting
 
     def run_single_test(self):
         """Run a single test run"""
@@ -226,10 +315,10 @@ class WPTAgent(object):
             print "Missing requests module. Please run 'pip install requests'"
             ret = False
 
-        try:
-            import ujson as _
-        except ImportError:
-            print "Missing ujson parser. Please run 'pip install ujson'"
+        from internal.support import json_codec
+        if json_codec.BACKEND.name == 'json':
+            print "Missing a fast JSON parser (orjson, ujson or simplejson with its C " \
+                "speedups). Please run 'pip install ujson'"
             ret = False
 
         try:
@@ -285,7 +374,8 @@ class WPTAgent(object):
                 print "Missing pywin32 module. Please run 'python -m pip install pypiwin32'"
                 ret = False
 
-        if not self.options.android:
+        # The other slots will be busy testing so the system will never be idle
+        if not self.options.android and self.options.slot is None:
             self.wait_for_idle(300)
         self.shaper.remove()
         if not self.shaper.install():
@@ -403,6 +493,21 @@ def main():
                         help="Load config settings from GCE user data.")
     parser.add_argument('--alive',
                         help="Watchdog file to update when successfully connected.")
+    parser.add_argument('--pipeline', action='store_true', default=False,
+                        help="Post-process and upload each run in the background while "\
+                        "the next run starts.")
+    parser.add_argument('--slots', type=int, default=1,
+                        help="Number of isolated test slots to run in parallel (Linux only).  "\
+                        "Each slot gets its own display, network namespace with traffic-shaping "\
+                        "and set of CPUs and polls for work as '<name>-<slot>'.")
+    parser.add_argument('--slot', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--bodyfetches', type=int, default=4,
+                        help="Number of response bodies to fetch from the browser in parallel "\
+                        "(defaults to 4).")
+    parser.add_argument('--gzipstore', action='store_true', default=False,
+                        help="Store the large artifacts (traces, netlogs, pcaps) in their "\
+                        "gzip containers without compressing them (for servers that "\
+                        "recompress the results).")
 
     # Video capture/display settings
     parser.add_argument('--xvfb', action='store_true', default=False,
@@ -421,6 +526,15 @@ def main():
     parser.add_argument('--key', help="Location key (optional).")
     parser.add_argument('--polling', type=int, default=5,
                         help='Polling interval for work (defaults to 5 seconds).')
+    parser.add_argument('--maxpolling', type=int,
+                        help='Maximum polling interval when backing off while there is no work '\
+                        '(defaults to the polling interval).')
+    parser.add_argument('--longpoll', type=int, default=0,
+                        help='Ask the server to hold work requests open for up to the '\
+                        'specified number of seconds until a job is available.')
+    parser.add_argument('--prefetch', action='store_true', default=False,
+                        help='Check for the next job while the results of the current one '\
+                        'are uploading.')
 
     # Traffic-shaping options (defaults to host-based)
     parser.add_argument('--shaper', help='Override default traffic shaper. '\
@@ -489,6 +603,17 @@ def main():
     logging.basicConfig(level=log_level, format="%(asctime)s.%(msecs)03d - %(message)s",
                         datefmt="%H:%M:%S")
 
+    if options.slots > 1 and options.slot is None:
+        if platform.system() != "Linux" or options.android:
+            print "Multiple slots are only supported for desktop testing on Linux"
+            exit(1)
+        from internal.slots import SlotManager
+        SlotManager(options, os.path.abspath(os.path.dirname(__file__))).run()
+        return
+    if options.slot is not None:
+        # Inherited by everything the slot launches so it only cleans up its own processes
+        os.environ['WPT_SLOT'] = str(options.slot)
+
     browsers = None
     if not options.android:
         browsers = find_browsers()
@@ -496,12 +621,16 @@ def main():
             print "No browsers configured. Check that browsers.ini is present and correct."
             exit(1)
 
+    # The trace parser process is forked before the agent starts any threads
+    from internal.devtools import start_trace_parser, stop_trace_parser
+    start_trace_parser()
     agent = WPTAgent(options, browsers)
     if agent.startup():
         #Create a work directory relative to where we are running
         print "Running agent, hit Ctrl+C to exit"
         agent.run_testing()
         print "Done"
+    stop_trace_parser()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+__doc__ = """
+Micro-benchmarks for the websocket hot paths on DevTools-shaped traffic.
+
+The traffic is either generated (small Network/Page events, large
+screenshot responses and trace chunks, the mix the agent receives from
+the browser) or replayed from recorded DevTools artifacts
+(``_devtools.json.gz``, ``_trace.json.gz``...), every entry of which
+becomes one text frame.
+
+The previous pure Python implementations (per-octet UTF-8 DFA, payload
+concatenation and per-byte masking) are kept here as references so the
+before/after numbers can be reproduced.
+
+Run it from the root of the agent::
+
+    python -m ws4py.benchmark [-i ITERATIONS] [-b utf8|framing] [recorded files...]
+"""
+import base64
+import gzip
+import json
+import os
+import random
+import time
+
+from ws4py.framing import Frame, OPCODE_TEXT
+from ws4py.streaming import Stream
+from ws4py.utf8validator import Utf8Validator
+from ws4py.websocket import DEFAULT_READING_SIZE
+
+__all__ = ['generate_messages', 'load_messages', 'encode_frames', 'split_reads',
+           'best_time', 'ReferenceUtf8Validator', 'benchmark_utf8',
+           'reference_mask', 'reference_collect', 'collect', 'parse_stream',
+           'benchmark_framing', 'main']
+
+# Shape of the generated traffic (~17MB)
+SMALL_EVENTS = 2000
+SCREENSHOTS = 10
+SCREENSHOT_SIZE = 600 * 1024
+TRACE_CHUNKS = 5
+TRACE_CHUNK_SIZE = 2 * 1024 * 1024
+# Range of the socket reads the frames are fed in
+MIN_READ_SIZE = 16 * 1024
+MAX_READ_SIZE = 64 * 1024
+MASKING_KEY = b'\x37\xfa\x21\x3d'
+
+def generate_messages(seed=0):
+    """
+    Builds a list of utf-8 encoded DevTools messages: small events,
+    base64 screenshot responses and trace data chunks, shuffled.
+    """
+    rand = random.Random(seed)
+    messages = []
+    for i in range(SMALL_EVENTS):
+        event = {'method': 'Network.dataReceived',
+                 'params': {'requestId': '1000.{0:d}'.format(i),
+                            'timestamp': 1000.0 + i * 0.001,
+                            'dataLength': rand.randint(100, 100000),
+                            'encodedDataLength': rand.randint(100, 100000)}}
+        if i % 10 == 0:
+            # Some non-ASCII content to keep the validators honest
+            event = {'method': 'Page.frameNavigated',
+                     'params': {'frame': {'id': str(i),
+                                          'url': u'https://example.com/été/漢字/{0:d}'.format(i)}}}
+        messages.append(json.dumps(event, ensure_ascii=False).encode('utf-8'))
+    for i in range(SCREENSHOTS):
+        data = base64.b64encode(os.urandom(SCREENSHOT_SIZE * 3 // 4)).decode('ascii')
+        messages.append(json.dumps({'id': i + 1, 'result': {'data': data}}).encode('utf-8'))
+    for i in range(TRACE_CHUNKS):
+        events = []
+        size = 0
+        while size < TRACE_CHUNK_SIZE:
+            entry = {'pid': 1, 'tid': rand.randint(1, 20), 'ts': rand.randint(0, 10 ** 9),
+                     'ph': 'X', 'dur': rand.randint(1, 10000), 'cat': 'devtools.timeline',
+                     'name': 'FunctionCall', 'args': {'data': {'url': u'https://example.com/über.js'}}}
+            events.append(entry)
+            size += 200
+        messages.append(json.dumps({'method': 'Tracing.dataCollected',
+                                    'params': {'value': events}},
+                                   ensure_ascii=False).encode('utf-8'))
+    rand.shuffle(messages)
+    return messages
+
+def load_messages(paths):
+    """
+    Loads recorded DevTools artifacts (json arrays, optionally gzipped),
+    returning every entry as a utf-8 encoded message.
+    """
+    messages = []
+    for path in paths:
+        if path.lower().endswith('.gz'):
+            f = gzip.open(path, 'rb')
+        else:
+            f = open(path, 'rb')
+        try:
+            entries = json.loads(f.read().decode('utf-8'))
+        finally:
+            f.close()
+        if isinstance(entries, dict):
+            entries = entries.get('traceEvents', [entries])
+        for entry in entries:
+            messages.append(json.dumps(entry, ensure_ascii=False).encode('utf-8'))
+    return messages
+
+def encode_frames(messages):
+    """
+    Returns the bytes the browser sends for the messages: one
+    unmasked text frame each.
+    """
+    return b''.join(Frame(opcode=OPCODE_TEXT, body=m, fin=1).build() for m in messages)
+
+def split_reads(data, seed=0):
+    """
+    Splits the data the way the socket delivers it, in reads of
+    MIN_READ_SIZE to MAX_READ_SIZE bytes.
+    """
+    rand = random.Random(seed)
+    reads = []
+    offset = 0
+    while offset < len(data):
+        size = rand.randint(MIN_READ_SIZE, MAX_READ_SIZE)
+        reads.append(data[offset:offset + size])
+        offset += size
+    return reads
+
+def best_time(func, iterations):
+    """
+    Returns the best wall time of ``iterations`` calls of ``func``.
+    """
+    best = None
+    for _ in range(iterations):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def report(name, elapsed, frames, size):
+    print('    {0:32s} {1:9.3f} s {2:12.0f} frames/s {3:9.1f} MB/s'.format(
+        name, elapsed, frames / elapsed if elapsed else 0,
+        size / elapsed / (1024 * 1024) if elapsed else 0))
+
+class ReferenceUtf8Validator(object):
+    """
+    The previous validator: Bjoern Hoehrmann's DFA run one octet
+    at a time in Python.
+    """
+    UTF8VALIDATOR_DFA = Utf8Validator.UTF8VALIDATOR_DFA
+    UTF8_ACCEPT = 0
+    UTF8_REJECT = 1
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.state = ReferenceUtf8Validator.UTF8_ACCEPT
+        self.i = 0
+
+    def validate(self, ba):
+        state = self.state
+        DFA = ReferenceUtf8Validator.UTF8VALIDATOR_DFA
+        i = 0
+        for i, b in enumerate(ba):
+            state = DFA[256 + (state << 4) + DFA[b]]
+            if state == ReferenceUtf8Validator.UTF8_REJECT:
+                self.i += i
+                self.state = state
+                return False, False, i, self.i
+        self.i += i
+        self.state = state
+        return True, state == ReferenceUtf8Validator.UTF8_ACCEPT, i, self.i
+
+def benchmark_utf8(messages, iterations, reference=True):
+    """
+    Validates every message as one text frame with the current
+    validator and, unless disabled, the reference one.
+    """
+    size = sum(len(m) for m in messages)
+    validators = [('Utf8Validator', Utf8Validator, messages)]
+    if reference:
+        # The reference validator was fed a bytearray copy of each frame
+        validators.insert(0, ('ReferenceUtf8Validator', ReferenceUtf8Validator,
+                              [bytearray(m) for m in messages]))
+    print('utf-8 validation ({0:d} frames, {1:0.1f} MB)'.format(
+        len(messages), size / (1024.0 * 1024.0)))
+    for name, cls, frames in validators:
+        def run():
+            validator = cls()
+            for frame in frames:
+                validator.reset()
+                if not validator.validate(frame)[0]:
+                    raise ValueError('{0} rejected a valid frame'.format(name))
+        report(name, best_time(run, iterations), len(frames), size)
+
+def reference_mask(masking_key, data):
+    """
+    The previous Frame.mask(): a Python loop over every byte.
+    """
+    masked = bytearray(data)
+    key = bytearray(masking_key)
+    for i in range(len(data)):
+        masked[i] = masked[i] ^ key[i % 4]
+    return masked
+
+def reference_collect(reads):
+    """
+    The previous payload collection: the reads concatenated one by one.
+    """
+    some_bytes = b''
+    for b in reads:
+        some_bytes = some_bytes + b
+    return some_bytes
+
+def collect(reads):
+    """
+    The current payload collection: the reads appended to a bytearray.
+    """
+    some_bytes = bytearray()
+    for b in reads:
+        some_bytes += b
+    return some_bytes
+
+def parse_stream(reads, validate_utf8):
+    """
+    Feeds the reads to a client stream, handing it no more than it
+    asks for like WebSocket.process() does, and returns the number of
+    messages parsed.
+    """
+    stream = Stream(expect_masking=False, validate_utf8=validate_utf8)
+    parser = stream.parser
+    size = DEFAULT_READING_SIZE
+    count = 0
+    for data in reads:
+        offset = 0
+        while offset < len(data):
+            some_bytes = data[offset:offset + size]
+            offset += len(some_bytes)
+            size = parser.send(some_bytes) or DEFAULT_READING_SIZE
+            if stream.errors:
+                raise ValueError(stream.errors[0].reason)
+            if stream.has_message:
+                count += 1
+                stream.message = None
+    return count
+
+def benchmark_framing(messages, iterations, reference=True):
+    """
+    Times the collection of large payloads from the socket reads,
+    the masking of a large frame and the parsing of the whole stream
+    with and without utf-8 validation.
+    """
+    large = [m for m in messages if len(m) >= MAX_READ_SIZE]
+    if large:
+        reads = [split_reads(m) for m in large]
+        size = sum(len(m) for m in large)
+        print('payload collection ({0:d} frames, {1:0.1f} MB)'.format(
+            len(large), size / (1024.0 * 1024.0)))
+        collectors = [('bytearray', collect)]
+        if reference:
+            collectors.insert(0, ('reference (concatenation)', reference_collect))
+        for name, func in collectors:
+            def run():
+                for frame_reads in reads:
+                    func(frame_reads)
+            report(name, best_time(run, iterations), len(large), size)
+
+    payload = max(messages, key=len)
+    print('masking ({0:0.1f} MB frame)'.format(len(payload) / (1024.0 * 1024.0)))
+    frame = Frame(opcode=OPCODE_TEXT, body=payload, masking_key=MASKING_KEY, fin=1)
+    if frame.mask(payload) != reference_mask(MASKING_KEY, payload):
+        raise ValueError('Frame.mask() differs from the reference')
+    maskers = [('Frame.mask', lambda: frame.mask(payload))]
+    if reference:
+        maskers.insert(0, ('reference (per byte)', lambda: reference_mask(MASKING_KEY, payload)))
+    for name, func in maskers:
+        report(name, best_time(func, iterations), 1, len(payload))
+
+    data = encode_frames(messages)
+    reads = split_reads(data)
+    print('stream parsing ({0:d} frames, {1:0.1f} MB in {2:d} reads)'.format(
+        len(messages), len(data) / (1024.0 * 1024.0), len(reads)))
+    for name, validate_utf8 in [('Stream', False), ('Stream (utf-8 validation)', True)]:
+        def run():
+            count = parse_stream(reads, validate_utf8)
+            if count != len(messages):
+                raise ValueError('Parsed {0:d} of {1:d} frames'.format(count, len(messages)))
+        report(name, best_time(run, iterations), len(messages), len(data))
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark ws4py on DevTools-shaped traffic.',
+                                     prog='ws4py.benchmark')
+    parser.add_argument('-i', '--iterations', type=int, default=3,
+                        help="Number of runs of each benchmark, the best one is reported (default 3).")
+    parser.add_argument('--noreference', action='store_true', default=False,
+                        help="Skip the (slow) reference implementations.")
+    parser.add_argument('-b', '--benchmark', action='append', choices=['utf8', 'framing'],
+                        help="Benchmark to run, may be repeated (default all).")
+    parser.add_argument('files', nargs='*',
+                        help="Recorded DevTools artifacts (.json or .json.gz) to replay "
+                             "instead of the generated traffic.")
+    options, _ = parser.parse_known_args()
+    if options.files:
+        messages = load_messages(options.files)
+    else:
+        messages = generate_messages()
+    iterations = max(1, options.iterations)
+    benchmarks = options.benchmark or ['utf8', 'framing']
+    if 'utf8' in benchmarks:
+        benchmark_utf8(messages, iterations, not options.noreference)
+    if 'framing' in benchmarks:
+        benchmark_framing(messages, iterations, not options.noreference)
+
+if '__main__' == __name__:
+    main()
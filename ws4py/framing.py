@@ -2,7 +2,7 @@
 from struct import pack, unpack
 
 from ws4py.exc import FrameTooLargeException, ProtocolException
-from ws4py.compat import py3k, ord, range
+from ws4py.compat import ord, range
 
 # Frame opcodes defined in the spec.
 OPCODE_CONTINUATION = 0x0
@@ -14,6 +14,16 @@ OPCODE_PONG = 0xa
 
 __all__ = ['Frame']
 
+# XOR translation tables for each masking key byte, built on first use
+_XOR_TABLES = {}
+
+def _xor_table(key_byte):
+    table = _XOR_TABLES.get(key_byte)
+    if table is None:
+        table = bytes(bytearray([b ^ key_byte for b in range(256)]))
+        _XOR_TABLES[key_byte] = table
+    return table
+
 class Frame(object):
     def __init__(self, opcode=None, body=b'', masking_key=None, fin=0, rsv1=0, rsv2=0, rsv3=0):
         """
@@ -237,14 +247,14 @@ class Frame(object):
             self.masking_key = some_bytes
 
         if len(buf) < self.payload_length:
-            nxt_buf_size = self.payload_length - len(buf)
-            some_bytes = (yield nxt_buf_size)
-            some_bytes = buf + (some_bytes or b'')
+            # Large payloads arrive over many reads, collect them in place
+            # in a bytearray rather than copying the body on every read
+            some_bytes = bytearray(buf)
             while len(some_bytes) < self.payload_length:
                 l = self.payload_length - len(some_bytes)
                 b = (yield l)
                 if b is not None:
-                    some_bytes = some_bytes + b
+                    some_bytes += b
         else:
             if self.payload_length == len(buf):
                 some_bytes = buf
@@ -263,11 +273,13 @@ class Frame(object):
            j                   = i MOD 4
            transformed-octet-i = original-octet-i XOR masking-key-octet-j
 
+        The XOR is done a key byte at a time over every fourth byte of the
+        payload (bytearray slice translate) instead of byte by byte.
         """
         masked = bytearray(data)
-        if py3k: key = self.masking_key
-        else: key = map(ord, self.masking_key)
-        for i in range(len(data)):
-            masked[i] = masked[i] ^ key[i%4]
+        key = bytearray(self.masking_key)
+        for i in range(4):
+            if key[i]:
+                masked[i::4] = masked[i::4].translate(_xor_table(key[i]))
         return masked
     unmask = mask
@@ -23,25 +23,45 @@ class Message(object):
         The ``opcode`` indicates the message type and ``data`` is
         the possible message payload.
 
-        The payload is held internally as a a :func:`bytearray` as they are
-        faster than pure strings for append operations.
+        While the message is being built from its frames, the payload
+        is held internally as a a :func:`bytearray` as they are faster
+        than pure strings for append operations. It is converted to
+        bytes once, when the message completes (or when ``data`` is
+        first read).
 
         Unicode data will be encoded using the provided ``encoding``.
         """
         self.opcode = opcode
         self._completed = False
         self.encoding = encoding
+        self._data = b''
+        self._buffer = None
 
         if isinstance(data, unicode):
             if not encoding:
                 raise TypeError("unicode data without an encoding")
-            data = data.encode(encoding)
+            self._data = data.encode(encoding)
         elif isinstance(data, bytearray):
-            data = bytes(data)
-        elif not isinstance(data, bytes):
+            self._buffer = data
+        elif isinstance(data, bytes):
+            self._data = data
+        else:
             raise TypeError("%s is not a supported data type" % type(data))
 
-        self.data = data
+    @property
+    def data(self):
+        """
+        The message payload as bytes.
+        """
+        if self._buffer is not None:
+            self._data = bytes(self._buffer)
+            self._buffer = None
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+        self._buffer = None
 
     def single(self, mask=False):
         """
@@ -84,21 +104,31 @@ class Message(object):
         """
         Sets the state for this message. Usually
         set by the stream's parser.
+
+        Completing the message converts the accumulated
+        payload to bytes.
         """
         self._completed = state
+        if state and self._buffer is not None:
+            self._data = bytes(self._buffer)
+            self._buffer = None
 
     def extend(self, data):
         """
         Add more ``data`` to the message.
+
+        The fragments are appended to a :func:`bytearray`
+        which is only converted to bytes once the message
+        completes.
         """
-        if isinstance(data, bytes):
-            self.data += data
-        elif isinstance(data, bytearray):
-            self.data += bytes(data)
-        elif isinstance(data, unicode):
-            self.data += data.encode(self.encoding)
-        else:
+        if isinstance(data, unicode):
+            data = data.encode(self.encoding)
+        elif not isinstance(data, (bytes, bytearray)):
             raise TypeError("%s is not a supported data type" % type(data))
+        if self._buffer is None:
+            self._buffer = bytearray(self._data)
+            self._data = b''
+        self._buffer += data
 
     def __len__(self):
         return len(self.__unicode__())
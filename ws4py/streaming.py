@@ -14,7 +14,7 @@ from ws4py.compat import py3k
 VALID_CLOSING_CODES = [1000, 1001, 1002, 1003, 1007, 1008, 1009, 1010, 1011]
 
 class Stream(object):
-    def __init__(self, always_mask=False, expect_masking=True):
+    def __init__(self, always_mask=False, expect_masking=True, validate_utf8=True):
         """ Represents a websocket stream of bytes flowing in and out.
 
         The stream doesn't know about the data provider itself and
@@ -40,6 +40,9 @@ class Stream(object):
 
         Set ``expect_masking`` to indicate masking will be
         checked on all parsed frames.
+
+        Unset ``validate_utf8`` to skip validating the text
+        frames when the peer is trusted to send valid UTF-8.
         """
 
         self.message = None
@@ -80,6 +83,7 @@ class Stream(object):
 
         self.always_mask = always_mask
         self.expect_masking = expect_masking
+        self.validate_utf8 = validate_utf8
 
     @property
     def parser(self):
@@ -202,16 +206,9 @@ class Stream(object):
                             msg = CloseControlMessage(code=1002, reason='Masked when not expected')
                             self.errors.append(msg)
                             break
-                        else:
-                            # If we reach this stage, it's because
-                            # the frame wasn't masked and we didn't expect
-                            # it anyway. Therefore, on py2k, the bytes
-                            # are actually a str object and can't be used
-                            # in the utf8 validator as we need integers
-                            # when we get each byte one by one.
-                            # Our only solution here is to convert our
-                            # string to a bytearray.
-                            some_bytes = bytearray(some_bytes)
+                        # Otherwise the frame wasn't masked and we didn't expect
+                        # it anyway. The utf8 validator works on whole buffers
+                        # (str or bytearray) so the payload is used as-is.
 
                     if frame.opcode == OPCODE_TEXT:
                         if self.message and not self.message.completed:
@@ -224,7 +221,7 @@ class Stream(object):
                         m.completed = (frame.fin == 1)
                         self.message = m
 
-                        if some_bytes:
+                        if some_bytes and self.validate_utf8:
                             is_valid, end_on_code_point, _, _ = utf8validator.validate(some_bytes)
 
                             if not is_valid or (m.completed and not end_on_code_point):
@@ -250,7 +247,7 @@ class Stream(object):
 
                         m.extend(some_bytes)
                         m.completed = (frame.fin == 1)
-                        if m.opcode == OPCODE_TEXT:
+                        if m.opcode == OPCODE_TEXT and self.validate_utf8:
                             if some_bytes:
                                 is_valid, end_on_code_point, _, _ = utf8validator.validate(some_bytes)
 
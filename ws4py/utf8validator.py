@@ -29,12 +29,28 @@
 ##
 ###############################################################################
 
+import codecs
+import re
+
+from ws4py.compat import py3k
+
+# Buffers are validated in blocks of this size to bound the memory used
+# by the decoded text (which is thrown away)
+VALIDATE_BLOCK_SIZE = 64 * 1024
+
+# Python 2's utf-8 codec accepts encoded surrogates (U+D800..U+DFFF) which
+# are not valid UTF-8
+SURROGATE_RE = re.compile(b'\xed[\xa0-\xbf]')
 
 class Utf8Validator(object):
     """
     Incremental UTF-8 validator with constant memory consumption (minimal state).
 
-    Implements the algorithm "Flexible and Economical UTF-8 Decoder" by
+    Whole buffers are validated by the C utf-8 codec, the only state kept
+    between calls is a partial code point (at most 3 bytes) left over at the
+    end of the previous fragment.
+
+    decode() implements the algorithm "Flexible and Economical UTF-8 Decoder" by
     Bjoern Hoehrmann (http://bjoern.hoehrmann.de/utf-8/decoder/dfa/).
     """
 
@@ -88,10 +104,11 @@ class Utf8Validator(object):
         self.state = Utf8Validator.UTF8_ACCEPT
         self.codepoint = 0
         self.i = 0
+        self.pending = b''
 
     def validate(self, ba):
         """
-        Incrementally validate a chunk of bytes provided as bytearray.
+        Incrementally validate a chunk of bytes (bytes or bytearray).
 
         Will return a quad (valid?, endsOnCodePoint?, currentIndex, totalIndex).
 
@@ -102,16 +119,35 @@ class Utf8Validator(object):
         When valid? == True, currentIndex will be len(ba) and totalIndex the
         total amount of consumed bytes.
         """
-        state = self.state
-        DFA = Utf8Validator.UTF8VALIDATOR_DFA
-        i = 0  # make sure 'i' is set if when 'ba' is empty
-        for i, b in enumerate(ba):
-            ## optimized version of decode(), since we are not interested in actual code points
-            state = DFA[256 + (state << 4) + DFA[b]]
-            if state == Utf8Validator.UTF8_REJECT:
-                self.i += i
-                self.state = state
-                return False, False, i, self.i
-        self.i += i
-        self.state = state
-        return True, state == Utf8Validator.UTF8_ACCEPT, i, self.i
+        if self.state == Utf8Validator.UTF8_REJECT:
+            return False, False, 0, self.i
+        pending = len(self.pending)
+        data = self.pending + bytes(ba) if pending else ba
+        length = len(data)
+        error = None
+        offset = 0
+        if not py3k:
+            match = SURROGATE_RE.search(data)
+            if match is not None:
+                error = match.start()
+                length = error
+        view = memoryview(data)
+        while offset < length:
+            end = min(offset + VALIDATE_BLOCK_SIZE, length)
+            try:
+                _, consumed = codecs.utf_8_decode(view[offset:end], 'strict', False)
+            except UnicodeDecodeError as err:
+                error = offset + err.start
+                break
+            offset += consumed
+            if end == length:
+                break
+        if error is not None:
+            self.state = Utf8Validator.UTF8_REJECT
+            self.pending = b''
+            index = max(0, error - pending)
+            self.i += index
+            return False, False, index, self.i
+        self.pending = bytes(data[offset:]) if offset < len(data) else b''
+        self.i += len(ba)
+        return True, not self.pending, len(ba), self.i